@@ -0,0 +1,73 @@
+"""Compares two benchmark result files, e.g. of two commits.
+
+Usage:
+    python benchmarks/compare.py baseline.json results.json --threshold 0.1
+
+Exits with status 1 if a case regressed by more than the threshold: a higher
+p50 latency or a lower throughput.
+"""
+
+import sys
+import json
+import argparse
+
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as file:
+        report = json.load(file)
+    # Results of before the vector store option ran on ChromaDB
+    results = {
+        (result["benchmark"], result["size"], result.get("vector_store", "chroma")):
+        result
+        for result in report["results"]
+        if "error" not in result
+    }
+    return report, results
+
+
+def change(before, after):
+    return (after - before) / before if before else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("baseline")
+    parser.add_argument("results")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative regression allowed"
+    )
+    args = parser.parse_args()
+
+    baseline_report, baseline = load(args.baseline)
+    report, results = load(args.results)
+    print(f"baseline: {baseline_report.get('commit')}")
+    print(f"results:  {report.get('commit')}\n")
+    print(
+        f"{'benchmark':>18} {'size':>9} {'store':>6} {'p50':>9} {'p99':>9} "
+        f"{'throughput':>11} {'peak RSS':>9}"
+    )
+
+    regressions = []
+    for key in sorted(baseline.keys() & results.keys()):
+        before, after = baseline[key], results[key]
+        p50 = change(before["p50_ms"], after["p50_ms"])
+        p99 = change(before["p99_ms"], after["p99_ms"])
+        throughput = change(before["throughput"], after["throughput"])
+        rss = change(before["peak_rss_mb"] or 0, after["peak_rss_mb"] or 0)
+        print(
+            f"{key[0]:>18} {key[1]:>9} {key[2]:>6} {p50:>+9.1%} {p99:>+9.1%} "
+            f"{throughput:>+11.1%} {rss:>+9.1%}"
+        )
+        if p50 > args.threshold or throughput < -args.threshold:
+            regressions.append(key)
+
+    for key in sorted(baseline.keys() ^ results.keys()):
+        print(f"{key[0]:>18} {key[1]:>9} {key[2]:>6}  only in one of the files")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import random
+
+
+LINE_WORDS = 12  # words per line, about 5 lines per sub-chunk
+
+
+class Corpus:
+    """Deterministic synthetic text, built from a random vocabulary.
+
+    Args:
+        seed (int): Seed of the generator, the same seed gives the same text.
+        vocabulary_size (int): Number of distinct words.
+    """
+
+    def __init__(self, seed=0, vocabulary_size=5000):
+        self.random = random.Random(seed)
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        self.vocabulary = [
+            "".join(self.random.choices(letters, k=self.random.randint(3, 10)))
+            for _ in range(vocabulary_size)
+        ]
+
+    def line(self, words=LINE_WORDS):
+        return " ".join(self.random.choices(self.vocabulary, k=words))
+
+    def lines(self, count):
+        return [self.line() for _ in range(count)]
+
+    def pages(self, sub_chunks, lines_per_page=40):
+        """Returns page texts that sub-chunk into about `sub_chunks` pieces."""
+        lines = self.lines(sub_chunks * 5)
+        return [
+            "\n".join(lines[i : i + lines_per_page])
+            for i in range(0, len(lines), lines_per_page)
+        ]
+
+    def sub_chunks(self, count, per_parent=8):
+        """Returns sub-chunks and the index of their parent chunk."""
+        chunks = ["\n".join(self.lines(5)) for _ in range(count)]
+        return chunks, [i // per_parent for i in range(count)]
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, font_size=9, leading=11):
+    """Writes a minimal text-only PDF, one page per text.
+
+    Args:
+        path (str): Path of the PDF file.
+        pages (list of str): Text of each page, lines separated by newlines.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, written once the pages are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for text in pages:
+        lines = [f"({escape(line)}) Tj T*" for line in text.split("\n")]
+        stream = "\n".join(
+            [f"BT /F1 {font_size} Tf {leading} TL 36 806 Td"] + lines + ["ET"]
+        ).encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        content_id = len(objects)
+        objects.append(
+            (
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+            ).encode("latin-1")
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode(
+        "latin-1"
+    )
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (i, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    with open(path, "wb") as file:
+        file.write(output)
+    return path
@@ -0,0 +1,66 @@
+import json
+import zlib
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from models.embedding import EmbeddingModel
+from models.fake import FakeModel
+
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Deterministic bag-of-words embedding: each word adds a signed one-hot
+    vector at the position given by its CRC32. Texts sharing words are close,
+    which is enough to exercise retrieval without a neural model."""
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+        self.words = {}
+
+    def word(self, word):
+        if word not in self.words:
+            crc = zlib.crc32(word.encode("utf-8"))
+            self.words[word] = (crc % self.dimension, 1.0 if crc & 1 << 31 else -1.0)
+        return self.words[word]
+
+    def __call__(self, input: Documents) -> Embeddings:
+        vectors = np.zeros((len(input), self.dimension), dtype=np.float32)
+        for i, text in enumerate(input):
+            for word in text.lower().split():
+                position, sign = self.word(word)
+                vectors[i, position] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return list(vectors / np.where(norms == 0, 1.0, norms))
+
+
+class HashingEmbeddingModel(EmbeddingModel):
+    def __init__(self, dimension=384):
+        super().__init__()
+        self.model_type = "Hashing"
+        self.model_name = f"hashing-{dimension}"
+        self.embedding_function = HashingEmbeddingFunction(dimension)
+
+    def embed(self, query):
+        return self.embedding_function([query])[0]
+
+
+class FakeLLM(FakeModel):
+    """Fake generation model that also answers the router.
+
+    JSON calls return a router decision asking for context with `query`,
+    other calls return a fixed answer.
+    """
+
+    def __init__(self, query, latency=0.0):
+        super().__init__(latency=latency, reply=lambda input: "benchmark answer")
+        self.routing = json.dumps(
+            {"classification": "Context", "new_query": query, "user_information": ""}
+        )
+
+    def predict_json(self, input, history=[]):
+        self._call(input)
+        return self.routing
+
+    async def apredict_json(self, input, history=[]):
+        await self._acall(input)
+        return self.routing
@@ -0,0 +1,374 @@
+"""Offline benchmarks of the chunking, ingestion and retrieval paths.
+
+The benchmarks need neither a Gemini key nor the e5 model: embeddings come
+from a deterministic hashing function and the LLM is a local fake. Corpora are
+synthetic and seeded, so runs on the same commit process the same data.
+
+Every (benchmark, size) case runs in its own process, in a temporary working
+directory, so that peak RSS is measured per case and runs leave nothing
+behind. The size is the number of sub-chunks of the corpus. Cases run once
+per vector store backend given with --vector-stores.
+
+Usage:
+    python benchmarks/run.py --sizes 1000 10000 --output results.json
+    python benchmarks/run.py --only retrieve --sizes 1000000
+    python benchmarks/run.py --only vector_query --vector-stores chroma numpy
+    python benchmarks/compare.py baseline.json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import yaml
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BENCHMARK_DIR = os.path.join(REPO_DIR, "benchmarks")
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(latencies, items):
+    """Summarizes the latencies of the samples of a case.
+
+    Args:
+        latencies (list of float): Duration of each sample, in seconds.
+        items (int): Number of items (chunks, queries...) of each sample.
+    """
+    latencies = np.asarray(latencies)
+    return {
+        "samples": len(latencies),
+        "items_per_sample": items,
+        "throughput": items * len(latencies) / latencies.sum(),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "mean_ms": float(latencies.mean() * 1000),
+        "total_s": float(latencies.sum()),
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def setup(vector_store="chroma"):
+    """Moves to a temporary working directory and installs the fakes.
+
+    The modules read `src/configs/config.yaml` and write `data/` relative to
+    the working directory, so `src` is linked into it.
+
+    Args:
+        vector_store (str): Vector store backend of the collections.
+
+    Returns:
+        tuple: The working directory and the configuration.
+    """
+    workdir = tempfile.mkdtemp(prefix="rag-benchmark-")
+    os.symlink(os.path.join(REPO_DIR, "src"), os.path.join(workdir, "src"))
+    os.chdir(workdir)
+    sys.path[:0] = [os.path.join(workdir, "src"), BENCHMARK_DIR]
+
+    with open("src/configs/config.yaml", "r", encoding="utf-8") as config_file:
+        config = yaml.safe_load(config_file)
+    config["processing"]["MULTIMODAL_EXTRACTION"] = False
+    config["retrieval"]["SPECULATIVE"] = False
+    config["cache"]["ENABLED"] = False
+    config["dataset"]["VECTOR_STORE"] = vector_store
+
+    from database.registry import register_embedding_model
+    from fakes import HashingEmbeddingModel
+
+    register_embedding_model(
+        config["processing"]["EMBEDDING_MODEL"], HashingEmbeddingModel()
+    )
+    return workdir, config
+
+
+def populate(config, size, collection_name="benchmark"):
+    """Fills a collection with `size` sub-chunks and their parent chunks.
+
+    Returns:
+        tuple: The collection and the sub-chunks.
+    """
+    from corpus import Corpus
+    from database.docstore import get_parent_store
+    from database.registry import get_collection
+
+    collection = get_collection(collection_name, config)
+    chunks, parents = Corpus(seed=1).sub_chunks(size)
+    batch_size = 5000
+    for start in range(0, size, batch_size):
+        end = min(start + batch_size, size)
+        collection.add(
+            ids=[f"id{i}" for i in range(start, end)],
+            documents=chunks[start:end],
+            metadatas=[
+                {"from": "corpus.pdf", "type": "text", "chunk": parents[i]}
+                for i in range(start, end)
+            ],
+        )
+
+    joined = {}
+    for chunk, parent in zip(chunks, parents):
+        joined[parent] = joined[parent] + "\n" + chunk if parent in joined else chunk
+    get_parent_store(config).add(
+        collection_name,
+        list(joined),
+        list(joined.values()),
+        [{"from": "corpus.pdf", "type": "text"} for _ in joined],
+    )
+    return collection, chunks
+
+
+def queries(chunks, count):
+    rng = np.random.default_rng(2)
+    return [chunks[i].split("\n")[0] for i in rng.integers(0, len(chunks), count)]
+
+
+@benchmark
+def basic_chunking(size, config, args):
+    from corpus import Corpus
+    from database.doc_processing import basic_chunking
+
+    texts = Corpus(seed=1).pages(size)
+    latencies = [timed(basic_chunking, texts, config)[0] for _ in range(args.repeat)]
+    return latencies, size
+
+
+@benchmark
+def sub_chunking(size, config, args):
+    from corpus import Corpus
+    from database.doc_processing import basic_chunking, sub_chunking
+
+    chunks, labels = basic_chunking(Corpus(seed=1).pages(size), config)
+    latencies = [timed(sub_chunking, chunks, labels)[0] for _ in range(args.repeat)]
+    return latencies, size
+
+
+@benchmark
+def process(size, config, args):
+    from corpus import Corpus, write_pdf
+    from database.doc_processing import process
+    from database.registry import get_collection
+
+    path = write_pdf("corpus.pdf", Corpus(seed=1).pages(size))
+    latencies = []
+    for sample in range(args.repeat):
+        collection = get_collection(f"process-{sample}", config)
+        latencies.append(timed(process, collection, path, config)[0])
+    return latencies, collection.count()
+
+
+@benchmark
+def retrieve(size, config, args):
+    from rag import Retriever
+
+    _, chunks = populate(config, size)
+    retriever = Retriever("benchmark", config)
+    latencies = [
+        timed(retriever.retrieve, query)[0] for query in queries(chunks, args.queries)
+    ]
+    return latencies, 1
+
+
+@benchmark
+def vector_query(size, config, args):
+    from rag import Retriever
+
+    collection, chunks = populate(config, size)
+    retriever = Retriever("benchmark", config)
+    embeddings = [retriever.embed(query) for query in queries(chunks, args.queries)]
+    n_results = retriever.top_k * retriever.fetch_multiplier
+    latencies = [
+        timed(collection.query, query_embeddings=[embedding], n_results=n_results)[0]
+        for embedding in embeddings
+    ]
+    return latencies, 1
+
+
+@benchmark
+def vector_query_batch(size, config, args):
+    from rag import Retriever
+
+    collection, chunks = populate(config, size)
+    retriever = Retriever("benchmark", config)
+    embeddings = [retriever.embed(query) for query in queries(chunks, args.queries)]
+    n_results = retriever.top_k * retriever.fetch_multiplier
+    latencies = [
+        timed(collection.query, query_embeddings=embeddings, n_results=n_results)[0]
+        for _ in range(args.repeat)
+    ]
+    return latencies, len(embeddings)
+
+
+@benchmark
+def group_sub_chunks(size, config, args):
+    from database.collection import group_sub_chunks
+
+    collection, _ = populate(config, size)
+    latencies = [
+        timed(group_sub_chunks, collection, config)[0] for _ in range(args.repeat)
+    ]
+    return latencies, size
+
+
+@benchmark
+def generate_response(size, config, args):
+    from fastapi.testclient import TestClient
+    from fakes import FakeLLM
+    from server import main
+
+    _, chunks = populate(config, size)
+    main.config["cache"]["ENABLED"] = False
+    main.config["retrieval"]["SPECULATIVE"] = False
+    llm = FakeLLM(queries(chunks, 1)[0], latency=args.llm_latency)
+    main.get_model_by_name = lambda name, api_key=None: llm
+
+    client = TestClient(main.app)
+    latencies = []
+    for query in queries(chunks, args.queries):
+        body = {
+            "model_name": "fake",
+            "collection_name": "benchmark",
+            "prompt_user": query,
+            "history": [],
+            "user_context": [],
+        }
+        latency, response = timed(client.post, "/generate-response/", json=body)
+        response.raise_for_status()
+        latencies.append(latency)
+    return latencies, 1
+
+
+def run_case(name, size, args, result_path):
+    """Runs one case in this process and writes its result as JSON."""
+    # The pipeline logs to stdout, keep only the results
+    sys.stdout = open(os.devnull, "w")
+    workdir, config = setup(args.vector_store)
+    try:
+        latencies, items = BENCHMARKS[name](size, config, args)
+        result = {"benchmark": name, "size": size, "vector_store": args.vector_store}
+        result.update(summarize(latencies, items))
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(result_path, "w", encoding="utf-8") as file:
+        json.dump(result, file)
+
+
+def run_subprocess(name, size, vector_store, args):
+    """Runs one case in a new process and returns its result."""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as file:
+        result_path = file.name
+    command = [sys.executable, os.path.abspath(__file__), "--case", name]
+    command += ["--sizes", str(size), "--result", result_path]
+    command += ["--repeat", str(args.repeat), "--queries", str(args.queries)]
+    command += ["--llm-latency", str(args.llm_latency)]
+    command += ["--vector-store", vector_store]
+    completed = subprocess.run(command)
+    if completed.returncode != 0:
+        result = {"benchmark": name, "size": size, "vector_store": vector_store}
+        result["error"] = completed.returncode
+        print(f"{name:>18} {size:>9} {vector_store:>6}  failed")
+    else:
+        with open(result_path, "r", encoding="utf-8") as file:
+            result = json.load(file)
+        print(
+            f"{name:>18} {size:>9} {vector_store:>6}"
+            f"  {result['throughput']:>12.1f} items/s"
+            f"  p50 {result['p50_ms']:>10.2f} ms"
+            f"  p99 {result['p99_ms']:>10.2f} ms"
+            f"  peak RSS {result['peak_rss_mb'] or 0:>8.1f} MB"
+        )
+    os.remove(result_path)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3, help="samples per case")
+    parser.add_argument(
+        "--queries", type=int, default=100, help="queries of per-query cases"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.0, help="fake LLM latency (s)"
+    )
+    parser.add_argument(
+        "--vector-stores", nargs="+", choices=["chroma", "numpy"], default=["chroma"]
+    )
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--vector-store", default="chroma", help=argparse.SUPPRESS)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.sizes[0], args, args.result)
+        return
+
+    results = []
+    for name in args.only or BENCHMARKS:
+        for size in args.sizes:
+            for vector_store in args.vector_stores:
+                results.append(run_subprocess(name, size, vector_store, args))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "repeat": args.repeat,
+            "queries": args.queries,
+            "llm_latency": args.llm_latency,
+            "vector_stores": args.vector_stores,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
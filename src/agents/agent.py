@@ -1,21 +1,30 @@
 import os
 import io
+import asyncio
+import contextvars
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import yaml
+import numpy as np
 
 sys.path.append("./src/")
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 
 from database.doc_processing import process
-from rag import Retriever, Generator, Router
+from database.registry import get_embedding_model
+from rag import Retriever, Generator, Router, HistoryManager
+from monitoring import span
+from monitoring.metrics import SPECULATIVE_RETRIEVALS
 
 
 class Agent:
     def __init__(self, config):
+        self.executor = ThreadPoolExecutor(thread_name_prefix="retrieval")
         self._initialize(config)
 
     def _initialize(self, config):
+        self.config = config
         self.file = os.path.join(config["agent"]["EXAMPLE_FOLDER"], config["agent"]["AGENT"])
         with open(self.file, "r", encoding="utf-8") as file:
             agent_config = yaml.safe_load(file)
@@ -28,35 +37,224 @@ class Agent:
         self.processing_function = process
 
         self.retriever = Retriever(self.collection_name, config)
-        self.generator = Generator(config, template=self.prompt_template)
+        history_config = config.get("history", {})
+        self.history_manager = HistoryManager(
+            get_embedding_model(config["processing"]["EMBEDDING_MODEL"]).count_tokens,
+            window_tokens=history_config.get("WINDOW_TOKENS", 1000),
+            summarize=history_config.get("SUMMARIZE", True),
+            summary_words=history_config.get("SUMMARY_WORDS", 150),
+            max_summaries=history_config.get("MAX_SUMMARIES", 1000),
+        )
+        self.generator = Generator(
+            config, template=self.prompt_template, history_manager=self.history_manager
+        )
         self.router = Router(template=self.router_template)
 
-    def update_collection(self, collection_name, config):
-        if collection_name != self.collection_name:
-            self.collection_name = collection_name
-            self.retriever = Retriever(collection_name, config)
-
     def update(self, config):
         self._initialize(config)
 
-    def predict(self, model, message, history=[], user_context=[]):
-        router_output = self.router.route_and_reformulate(model, message)
+    def speculate(self, message, token_limit=None, retriever=None):
+        """Retrieves context for the raw user message.
+
+        Returns:
+            tuple: The message embedding and the retrieved context.
+        """
+        retriever = retriever or self.retriever
+        with span("speculative_retrieval"):
+            embedding = retriever.embed(message)
+            context = retriever.retrieve(
+                query_embedding=embedding, token_limit=token_limit
+            )
+        return embedding, context
+
+    def retrieve_context(
+        self, message, new_query, speculated, token_limit, retriever=None
+    ):
+        """Retrieves context for the reformulated query of the router.
+
+        Args:
+            message (str): The user message.
+            new_query (str): The query reformulated by the router.
+            speculated (tuple, optional): The result of `speculate` on the
+                                          message, reused if the queries are
+                                          close enough.
+            token_limit (int, optional): Input token limit of the model.
+            retriever (Retriever, optional): Retriever of the collection to
+                                             search. Defaults to the
+                                             collection of the agent.
+
+        Returns:
+            list of str: The retrieved context.
+        """
+        retriever = retriever or self.retriever
+        if speculated is None:
+            return retriever.retrieve(new_query, token_limit=token_limit)
+
+        embedding, speculative_context = speculated
+        if new_query != message:
+            new_embedding = retriever.embed(new_query)
+            similarity = float(
+                np.dot(embedding, new_embedding)
+                / (np.linalg.norm(embedding) * np.linalg.norm(new_embedding))
+            )
+        else:
+            new_embedding, similarity = embedding, 1.0
+
+        threshold = self.config["retrieval"].get("SPECULATIVE_THRESHOLD", 0.9)
+        if similarity >= threshold:
+            SPECULATIVE_RETRIEVALS.inc(result="reused")
+            return speculative_context
+        SPECULATIVE_RETRIEVALS.inc(result="discarded")
+        return retriever.retrieve(
+            query_embedding=new_embedding, token_limit=token_limit
+        )
+
+    def _start_speculation(self, message, token_limit, retriever):
+        """Starts the retrieval on the raw message on the agent's executor, in
+        speculative mode.
+
+        Returns:
+            Future: The result of `speculate`, or None if not speculative.
+        """
+        if not self.config["retrieval"].get("SPECULATIVE", False):
+            return None
+        # Executor tasks run in a copy of the context, to keep the request
+        # trace of their spans
+        return self.executor.submit(
+            contextvars.copy_context().run,
+            self.speculate,
+            message,
+            token_limit,
+            retriever,
+        )
+
+    def _read_router_output(self, router_output, user_context):
+        """Records the router output.
+
+        Returns:
+            str: The reformulated query, or None if the message does not
+                 need context.
+        """
         print("=== Router Output ===\n", router_output, "\n")
+        user_context.append(router_output["user_information"])
+        if router_output["classification"] == "Context":
+            return router_output["new_query"]
+        return None
+
+    def _generation_input(self, message, history, user_context, router_output, context):
+        """Returns the retrieved context (empty if the message does not need
+        any), the extracted user information and the arguments of the
+        generator call, after the model."""
         user_information = router_output["user_information"]
-        user_context.append(user_information)
+        if context is None:
+            return [], user_information, (message, history)
+        return context, user_information, (message, history, context, user_context)
 
-        if router_output["classification"] == "Context":
-            context = self.retriever.retrieve(router_output["new_query"])
-            # for c in context:
-            #     print(f"\n{c}\n---------\n")
-            output = self.generator.predict(
-                model, message, history, context, user_context
+    def route(self, model, message, history, user_context, retriever=None):
+        """Classifies the message and retrieves context if it needs some.
+
+        In speculative mode, retrieval on the raw message runs while the
+        router is called. Its results are reused when the router asks for
+        context with a reformulated query close enough to the message, and
+        discarded otherwise.
+
+        Requests on other collections than the agent's pass their own
+        retriever, as the agent is shared by concurrent requests.
+
+        Returns:
+            tuple: The retrieved context, the extracted user information and
+                   the arguments of the generator call, after the model.
+        """
+        token_limit = getattr(model, "input_token_limit", None)
+        speculation = self._start_speculation(message, token_limit, retriever)
+
+        with span("router"):
+            router_output = self.router.route_and_reformulate(model, message)
+        new_query = self._read_router_output(router_output, user_context)
+
+        context = None
+        if new_query is not None:
+            speculated = speculation.result() if speculation is not None else None
+            with span("retrieval"):
+                context = self.retrieve_context(
+                    message, new_query, speculated, token_limit, retriever
+                )
+        return self._generation_input(
+            message, history, user_context, router_output, context
+        )
+
+    async def aroute(self, model, message, history, user_context, retriever=None):
+        """Async variant of `route`. The router call is awaited, while the
+        blocking retrieval work runs on the agent's executor."""
+        token_limit = getattr(model, "input_token_limit", None)
+        speculation = self._start_speculation(message, token_limit, retriever)
+
+        with span("router"):
+            router_output = await self.router.aroute_and_reformulate(model, message)
+        new_query = self._read_router_output(router_output, user_context)
+
+        context = None
+        if new_query is not None:
+            speculated = (
+                await asyncio.wrap_future(speculation)
+                if speculation is not None
+                else None
             )
-            # return self.filter_output(output, context)
+            with span("retrieval"):
+                context = await asyncio.get_running_loop().run_in_executor(
+                    self.executor,
+                    contextvars.copy_context().run,
+                    self.retrieve_context,
+                    message,
+                    new_query,
+                    speculated,
+                    token_limit,
+                    retriever,
+                )
+        return self._generation_input(
+            message, history, user_context, router_output, context
+        )
 
-        else:
-            context = []
-            output = self.generator.predict(model, message, history)
+    def predict(self, model, message, history=[], user_context=[], retriever=None):
+        context, user_information, generator_input = self.route(
+            model, message, history, user_context, retriever
+        )
+        output = self.generator.predict(model, *generator_input)
+
+        print("=== Generator Output ===\n", output, "\n")
+        return output, context, user_information
+
+    def predict_stream(
+        self, model, message, history=[], user_context=[], retriever=None
+    ):
+        """Routes and retrieves, then streams the answer.
+
+        Returns:
+            tuple: An iterator over the pieces of the answer, the retrieved
+                   context and the extracted user information.
+        """
+        context, user_information, generator_input = self.route(
+            model, message, history, user_context, retriever
+        )
+        tokens = self.generator.predict_stream(model, *generator_input)
+
+        def stream():
+            output = ""
+            for token in tokens:
+                output += token
+                yield token
+            print("=== Generator Output ===\n", output, "\n")
+
+        return stream(), context, user_information
+
+    async def apredict(
+        self, model, message, history=[], user_context=[], retriever=None
+    ):
+        """Async variant of `predict`."""
+        context, user_information, generator_input = await self.aroute(
+            model, message, history, user_context, retriever
+        )
+        output = await self.generator.apredict(model, *generator_input)
 
         print("=== Generator Output ===\n", output, "\n")
         return output, context, user_information
@@ -6,6 +6,7 @@ Usage:
 """
 
 import os
+import json
 import uuid
 import requests
 import streamlit as st
@@ -18,6 +19,15 @@ port = os.getenv("BACKEND_PORT", "8199")
 BASE_URL = f"http://127.0.0.1:{port}"
 
 
+def post(url, **kwargs):
+    """
+    Sends a POST request to the backend with a new `X-Request-ID` header, so
+    that the backend logs and metrics of the request can be traced back to it.
+    """
+    headers = {"X-Request-ID": uuid.uuid4().hex, **kwargs.pop("headers", {})}
+    return requests.post(url, headers=headers, **kwargs)
+
+
 class RAGApp:
     """
     A Streamlit application for interacting with an LLM (Language Model) that
@@ -48,7 +58,7 @@ class RAGApp:
         Returns:
             dict: The configuration dictionary.
         """
-        response = requests.post(f"{BASE_URL}/get-config/", timeout=10)
+        response = post(f"{BASE_URL}/get-config/", timeout=10)
         response_json = response.json()
         return response_json["config"]
 
@@ -63,6 +73,8 @@ class RAGApp:
             layout="wide",
             initial_sidebar_state="auto",
         )
+        if "ingestion_jobs" not in st.session_state:
+            st.session_state["ingestion_jobs"] = []
         self.setup_sidebar()
 
         if "messages" not in st.session_state:
@@ -89,7 +101,7 @@ class RAGApp:
         file upload, and file deletion functionalities.
         """
         with st.sidebar:
-            response = requests.post(
+            response = post(
                 f"{BASE_URL}/get-names/",
                 json={},
                 timeout=10,
@@ -125,7 +137,7 @@ class RAGApp:
                     step=1,
                 )
 
-                requests.post(
+                post(
                     f"{BASE_URL}/update-config/",
                     json={
                         "temperature": temperature,
@@ -144,7 +156,7 @@ class RAGApp:
             )
 
             if new_agent_name != self.agent_name:
-                requests.post(
+                post(
                     f"{BASE_URL}/update-agent/",
                     json={
                         "agent_name": new_agent_name,
@@ -167,7 +179,7 @@ class RAGApp:
                     "Enter the name for the new collection"
                 )
                 if new_collection_name:
-                    requests.post(
+                    post(
                         f"{BASE_URL}/create-collection/",
                         json={
                             "collection_name": new_collection_name,
@@ -182,7 +194,7 @@ class RAGApp:
 
             else:
                 if st.button("Delete collection"):
-                    requests.post(
+                    post(
                         f"{BASE_URL}/delete-collection/",
                         json={"files": [], "collection_name": self.collection_name},
                         timeout=100,
@@ -196,25 +208,39 @@ class RAGApp:
                     submitted = st.form_submit_button("Add files")
 
                 if submitted and uploaded_files is not None:
+                    threshold = self.base_config["upload"]["RESUMABLE_THRESHOLD_MB"]
+                    large_files = [
+                        file for file in uploaded_files if file.size > threshold * 2**20
+                    ]
                     files = [
                         ("files", (file.name, file.getvalue(), file.type))
                         for file in uploaded_files
+                        if file not in large_files
                     ]
-                    with st.spinner("Processing files..."):
+                    with st.spinner("Uploading files..."):
                         try:
-                            response = requests.post(
-                                f"{BASE_URL}/upload/",
-                                files=files,
-                                data={"collection_name": self.collection_name},
-                                timeout=1000,
-                            )
-                            response.raise_for_status()
-                            st.success("Files successfully added!")
+                            if files:
+                                response = post(
+                                    f"{BASE_URL}/upload/",
+                                    files=files,
+                                    data={"collection_name": self.collection_name},
+                                    timeout=1000,
+                                )
+                                response.raise_for_status()
+                                st.session_state["ingestion_jobs"].append(
+                                    response.json()["job_id"]
+                                )
+                            for file in large_files:
+                                st.session_state["ingestion_jobs"].append(
+                                    self.upload_resumable(file)
+                                )
                         except requests.exceptions.RequestException as e:
                             st.error(f"Failed to upload files: {e}")
 
+                self.show_ingestion_jobs()
+
                 st.header("Collection Files")
-                response = requests.post(
+                response = post(
                     f"{BASE_URL}/list-files/",
                     json={
                         "collection_name": self.collection_name,
@@ -222,14 +248,17 @@ class RAGApp:
                     timeout=10,
                 )
                 response_json = response.json()
+                files_stats = response_json.get("files_stats", {})
                 checked_files = [
                     file
                     for file in response_json["files_list"]
-                    if st.checkbox(file, key=file)
+                    if st.checkbox(
+                        file, key=file, help=self.file_summary(files_stats.get(file))
+                    )
                 ]
 
                 if st.button("Delete selected files"):
-                    requests.post(
+                    post(
                         f"{BASE_URL}/delete-files/",
                         json={
                             "files": checked_files,
@@ -239,20 +268,140 @@ class RAGApp:
                     )
                     st.rerun()
 
-    def generate_response(self, prompt_user):
+    def upload_resumable(self, file, retries=5):
         """
-        Generates a response to the user's input using the selected LLM.
+        Uploads a large file in parts, so that a dropped connection only
+        resends the part in flight: after a failure, the backend tells how
+        many bytes it received and the upload resumes from there.
+
+        Args:
+            file (UploadedFile): The file to upload.
+            retries (int): Number of consecutive failures before giving up.
+
+        Returns:
+            str: The ID of the ingestion job of the file.
+        """
+        response = post(
+            f"{BASE_URL}/upload/init/",
+            json={
+                "collection_name": self.collection_name,
+                "filename": file.name,
+                "size": file.size,
+            },
+            timeout=10,
+        )
+        response.raise_for_status()
+        session = response.json()
+        upload_id, received = session["upload_id"], session["received"]
+
+        failures = 0
+        while received < file.size:
+            file.seek(received)
+            part = file.read(session["part_size"])
+            try:
+                response = post(
+                    f"{BASE_URL}/upload/part/",
+                    files={"part": (file.name, part, file.type)},
+                    data={"upload_id": upload_id, "offset": received},
+                    timeout=100,
+                )
+                response.raise_for_status()
+                received, failures = response.json()["received"], 0
+            except requests.exceptions.RequestException:
+                failures += 1
+                if failures > retries:
+                    raise
+                response = post(
+                    f"{BASE_URL}/upload/status/",
+                    json={"upload_id": upload_id},
+                    timeout=10,
+                )
+                response.raise_for_status()
+                received = response.json()["received"]
+
+        response = post(
+            f"{BASE_URL}/upload/commit/", json={"upload_id": upload_id}, timeout=100
+        )
+        response.raise_for_status()
+        return response.json()["job_id"]
+
+    @st.fragment(run_every=2)
+    def show_ingestion_jobs(self):
+        """
+        Displays the progress of the background ingestion jobs started by
+        this session, and lets the user cancel them. Refreshed every two
+        seconds without blocking the rest of the app; the whole app is rerun
+        when a job finishes, to refresh the file list.
+        """
+        finished = False
+        for job_id in list(st.session_state["ingestion_jobs"]):
+            response = post(
+                f"{BASE_URL}/job-status/", json={"job_id": job_id}, timeout=10
+            )
+            if response.status_code != 200:
+                st.session_state["ingestion_jobs"].remove(job_id)
+                continue
+            job = response.json()
+
+            for file in job["files"]:
+                extracted = file["pages_extracted"] / max(file["pages_total"], 1)
+                embedded = file["chunks_embedded"] / max(file["chunks_total"], 1)
+                st.progress(
+                    min((extracted + embedded) / 2, 1.0),
+                    text=f"{file['filename']}: {file['status']} "
+                    f"({file['pages_extracted']}/{file['pages_total']} pages, "
+                    f"{file['chunks_embedded']}/{file['chunks_total']} chunks)",
+                )
+
+            if job["status"] in ["done", "failed", "cancelled"]:
+                st.session_state["ingestion_jobs"].remove(job_id)
+                for file in job["files"]:
+                    if file["status"] == "done":
+                        st.toast(f"{file['filename']} successfully added!")
+                    elif file["status"] == "failed":
+                        st.toast(
+                            f"Failed to process {file['filename']}: "
+                            f"{file['failures'][-1]}"
+                        )
+                finished = True
+            elif st.button("Cancel", key=f"cancel-{job_id}"):
+                post(
+                    f"{BASE_URL}/cancel-job/", json={"job_id": job_id}, timeout=10
+                )
+
+        if finished:
+            st.rerun()
+
+    def file_summary(self, stats):
+        """
+        Formats the manifest statistics of a file for display.
+        Args:
+            stats (dict or None): The file statistics returned by the backend.
+        Returns:
+            str or None: A short summary, or None if the file has no stats.
+        """
+        if not stats:
+            return None
+        return (
+            f"{stats['chunk_count']} chunks, "
+            f"pages {stats['first_page']}-{stats['last_page']}"
+        )
+
+    def stream_response(self, prompt_user):
+        """
+        Streams a response to the user's input using the selected LLM.
         Args:
             prompt_user (str): The user's input prompt.
         Returns:
-            tuple: A tuple containing the response text, retrieved context,
-                   and updated user context.
+            tuple: An iterator over the pieces of the response, and a
+                   dictionary filled with the retrieved context and updated
+                   user context once the iterator is exhausted.
         """
         history = st.session_state["messages"][:-1]
         user_context = st.session_state["user_context"]
 
-        response = requests.post(
-            f"{BASE_URL}/generate-response/",
+        response = post(
+            f"{BASE_URL}/generate-response-stream/",
             json={
                 "model_name": self.model_name,
                 "collection_name": self.collection_name,
@@ -260,19 +409,23 @@ class RAGApp:
                 "history": history,
                 "user_context": user_context,
             },
+            stream=True,
             timeout=1000,
         )
-        try:
-            response_json = response.json()
-        except ValueError:
-            st.error("Error processing the response from the server. Please check the backend logs.")
-            return "", [], []
+        response.raise_for_status()
+        final = {}
 
-        return (
-            response_json["output"],
-            response_json["context"],
-            response_json["user_context"],
-        )
+        def tokens():
+            for line in response.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                event = json.loads(line)
+                if "token" in event:
+                    yield event["token"]
+                else:
+                    final.update(event)
+
+        return tokens(), final
 
     def display_chat_history(self):
         """
@@ -280,7 +433,7 @@ class RAGApp:
         Initializes with an assistant message if no messages exist.
         """
         if not st.session_state["messages"]:
-            response = requests.post(
+            response = post(
                 f"{BASE_URL}/initial-message/",
                 timeout=10,
             )
@@ -307,15 +460,20 @@ class RAGApp:
             )
             st.chat_message("user").write(prompt_user)
 
-            with st.spinner("Thinking..."):
-                full_response, context, user_context = self.generate_response(
-                    prompt_user
-                )
+            with st.chat_message("assistant"):
+                try:
+                    with st.spinner("Thinking..."):
+                        tokens, final = self.stream_response(prompt_user)
+                    full_response = st.write_stream(tokens)
+                except (requests.exceptions.RequestException, ValueError):
+                    st.error("Error processing the response from the server. Please check the backend logs.")
+                    return
 
             if not full_response:
                 return
-            
-            st.chat_message("assistant").write(full_response)
+
+            context = final.get("context", [])
+            user_context = final.get("user_context", [])
             st.session_state["messages"].append(
                 {"role": "assistant", "content": full_response}
             )
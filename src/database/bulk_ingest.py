@@ -0,0 +1,316 @@
+"""Bulk ingestion of a directory tree of PDF files into a collection.
+
+Files are extracted and chunked by a pool of processes, one file per task,
+while the main process embeds and writes the chunks of the files already
+extracted, in batches of EMBEDDING_BATCH_SIZE. Each ingested file is recorded
+in a checkpoint file: an interrupted run started again skips the files
+already ingested, as long as they were not modified since.
+
+Files are added to the collection like uploaded files, under their path
+relative to the directory with separators replaced by "_". Run it while the
+server is stopped, as ChromaDB does not support writes from two processes.
+
+With MULTIMODAL_EXTRACTION, each worker calls Gemini through a scheduler of
+its own, so the RPM and TPM limits of the scheduler configuration are
+divided by the number of workers: together they stay within the limits.
+
+Usage:
+    python src/database/bulk_ingest.py archive/ --collection papers
+    python src/database/bulk_ingest.py archive/ --collection papers --workers 8
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+sys.path.append("./src/")
+
+from database.docstore import get_content_store, ingest_staged, staging_path
+from database.doc_processing import extract_file, file_hash, process
+from database.registry import get_collection
+
+CONFIG_PATH = "src/configs/config.yaml"
+
+
+def find_files(directory, extensions=(".pdf",)):
+    """Lists the files of a directory tree, in a stable order.
+
+    Args:
+        directory (str): Root of the tree.
+        extensions (tuple of str): Extensions of the listed files.
+
+    Returns:
+        list of tuple: The path of each file and its path relative to
+                       `directory`.
+    """
+    files = []
+    for root, folders, names in os.walk(directory):
+        folders.sort()
+        for name in sorted(names):
+            if name.lower().endswith(extensions):
+                path = os.path.join(root, name)
+                files.append((path, os.path.relpath(path, directory)))
+    return files
+
+
+class Checkpoint:
+    """Append-only record of the files ingested by bulk runs, as JSON lines.
+
+    A file is done while its size and modification time are those recorded.
+    Each line is flushed once its file is ingested, so an interruption loses
+    at most the file in flight.
+
+    Args:
+        path (str): Path of the checkpoint file, created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        complete = True
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    complete = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # line cut by an interruption
+                    self.entries[entry["file"]] = entry
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+        if not complete:
+            self.file.write("\n")
+
+    def is_done(self, relative_path, stat):
+        entry = self.entries.get(relative_path)
+        return entry is not None and (entry["size"], entry["mtime"]) == (
+            stat.st_size,
+            stat.st_mtime,
+        )
+
+    def record(self, relative_path, stat, **fields):
+        entry = {
+            "file": relative_path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            **fields,
+        }
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        self.entries[relative_path] = entry
+
+    def close(self):
+        self.file.close()
+
+
+def stage_file(filename, file_path, config):
+    """Stages a copy of a file for its ingestion, as an upload.
+
+    A content already in the content store is linked from there, other files
+    are copied.
+
+    Returns:
+        str: The staged path of the file.
+    """
+    staged_path = staging_path(config, filename)
+    if not get_content_store(config).link(file_hash(file_path), staged_path):
+        shutil.copyfile(file_path, staged_path)
+    return staged_path
+
+
+def share_rate_limits(workers):
+    """Divides the Gemini rate limits of a worker process between `workers`."""
+    from models.generation import scheduler
+
+    scheduler.share(workers)
+
+
+def iter_extracted(files, config, workers):
+    """Extracts and chunks files in a pool of processes, in order.
+
+    At most two files per worker are in flight, so memory does not grow with
+    the number of files.
+
+    Args:
+        files (list of tuple): Paths and relative paths of the files.
+        config (dict): Configuration dictionary for processing.
+        workers (int): Number of extraction processes. 1 extracts in the
+                       calling process.
+
+    Yields:
+        tuple: The path and relative path of each file, and the output of
+               `extract_file` or the exception it raised.
+    """
+    # Files are extracted in parallel, the pages of a file are not
+    config = {**config, "processing": {**config["processing"], "TEXT_WORKERS": 1}}
+
+    if workers <= 1:
+        for path, relative_path in files:
+            try:
+                yield path, relative_path, extract_file(path, config)
+            except Exception as e:
+                yield path, relative_path, e
+        return
+
+    # Spawned workers, as in the text extraction pool
+    context = multiprocessing.get_context("spawn")
+    initializer = None
+    if config["processing"]["MULTIMODAL_EXTRACTION"]:
+        initializer = share_rate_limits
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=initializer,
+        initargs=(workers,),
+    )
+    pending = deque()
+    files = iter(files)
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                file = next(files, None)
+                if file is None:
+                    break
+                pending.append((file, executor.submit(extract_file, file[0], config)))
+            if not pending:
+                break
+            (path, relative_path), future = pending.popleft()
+            try:
+                yield path, relative_path, future.result()
+            except Exception as e:
+                yield path, relative_path, e
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def bulk_ingest(directory, collection_name, config, workers=None, checkpoint=None):
+    """Ingests the PDF files of a directory tree into a collection.
+
+    Args:
+        directory (str): Root of the tree.
+        collection_name (str): Name of the collection, created if needed.
+        config (dict): Configuration dictionary.
+        workers (int, optional): Number of extraction processes, one per CPU
+                                 by default.
+        checkpoint (str, optional): Path of the checkpoint file. Defaults to
+                                    a file per collection in CHROMA_DATA_PATH.
+
+    Returns:
+        dict: Numbers of ingested, skipped and failed files, of pages and
+              chunks, and the duration of the run in seconds.
+    """
+    workers = workers or os.cpu_count() or 1
+    checkpoint = Checkpoint(
+        checkpoint
+        or os.path.join(
+            config["dataset"]["CHROMA_DATA_PATH"],
+            f"bulk_ingest_{collection_name}.jsonl",
+        )
+    )
+    collection = get_collection(collection_name, config)
+    upload_folder = os.path.join(
+        config["dataset"]["CHROMA_DATA_PATH"], "upload", collection_name
+    )
+
+    files = find_files(directory)
+    todo = [
+        (path, relative_path)
+        for path, relative_path in files
+        if not checkpoint.is_done(relative_path, os.stat(path))
+    ]
+    print(
+        f"Ingesting {len(todo)} files into {collection_name} with {workers} "
+        f"workers ({len(files) - len(todo)} already ingested)"
+    )
+
+    stats = {"ingested": 0, "skipped": len(files) - len(todo), "failed": 0}
+    stats.update(pages=0, chunks=0)
+    start = time.perf_counter()
+    try:
+        for index, (path, relative_path, extracted) in enumerate(
+            iter_extracted(todo, config, workers), start=1
+        ):
+            stat = os.stat(path)
+            try:
+                if isinstance(extracted, Exception):
+                    raise extracted
+                filename = relative_path.replace(os.sep, "_")
+                # The file already in the upload folder, if any, is only
+                # replaced once the new version is ingested
+                ingest_staged(
+                    stage_file(filename, path, config),
+                    os.path.join(upload_folder, filename),
+                    lambda staged_path: process(
+                        collection, staged_path, config, extracted=extracted
+                    ),
+                )
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"[{index}/{len(todo)}] Failed to ingest {relative_path}: {e}")
+                continue
+
+            pages, chunks = len(extracted[0]), len(extracted[1])
+            checkpoint.record(relative_path, stat, pages=pages, chunks=chunks)
+            stats["ingested"] += 1
+            stats["pages"] += pages
+            stats["chunks"] += chunks
+            print(
+                f"[{index}/{len(todo)}] {relative_path}: {pages} pages, "
+                f"{chunks} chunks"
+            )
+    finally:
+        checkpoint.close()
+        stats["seconds"] = time.perf_counter() - start
+        elapsed = max(stats["seconds"], 1e-9)
+        print(
+            f"Ingested {stats['ingested']} files ({stats['failed']} failed, "
+            f"{stats['skipped']} skipped) in {stats['seconds']:.1f}s: "
+            f"{stats['pages'] / elapsed:.1f} pages/s, "
+            f"{stats['chunks'] / elapsed:.1f} chunks/s"
+        )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory", help="root of the PDF files to ingest")
+    parser.add_argument("--collection", required=True, help="target collection")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="extraction processes (default: one per CPU); with multimodal "
+        "extraction, the Gemini rate limits are divided between them",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, help="chunks embedded and written per call"
+    )
+    parser.add_argument("--checkpoint", help="checkpoint file of the run")
+    parser.add_argument("--config", default=CONFIG_PATH)
+    args = parser.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as config_file:
+        config = yaml.safe_load(config_file)
+    if args.batch_size:
+        config["processing"]["EMBEDDING_BATCH_SIZE"] = args.batch_size
+
+    stats = bulk_ingest(
+        args.directory,
+        args.collection,
+        config,
+        workers=args.workers,
+        checkpoint=args.checkpoint,
+    )
+    sys.exit(1 if stats["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import sys
+from itertools import islice
+
+sys.path.append("./src/")
+
+from monitoring import span
+
+
+def token_len(chunk):
+    """Calculates the number of tokens (words) in a given chunk of text.
+
+    Args:
+        chunk (str): The text chunk.
+
+    Returns:
+        int: The number of tokens in the chunk.
+    """
+    return len(chunk.split())
+
+
+def iter_batches(items, size):
+    """Yields lists of at most `size` elements from any iterable."""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def overlap_tail(entries, overlap):
+    """Returns the last `overlap` tokens of a chunk, as entries.
+
+    Whole entries are kept while they fit, the entry crossing the limit is cut
+    to its last words. Only the end of the chunk is visited.
+
+    Args:
+        entries (list of tuple): (text, tokens, page) of each chunk entry.
+        overlap (int): Number of tokens to keep.
+
+    Returns:
+        list of tuple: The kept entries, in order.
+    """
+    tail, tokens = [], 0
+    for text, length, page in reversed(entries):
+        if tokens >= overlap:
+            break
+        if tokens + length > overlap:
+            words = text.split()[tokens - overlap :]
+            tail.append((" ".join(words), len(words), page))
+            break
+        tail.append((text, length, page))
+        tokens += length
+    return tail[::-1]
+
+
+def iter_entry_groups(pages, max_chunk_size, separator="\n", overlap=0):
+    """Groups the entries of a stream of pages into chunks.
+
+    Entries are the texts between two separators. Each entry is counted once
+    and the chunk size is kept as a running total, so chunking is linear in
+    the size of the document and only holds the current chunk in memory.
+
+    Args:
+        pages (iterable of str): Page texts, e.g. a generator over a PDF.
+        max_chunk_size (int): Maximum number of tokens of a chunk. An entry
+                              longer than that is a chunk of its own.
+        separator (str): Separator of the entries of a page.
+        overlap (int): Number of tokens from the end of a chunk repeated at
+                       the start of the next one.
+
+    Yields:
+        list of tuple: (text, tokens, page) of the entries of each chunk, with
+                       1-based page numbers.
+    """
+    entries, tokens = [], 0
+    for page, text in enumerate(pages, start=1):
+        # Groups completed on this page, yielded outside of the span so that
+        # the time spent by the consumer is not counted as chunking
+        completed = []
+        with span("chunk"):
+            for entry in text.split(separator):
+                entry = entry.replace("-\n", "")
+                length = token_len(entry)
+                if not tokens and not length:
+                    continue  # blank entries do not start a chunk
+                if tokens and tokens + length > max_chunk_size:
+                    completed.append(entries)
+                    entries = overlap_tail(entries, overlap) if overlap else []
+                    tokens = sum(kept[1] for kept in entries)
+                    if tokens + length > max_chunk_size:
+                        entries, tokens = [], 0
+                entries.append((entry, length, page))
+                tokens += length
+        yield from completed
+
+    if tokens:
+        yield entries
+
+
+def iter_chunks(pages, max_chunk_size, separator="\n", overlap=0):
+    """Streams the chunks of a document.
+
+    Args:
+        pages (iterable of str): Page texts.
+        max_chunk_size (int): Maximum number of tokens of a chunk.
+        separator (str): Separator of the entries of a page.
+        overlap (int): Number of tokens shared by consecutive chunks.
+
+    Yields:
+        tuple: The chunk text and the page where it starts.
+    """
+    for entries in iter_entry_groups(pages, max_chunk_size, separator, overlap):
+        yield "\n".join(entry[0] for entry in entries), entries[0][2]
+
+
+def iter_sub_chunks(
+    pages, max_chunk_size, sub_chunk_size, separator="\n", overlap=0
+):
+    """Streams the sub-chunks of a document, split from its chunks.
+
+    The sub-chunks of a chunk do not overlap: joined back, they give the
+    chunk text exactly.
+
+    Args:
+        pages (iterable of str): Page texts.
+        max_chunk_size (int): Maximum number of tokens of a (parent) chunk.
+        sub_chunk_size (int): Maximum number of tokens of a sub-chunk. A line
+                              longer than that is a sub-chunk of its own.
+        separator (str): Separator of the entries of a page.
+        overlap (int): Number of tokens shared by consecutive parent chunks.
+
+    Yields:
+        tuple: The sub-chunk text, the page where it starts and the index of
+               its parent chunk in the document.
+    """
+    groups = iter_entry_groups(pages, max_chunk_size, separator, overlap)
+    for parent, entries in enumerate(groups):
+        for sub_chunk, page in split_entries(entries, sub_chunk_size):
+            yield sub_chunk, page, parent
+
+
+def split_entries(entries, sub_chunk_size):
+    """Splits the lines of a chunk into sub-chunks.
+
+    Args:
+        entries (list of tuple): (text, tokens, page) of the chunk entries.
+        sub_chunk_size (int): Maximum number of tokens of a sub-chunk.
+
+    Yields:
+        tuple: The sub-chunk text and the page where it starts. Every
+               sub-chunk but the last ends with a newline.
+    """
+    parts, tokens, page = [], 0, None
+    for text, length, entry_page in entries:
+        for line in text.split("\n") if "\n" in text else [text]:
+            line_length = token_len(line) if line is not text else length
+            if parts and tokens + line_length > sub_chunk_size:
+                yield "\n".join(parts) + "\n", page
+                parts, tokens = [], 0
+            if not parts:
+                page = entry_page
+            parts.append(line)
+            tokens += line_length
+    if parts:
+        yield "\n".join(parts), page
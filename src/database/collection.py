@@ -1,48 +1,138 @@
-def group_sub_chunks(collection):
-    """Groups sub-chunks in a ChromaDB collection into complete chunks.
+import sys
+
+sys.path.append("./src/")
+
+from database.docstore import get_parent_store, get_sequence_allocator
+
+
+def get_parent_chunks(collection, indexes, config):
+    """Resolves the parent chunks of a list of chunk indexes.
+
+    Parent chunks are read from the parent chunk store in one batched lookup.
+    Chunks missing from the store (e.g. collections ingested before the store
+    existed) are rebuilt from their sub-chunks with a single ChromaDB call and
+    written back to the store.
 
     Args:
         collection: The ChromaDB collection object.
+        indexes (list of int): Chunk indexes to resolve.
+        config (dict): Configuration dictionary.
 
     Returns:
-        tuple: A tuple of grouped chunk documents and their metadata.
+        dict: Mapping chunk index -> (document, metadata).
     """
-    elements = collection.get()
-    chunks, indexes = [], []
-    metadatas = []
-
-    for i in range(len(elements["documents"])):
-        # If sub chunk:
-        if "chunk" in elements["metadatas"][i]:
-            chunk_index = elements["metadatas"][i]["chunk"]
-            if chunk_index not in indexes:
-                subchunks = collection.get(where={"chunk": chunk_index})["documents"]
-                chunks.append("".join(subchunks))
-                indexes.append(chunk_index)
-                metadatas.append(
-                    {k: v for k, v in elements["metadatas"][i].items() if k != "chunk"}
-                )
+    store = get_parent_store(config)
+    parents = store.get(collection.name, indexes)
+    missing = [index for index in dict.fromkeys(indexes) if index not in parents]
 
-        # If not a not sub chunk:
-        else:
-            chunks.append(elements["documents"][i])
-            metadatas.append(
-                {k: v for k, v in elements["metadatas"][i].items() if k != "chunk"}
+    if missing:
+        elements = collection.get(where={"chunk": {"$in": missing}})
+        subchunks, metadatas = {}, {}
+        for document, metadata in zip(elements["documents"], elements["metadatas"]):
+            subchunks.setdefault(metadata["chunk"], []).append(document)
+            metadatas.setdefault(
+                metadata["chunk"],
+                {k: v for k, v in metadata.items() if k != "chunk"},
             )
 
+        rebuilt = list(subchunks)
+        store.add(
+            collection.name,
+            rebuilt,
+            ["".join(subchunks[index]) for index in rebuilt],
+            [metadatas[index] for index in rebuilt],
+        )
+        for index in rebuilt:
+            parents[index] = ("".join(subchunks[index]), metadatas[index])
+
+    return parents
+
+
+def iter_grouped_chunks(collection, config, batch_size=1000):
+    """Streams the complete chunks of a ChromaDB collection.
+
+    The collection is read in pages of `batch_size` elements, so memory stays
+    bounded whatever the size of the collection. The sub-chunks of a parent
+    are not always contiguous, e.g. when files are ingested concurrently, so
+    those of a page are grouped by parent and each parent is emitted once, at
+    its first sub-chunk. Parent texts come from the parent chunk store in one
+    lookup per page, and are rebuilt from all their sub-chunks when missing
+    from the store.
+
+    Args:
+        collection: The ChromaDB collection object.
+        config (dict): Configuration dictionary.
+        batch_size (int): Number of elements read from ChromaDB at a time.
+
+    Yields:
+        tuple: A chunk document and its metadata.
+    """
+    emitted = set()
+    offset = 0
+
+    while True:
+        elements = collection.get(
+            limit=batch_size, offset=offset, include=["documents", "metadatas"]
+        )
+        if not elements["ids"]:
+            break
+        offset += len(elements["ids"])
+
+        # Parents first seen in this page, with the metadata of their first
+        # sub-chunk
+        new_parents = {}
+        for metadata in elements["metadatas"]:
+            index = metadata.get("chunk")
+            if index is not None and index not in emitted:
+                new_parents.setdefault(
+                    index, {k: v for k, v in metadata.items() if k != "chunk"}
+                )
+        parents = get_parent_chunks(collection, list(new_parents), config)
+
+        for document, metadata in zip(elements["documents"], elements["metadatas"]):
+            index = metadata.get("chunk")
+            if index is None:
+                yield document, metadata
+            elif index not in emitted:
+                emitted.add(index)
+                yield parents[index][0], new_parents[index]
+
+
+def group_sub_chunks(collection, config, batch_size=1000):
+    """Groups sub-chunks in a ChromaDB collection into complete chunks.
+
+    Args:
+        collection: The ChromaDB collection object.
+        config (dict): Configuration dictionary.
+        batch_size (int): Number of elements read from ChromaDB at a time.
+
+    Returns:
+        tuple: A tuple of grouped chunk documents and their metadata.
+    """
+    chunks, metadatas = [], []
+    for chunk, metadata in iter_grouped_chunks(collection, config, batch_size):
+        chunks.append(chunk)
+        metadatas.append(metadata)
+
     return chunks, metadatas
 
 
-def delete_collection(client, collection_name):
+def delete_collection(client, collection_name, config=None):
     """Deletes a specified collection from the ChromaDB client.
 
     Args:
         client: The ChromaDB client object.
         collection_name (str): The name of the collection to be deleted.
+        config (dict, optional): Configuration dictionary. When given, the
+                                 parent chunks and ID counters of the
+                                 collection are deleted as well.
     """
     collection = client.get_collection(collection_name)
     ids = collection.get()["ids"]
     if ids:
         collection.delete(ids)
     client.delete_collection(collection_name)
-    print(f"Collection succesfully deleted : {collection_name}")
\ No newline at end of file
+    if config is not None:
+        get_parent_store(config).delete(collection_name)
+        get_sequence_allocator(config).reset(collection_name)
+    print(f"Collection succesfully deleted : {collection_name}")
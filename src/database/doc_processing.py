@@ -1,74 +1,110 @@
 import os
 import sys
+import time
+import json
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # third-party imports
 from pdf2image import convert_from_path
-from PyPDF2 import PdfReader
 
 
 sys.path.append("./src/")
 
-from models.generation import GeminiFlash
+from models.generation import GeminiFlash, get_model
+from models.scheduler import INGESTION, llm_priority
+from database.docstore import (
+    get_content_store,
+    get_manifest,
+    get_parent_store,
+    get_sequence_allocator,
+)
+from database.registry import get_collection, get_embedding_model
+from database.pdf_text import get_text_backend, iter_page_texts
+from database.chunking import (
+    iter_batches,
+    iter_chunks,
+    iter_sub_chunks,
+    split_entries,
+    token_len,
+)
+from monitoring import span
 
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-
-def token_len(chunk):
-    """Calculates the number of tokens (words) in a given chunk of text.
+# Settings that change the chunks of a file, part of the page fingerprints
+FINGERPRINT_SETTINGS = [
+    "EMBEDDING_MODEL",
+    "MULTIMODAL_EXTRACTION",
+    "TEXT_BACKEND",
+    "INCREMENTAL",
+    "SUB_CHUNKING",
+    "MAX_CHUNK_SIZE",
+    "OVERLAP",
+    "SUB_CHUNK_SIZE",
+    "SEPARATOR",
+]
+# Chunks copied from another collection per ChromaDB call
+COPY_BATCH_SIZE = 1000
+
+
+def file_hash(file_path, block_size=1 << 20):
+    """Computes the SHA-256 hash of a file without loading it in memory.
 
     Args:
-        chunk (str): The text chunk.
+        file_path (str): Path to the file.
+        block_size (int): Number of bytes read at a time.
 
     Returns:
-        int: The number of tokens in the chunk.
+        str: The hexadecimal digest.
     """
-    return len(chunk.split())
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while block := file.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
 
+def chunking_parameters(config, separator=None):
+    """Reads the chunk sizes, overlap and separator of the configuration."""
+    processing = config["processing"]
+    return {
+        "max_chunk_size": processing["MAX_CHUNK_SIZE"],
+        "separator": separator or processing["SEPARATOR"],
+        "overlap": processing.get("OVERLAP", 0),
+    }
 
-def basic_chunking(texts, config):
+
+def basic_chunking(texts, config, separator=None):
     """Performs basic text chunking based on a separator and max chunk size.
 
     Args:
         texts (list): List of text strings to chunk.
         config (dict): Configuration dictionary with processing parameters.
+        separator (str, optional): Overrides the configured separator.
 
     Returns:
         tuple: A tuple containing:
             - list: A list of text chunks (str).
             - list: A list of labels, all "text" for basic chunking.
     """
-    separator = config["processing"]["SEPARATOR"]
-    max_chunk_size = config["processing"]["MAX_CHUNK_SIZE"]
-    chunks, current_chunk = [], ""
-
-    for text in texts:
-        entries = text.split(separator)
-        entries = [entry.replace("-\n", "") for entry in entries]
-
-        for entry in entries:
-            if not current_chunk:
-                current_chunk = entry
-                continue
-            if token_len(current_chunk + " " + entry) > max_chunk_size:
-                chunks.append(current_chunk)
-                current_chunk = entry
-            else:
-                current_chunk += "\n" + entry
-
-    if current_chunk:
-        chunks.append(current_chunk)
-
+    chunks = [
+        chunk
+        for chunk, _ in iter_chunks(texts, **chunking_parameters(config, separator))
+    ]
     return chunks, ["text" for _ in chunks]
 
 
-def sub_chunking(chunks, labels):
+def sub_chunking(chunks, labels, sub_chunk_size=64):
     """Splits each chunk into smaller sub-chunks.
 
     Args:
         chunks (list of str): List of input chunks.
         labels (list): Corresponding labels for the input chunks.
+        sub_chunk_size (int): Maximum number of tokens of a sub-chunk.
 
     Returns:
         tuple: A tuple containing:
@@ -76,65 +112,142 @@ def sub_chunking(chunks, labels):
             - list: Corresponding labels for each sub-chunk.
             - list: List of indexes indicating the parent chunk of each sub-chunk.
     """
-    max_token_length = 64
     sub_chunks, new_labels, chunk_indexes = [], [], []
-
     for chunk_index, (chunk, label) in enumerate(zip(chunks, labels)):
-        current_subchunk = ""
-
-        for part in chunk.split("\n"):
-            if token_len(current_subchunk + " " + part) > max_token_length:
-                if current_subchunk:  # Only add if it's non-empty
-                    sub_chunks.append(current_subchunk)
-                    new_labels.append(label)
-                    chunk_indexes.append(chunk_index)
-                current_subchunk = part + "\n"
-            else:
-                current_subchunk += part + "\n"
-
-        # Add the final subchunk if it exists
-        if current_subchunk:
-            sub_chunks.append(current_subchunk[:-1])
+        entries = [(chunk, token_len(chunk), None)]
+        for sub_chunk, _ in split_entries(entries, sub_chunk_size):
+            sub_chunks.append(sub_chunk)
             new_labels.append(label)
             chunk_indexes.append(chunk_index)
 
     return sub_chunks, new_labels, chunk_indexes
 
 
-def extract_text(input_path, config):
-    """Extracts text from a PDF and performs basic chunking.
+def extract_text(input_path, config, progress=None):
+    """Extracts the text of a PDF, page by page.
+
+    The text backend and the number of extraction processes come from the
+    TEXT_BACKEND and TEXT_WORKERS settings.
 
     Args:
         input_path (str): Path to the PDF file.
         config (dict): Configuration dictionary with processing parameters.
+        progress (FileProgress, optional): Progress tracker of the file.
+
+    Yields:
+        tuple: The page number and the text of each page, in order.
+    """
+    processing = config["processing"]
+    backend_name = processing.get("TEXT_BACKEND", "pdfium")
+    if progress:
+        page_count = get_text_backend(backend_name).page_count(input_path)
+        progress.update(pages_total=page_count)
+    pages = iter_page_texts(
+        input_path,
+        backend_name,
+        workers=processing.get("TEXT_WORKERS", 1),
+        pages_per_task=processing.get("TEXT_PAGES_PER_TASK", 50),
+    )
+    while True:
+        if progress:
+            progress.check_cancelled()
+        with span("extract"):
+            page = next(pages, None)
+        if page is None:
+            break
+        if progress:
+            progress.update(pages_extracted=1)
+        yield page
+
+
+def predict_page(model, query, page, retries=0, retry_delay=1.0, progress=None):
+    """Extracts the content of one page image, retrying on failure.
+
+    Args:
+        model: The multimodal extraction model (e.g., GeminiFlash).
+        query (str): The extraction prompt.
+        page: The page image.
+        retries (int): Number of retries before giving up on the page.
+        retry_delay (float): Delay before the first retry, in seconds. The
+                             delay doubles after each failed attempt.
+        progress (FileProgress, optional): Progress tracker of the file.
 
     Returns:
-        tuple: A tuple containing:
-            - list: A list of text chunks (str).
-            - list: A list of labels, all "text".
+        str: The extracted content.
     """
-    extracted_texts = []
-    reader = PdfReader(input_path)
-    for page in reader.pages:
-        extracted_texts.append(page.extract_text())
+    for attempt in range(retries + 1):
+        if progress:
+            progress.check_cancelled()
+        try:
+            output = model.predict_image(query, page, [])
+            if progress:
+                progress.update(pages_extracted=1)
+            return output
+        except Exception as e:
+            if progress:
+                progress.record_failure(f"Page extraction failed: {e}")
+            if attempt == retries:
+                raise
+            print(f"Page extraction failed ({e}), retrying ({attempt + 1}/{retries})")
+            time.sleep(retry_delay * 2**attempt)
+
+
+def extract_images(
+    model, query, pages, workers=1, retries=0, retry_delay=1.0, progress=None
+):
+    """Extracts the content of page images with bounded concurrency.
+
+    At most `workers` pages are sent to the model at the same time. Each page
+    is retried on its own, and results keep the order of the pages.
 
-    all_chunks, all_labels = basic_chunking(extracted_texts, config)
+    Args:
+        model: The multimodal extraction model (e.g., GeminiFlash).
+        query (str): The extraction prompt.
+        pages (list): The page images.
+        workers (int): Maximum number of in-flight page requests.
+        retries (int): Number of retries per page.
+        retry_delay (float): Delay before the first retry of a page, in seconds.
+        progress (FileProgress, optional): Progress tracker of the file.
 
-    return all_chunks, all_labels
+    Returns:
+        list: A list of extracted content strings, one per page.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Pages run in the caller's context, to keep its model call priority
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                predict_page,
+                model,
+                query,
+                page,
+                retries,
+                retry_delay,
+                progress,
+            )
+            for page in pages
+        ]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
 
-def extract_multimodal(model, input_path):
+def extract_multimodal(model, pages, workers=1, retries=0, progress=None):
     """Extracts multimodal content (text, tables, figures) from PDF pages.
 
     Args:
         model: The multimodal extraction model (e.g., GeminiFlash).
-        input_path (str): Path to the PDF file.
+        pages (list): The rendered page images.
+        workers (int): Maximum number of in-flight page requests.
+        retries (int): Number of retries per page.
+        progress (FileProgress, optional): Progress tracker of the file.
 
     Returns:
         list: A list of extracted content strings.
     """
-    pages = convert_from_path(input_path)
-    results = []
     query = """
     Extract text data from this image of a PDF page in Markdown format.
     Extract only the text, without saying anything else or giving any
@@ -158,71 +271,614 @@ def extract_multimodal(model, input_path):
     column, even if the table rows are implicit and not directly displayed.
     """
 
-    for page in pages:
-        results.append(model.predict_image(query, page, []))
+    # Page extraction yields to interactive chat requests under rate limits
+    with llm_priority(INGESTION), span("extract"):
+        return extract_images(
+            model, query, pages, workers=workers, retries=retries, progress=progress
+        )
 
-    return results
 
+def settings_digest(config):
+    """Digests the settings that change the chunks and embeddings of a file,
+    and where they are stored."""
+    processing = config["processing"]
+    settings = [processing.get(key) for key in FINGERPRINT_SETTINGS]
+    # Chunks of another vector store are not found, Chroma keeps the digests
+    # of the data ingested before the setting existed
+    vector_store = config["dataset"].get("VECTOR_STORE", "chroma")
+    if vector_store != "chroma":
+        settings.append(vector_store)
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
 
-def extract_chunks(input_path, config):
-    """Extracts and chunks content from a file based on configuration.
+
+def page_fingerprint(content, config):
+    """Fingerprints a page from its content and the ingestion settings.
+
+    A page keeps its fingerprint, and its chunks, as long as neither its
+    content nor the settings that shape its chunks change.
 
     Args:
-        input_path (str): Path to the input file.
+        content (str or bytes): Text layer or rendered image of the page.
         config (dict): Configuration dictionary for processing.
 
     Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256(settings_digest(config).encode("utf-8"))
+    digest.update(content if isinstance(content, bytes) else content.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def page_texts(pages, numbers):
+    """Yields the texts of numbered pages, appending their numbers to a list."""
+    for number, text in pages:
+        numbers.append(number)
+        yield text
+
+
+def chunk_pages(pages, config, separator=None):
+    """Chunks numbered pages according to the configuration.
+
+    With INCREMENTAL, chunks never span two pages, so that the chunks of a
+    page only depend on its content and can be replaced on their own.
+
+    Args:
+        pages (iterable of tuple): Page numbers and texts, in order.
+        config (dict): Configuration dictionary for processing.
+        separator (str, optional): Overrides the configured separator.
+
+    Yields:
+        tuple: The chunk text, its label, its page and the index of its
+               parent chunk in the file (None if not sub-chunking).
+    """
+    processing = config["processing"]
+    parameters = chunking_parameters(config, separator)
+    sub_chunking = processing["SUB_CHUNKING"]
+    if sub_chunking:
+        parameters["sub_chunk_size"] = processing.get("SUB_CHUNK_SIZE", 64)
+    if processing.get("INCREMENTAL", False):
+        groups = ([page] for page in pages)
+    else:
+        groups = [pages]
+
+    parents = 0
+    for group in groups:
+        # The chunkers number pages from 1 in the order they receive them
+        numbers = []
+        texts = page_texts(group, numbers)
+        if sub_chunking:
+            last_parent = -1
+            for chunk, page, parent in iter_sub_chunks(texts, **parameters):
+                yield chunk, "text", numbers[page - 1], parents + parent
+                last_parent = parent
+            parents += last_parent + 1
+        else:
+            for chunk, page in iter_chunks(texts, **parameters):
+                yield chunk, "text", numbers[page - 1], None
+
+
+def extract_chunks(input_path, config, progress=None, reuse_page=None):
+    """Extracts and chunks content from a file based on configuration.
+
+    Pages are chunked as they are extracted, so text-only files are never
+    held in memory as a whole.
+
+    Args:
+        input_path (str): Path to the input file.
+        config (dict): Configuration dictionary for processing.
+        progress (FileProgress, optional): Progress tracker of the file.
+        reuse_page (callable, optional): Called with the number and the
+                                         fingerprint of each page, returns
+                                         True if the chunks of the page are
+                                         already in the collection. These
+                                         pages are neither extracted by the
+                                         model nor chunked.
+
+    Yields:
         tuple: A tuple containing:
-            - list: List of extracted chunks.
-            - list: List of labels for each chunk.
-            - list or None: List of parent chunk indexes for sub-chunks,
-                            or None if not sub-chunking.
+            - str: The chunk text.
+            - str: The label of the chunk.
+            - int: The page where the chunk starts.
+            - int or None: The index of the parent chunk in the file for
+                           sub-chunks, or None if not sub-chunking.
     """
     print(f"Processing file {input_path}")
+    reuse_page = reuse_page or (lambda number, fingerprint: False)
     if config["processing"]["MULTIMODAL_EXTRACTION"]:
-        extraction_model = GeminiFlash(api_key=GOOGLE_API_KEY)
-        text_results = extract_multimodal(extraction_model, input_path)
-        config["processing"]["SEPARATOR"] = "|||"
-        chunks, labels = basic_chunking(text_results, config)
+        with span("render"):
+            images = convert_from_path(input_path)
+        if progress:
+            progress.update(pages_total=len(images))
+        numbers = []
+        for number, image in enumerate(images, start=1):
+            if not reuse_page(number, page_fingerprint(image.tobytes(), config)):
+                numbers.append(number)
+            elif progress:
+                progress.update(pages_extracted=1)
+        extraction_model = get_model(GeminiFlash, api_key=GOOGLE_API_KEY)
+        texts = extract_multimodal(
+            extraction_model,
+            [images[number - 1] for number in numbers],
+            workers=config["processing"].get("EXTRACTION_WORKERS", 1),
+            retries=config["processing"].get("EXTRACTION_RETRIES", 0),
+            progress=progress,
+        )
+        yield from chunk_pages(zip(numbers, texts), config, separator="|||")
 
     else:
-        chunks, labels = extract_text(input_path, config)
+        pages = (
+            (number, text)
+            for number, text in extract_text(input_path, config, progress=progress)
+            if not reuse_page(number, page_fingerprint(text, config))
+        )
+        yield from chunk_pages(pages, config)
+
 
-    if config["processing"]["SUB_CHUNKING"]:
-        chunks, labels, indexes = sub_chunking(chunks, labels)
+def next_sequence_values(collection):
+    """Computes the next free document ID and chunk index of a collection.
+
+    This scans the whole collection and is only used once per collection, to
+    seed the sequence allocator of collections that predate it.
+
+    Args:
+        collection: The ChromaDB collection object.
+
+    Returns:
+        dict: The next free value of the "id" and "chunk" sequences.
+    """
+    if collection.count() == 0:
+        return {"id": 0, "chunk": 0}
+
+    doc = collection.get(include=["metadatas"])
+    start_id = max([int(id[2:]) + 1 for id in doc["ids"]], default=0)
+    start_index = (
+        max([m["chunk"] for m in doc["metadatas"] if "chunk" in m], default=-1) + 1
+    )
+    return {"id": start_id, "chunk": start_index}
+
+
+def add_chunks(collection, filename, chunks, config, progress=None):
+    """Embeds and adds a stream of chunks to a collection.
+
+    Chunks are embedded and added in batches of EMBEDDING_BATCH_SIZE.
+    Document IDs and chunk indexes of each batch are reserved from the
+    collection's sequence allocator, so the cost of ingesting a file does not
+    depend on the size of the collection and concurrent uploads never
+    collide. When sub-chunking, the full parent chunks are also written to
+    the parent chunk store, as soon as they are complete, so that retrieval
+    can resolve them without re-joining sub-chunks.
+
+    If the ingestion fails or is cancelled between two batches, the chunks
+    and parent chunks already added are removed.
+
+    Args:
+        collection: The ChromaDB collection object.
+        filename (str): Name of the file the chunks come from.
+        chunks (iterable of tuple): Text, label, page and parent index of the
+                                    chunks, as yielded by `extract_chunks`.
+        config (dict): Configuration dictionary for processing.
+        progress (FileProgress, optional): Progress tracker of the file.
+
+    Returns:
+        list of tuple: The ID, page and parent chunk index (None if not
+                       sub-chunking) of each added chunk.
+    """
+    allocator = get_sequence_allocator(config)
+    parent_store = get_parent_store(config)
+    batch_size = config["processing"].get("EMBEDDING_BATCH_SIZE", 64)
+    # Embedded here rather than by ChromaDB, to time embedding and writing
+    embedding_function = get_embedding_model(
+        config["processing"]["EMBEDDING_MODEL"]
+    ).embedding_function
+
+    added, written = [], []
+    # Parent chunks not written yet, by index in the file: chunk index in the
+    # collection, metadata and sub-chunk texts
+    parents = {}
+
+    def write_parents(file_indexes):
+        if not file_indexes:
+            return
+        indexes = [parents[index][0] for index in file_indexes]
+        with span("write"):
+            parent_store.add(
+                collection.name,
+                indexes,
+                ["".join(parents[index][2]) for index in file_indexes],
+                [parents[index][1] for index in file_indexes],
+            )
+        written.extend(indexes)
+        for index in file_indexes:
+            del parents[index]
+
+    try:
+        for batch in iter_batches(chunks, batch_size):
+            if progress:
+                progress.check_cancelled()
+                progress.update(chunks_total=len(batch))
+            # Metadata of the parents starting in the batch, from their first
+            # sub-chunk
+            new_parents = {}
+            for _, label, page, parent in batch:
+                if parent is not None and parent not in parents:
+                    new_parents.setdefault(
+                        parent, {"from": filename, "type": label, "page": page}
+                    )
+            starts = allocator.allocate(
+                collection.name,
+                {"id": len(batch), "chunk": len(new_parents)},
+                seed=lambda: next_sequence_values(collection),
+            )
+            for offset, (parent, metadata) in enumerate(new_parents.items()):
+                parents[parent] = (starts["chunk"] + offset, metadata, [])
+
+            documents, metadatas, batch_added = [], [], []
+            for i, (chunk, label, page, parent) in enumerate(batch):
+                documents.append(chunk)
+                metadatas.append({"from": filename, "type": label, "page": page})
+                index = None
+                if parent is not None:
+                    index = parents[parent][0]
+                    metadatas[-1]["chunk"] = index
+                    parents[parent][2].append(chunk)
+                batch_added.append((f"id{starts['id'] + i}", page, index))
+            batch_ids = [id for id, _, _ in batch_added]
+
+            with span("embed"):
+                embeddings = embedding_function(documents)
+            with span("write"):
+                collection.add(
+                    documents=documents,
+                    embeddings=embeddings,
+                    ids=batch_ids,
+                    metadatas=metadatas,
+                )
+            added.extend(batch_added)
+            if progress:
+                progress.update(chunks_embedded=len(batch))
+
+            # Sub-chunks of a parent are contiguous: all but the last parent
+            # of the batch are complete
+            write_parents([index for index in parents if index != batch[-1][3]])
+        write_parents(list(parents))
+    except BaseException:
+        if added:
+            collection.delete(ids=[id for id, _, _ in added])
+        if written:
+            parent_store.delete(collection.name, indexes=written)
+        raise
+
+    return added
+
+
+def renumber_pages(collection, moved, config):
+    """Updates the page metadata of the chunks of pages that moved.
+
+    Args:
+        collection: The ChromaDB collection object.
+        moved (list of tuple): New page number and previous page record of
+                               each moved page.
+        config (dict): Configuration dictionary.
+    """
+    if not moved:
+        return
+    pages = {id: number for number, record in moved for id in record["ids"]}
+    if pages:
+        elements = collection.get(ids=list(pages), include=["metadatas"])
+        for id, metadata in zip(elements["ids"], elements["metadatas"]):
+            metadata["page"] = pages[id]
+        collection.update(ids=elements["ids"], metadatas=elements["metadatas"])
+
+    parent_store = get_parent_store(config)
+    pages = {index: number for number, record in moved for index in record["chunks"]}
+    parents = parent_store.get(collection.name, list(pages))
+    for index, (_, metadata) in parents.items():
+        metadata["page"] = pages[index]
+    parent_store.add(
+        collection.name,
+        list(parents),
+        [document for document, _ in parents.values()],
+        [metadata for _, metadata in parents.values()],
+    )
+
+
+def copy_chunks(source, source_file, collection, filename, config, progress=None):
+    """Copies the chunks of a file from another collection.
+
+    Documents, embeddings and metadata are copied as they are, under new IDs
+    and chunk indexes, together with the parent chunks: nothing is extracted
+    or embedded.
+
+    Args:
+        source: The ChromaDB collection holding the file.
+        source_file (str): Name of the file in the source collection.
+        collection: The ChromaDB collection to copy the chunks to.
+        filename (str): Name of the file in the target collection.
+        config (dict): Configuration dictionary.
+        progress (FileProgress, optional): Progress tracker of the file.
+
+    Returns:
+        tuple: The new chunk IDs and page records of the file.
+    """
+    manifest = get_manifest(config)
+    parent_store = get_parent_store(config)
+    record = manifest.get(source.name, [source_file])[source_file]
+    print(f"Copying {filename} from {source.name}/{source_file}")
+    if progress:
+        progress.update(pages_total=record["last_page"] or 0)
+        progress.update(chunks_total=len(record["ids"]))
+
+    elements = source.get(ids=record["ids"], include=["metadatas"])
+    source_ids = elements["ids"]
+    source_chunks = list(
+        dict.fromkeys(m["chunk"] for m in elements["metadatas"] if "chunk" in m)
+    )
+    starts = get_sequence_allocator(config).allocate(
+        collection.name,
+        {"id": len(source_ids), "chunk": len(source_chunks)},
+        seed=lambda: next_sequence_values(collection),
+    )
+    new_ids = {id: f"id{starts['id'] + i}" for i, id in enumerate(source_ids)}
+    new_chunks = {
+        index: starts["chunk"] + i for i, index in enumerate(source_chunks)
+    }
+
+    added, written = [], []
+    try:
+        for batch in iter_batches(source_ids, COPY_BATCH_SIZE):
+            if progress:
+                progress.check_cancelled()
+            elements = source.get(
+                ids=batch, include=["documents", "embeddings", "metadatas"]
+            )
+            for metadata in elements["metadatas"]:
+                metadata["from"] = filename
+                if "chunk" in metadata:
+                    metadata["chunk"] = new_chunks[metadata["chunk"]]
+            ids = [new_ids[id] for id in elements["ids"]]
+            with span("write"):
+                collection.add(
+                    ids=ids,
+                    documents=elements["documents"],
+                    embeddings=elements["embeddings"],
+                    metadatas=elements["metadatas"],
+                )
+            added.extend(ids)
+            if progress:
+                progress.update(chunks_embedded=len(ids))
+
+        for batch in iter_batches(source_chunks, COPY_BATCH_SIZE):
+            parents = parent_store.get(source.name, batch)
+            for _, metadata in parents.values():
+                metadata["from"] = filename
+            with span("write"):
+                parent_store.add(
+                    collection.name,
+                    [new_chunks[index] for index in parents],
+                    [document for document, _ in parents.values()],
+                    [metadata for _, metadata in parents.values()],
+                )
+            written.extend(new_chunks[index] for index in parents)
+    except BaseException:
+        if added:
+            collection.delete(ids=added)
+        if written:
+            parent_store.delete(collection.name, indexes=written)
+        raise
+
+    if progress:
+        progress.update(pages_extracted=record["last_page"] or 0)
+    pages = []
+    for page in manifest.get_pages(source.name, source_file):
+        page["ids"] = [new_ids[id] for id in page["ids"] if id in new_ids]
+        page["chunks"] = [
+            new_chunks[index] for index in page["chunks"] if index in new_chunks
+        ]
+        pages.append(page)
+    return [new_ids[id] for id in record["ids"] if id in new_ids], pages
+
+
+def ingest_pages(
+    collection, file_path, previous, config, progress=None, extracted=None
+):
+    """Extracts, chunks and embeds a file, or the modified pages of a file
+    already in the collection.
+
+    Args:
+        collection: The ChromaDB collection object.
+        file_path (str): Path to the file to process.
+        previous (dict or None): Manifest entry of the file, if known.
+        config (dict): Configuration dictionary for processing.
+        progress (FileProgress, optional): Progress tracker of the file.
+        extracted (tuple, optional): Page fingerprints and chunks of the
+                                     whole file, as returned by
+                                     `extract_file`, e.g. by another process.
+                                     The chunks of unchanged pages are
+                                     skipped instead of being extracted.
+
+    Returns:
+        tuple: The chunk IDs and page records of the file.
+    """
+    filename = os.path.basename(file_path)
+    manifest = get_manifest(config)
+    incremental = config["processing"].get("INCREMENTAL", False)
+    previous_pages = []
+    if previous and incremental:
+        previous_pages = manifest.get_pages(collection.name, filename)
+
+    # Previous page records not reused yet, by fingerprint
+    reusable = {}
+    for record in previous_pages:
+        reusable.setdefault(record["fingerprint"], []).append(record)
+    # New page records, by page number, and the reused previous records
+    pages, reused = {}, []
+
+    def reuse_page(number, fingerprint):
+        if reusable.get(fingerprint):
+            reused.append((number, reusable[fingerprint].pop(0)))
+            pages[number] = dict(reused[-1][1], page=number)
+            return True
+        pages[number] = {"page": number, "fingerprint": fingerprint}
+        pages[number].update(ids=[], chunks=[])
+        return False
+
+    if extracted is None:
+        chunks = extract_chunks(
+            file_path,
+            config,
+            progress=progress,
+            reuse_page=reuse_page if incremental else None,
+        )
     else:
-        indexes = None
+        fingerprints, chunks = extracted
+        if incremental:
+            skipped = {
+                number
+                for number, fingerprint in fingerprints
+                if reuse_page(number, fingerprint)
+            }
+            chunks = [chunk for chunk in chunks if chunk[2] not in skipped]
+    added = add_chunks(collection, filename, chunks, config, progress=progress)
+    for id, page, index in added:
+        if page in pages:
+            pages[page]["ids"].append(id)
+            if index is not None and index not in pages[page]["chunks"]:
+                pages[page]["chunks"].append(index)
+
+    if previous:
+        kept = {id for _, record in reused for id in record["ids"]}
+        stale_ids = [id for id in previous["ids"] if id not in kept]
+        if previous_pages:
+            stale_parents = [
+                index
+                for records in reusable.values()
+                for record in records
+                for index in record["chunks"]
+            ]
+        elif stale_ids:
+            metadatas = collection.get(ids=stale_ids, include=["metadatas"])
+            stale_parents = list(
+                {m["chunk"] for m in metadatas["metadatas"] if "chunk" in m}
+            )
+        else:
+            stale_parents = []
+        moved = [
+            (number, record) for number, record in reused if number != record["page"]
+        ]
+        if incremental:
+            print(
+                f"Re-ingested {filename}: {len(pages) - len(reused)} new or "
+                f"modified pages, {len(reused)} unchanged ({len(moved)} moved), "
+                f"{len(stale_ids)} chunks removed"
+            )
+        else:
+            print(f"Re-ingested {filename}: {len(stale_ids)} chunks replaced")
+        with span("write"):
+            if stale_ids:
+                collection.delete(ids=stale_ids)
+            if stale_parents:
+                get_parent_store(config).delete(collection.name, indexes=stale_parents)
+            renumber_pages(collection, moved, config)
+
+    records = [pages[number] for number in sorted(pages)]
+    if incremental:
+        return [id for record in records for id in record["ids"]], records
+    return [id for id, _, _ in added], records
+
+
+def extract_file(file_path, config):
+    """Extracts and chunks a whole file, without touching any store, so that
+    it can run in another process.
+
+    Args:
+        file_path (str): Path to the file.
+        config (dict): Configuration dictionary for processing.
 
-    return chunks, labels, indexes
+    Returns:
+        tuple: The page numbers and fingerprints of the file, and its chunks
+               as yielded by `extract_chunks`.
+    """
+    fingerprints = []
+
+    def record_page(number, fingerprint):
+        fingerprints.append((number, fingerprint))
+        return False
+
+    chunks = list(extract_chunks(file_path, config, reuse_page=record_page))
+    return fingerprints, chunks
 
 
-def process(collection, file_path, config):
+def process(collection, file_path, config, progress=None, extracted=None):
     """Processes a file by extracting chunks and adding them to a collection.
 
+    Chunks stream from the extraction into `add_chunks`, and the produced
+    chunk IDs are recorded in the file manifest.
+
+    A file already in the collection is re-ingested rather than added twice.
+    With INCREMENTAL, the fingerprint of each page is recorded, and on
+    re-ingestion only new or modified pages are extracted, chunked and
+    embedded: the chunks of removed pages are deleted and pages that only
+    moved get their page number updated. Files recorded without page
+    fingerprints are fully replaced. The previous chunks are only removed
+    once the new ones are added, so a failed re-ingestion leaves the file
+    as it was.
+
+    A file whose content is already in another collection (or under another
+    name), ingested with the same settings, is copied from there with its
+    embeddings. Contents are referenced in the content store.
+
     Args:
         collection: The ChromaDB collection object.
         file_path (str): Path to the file to process.
         config (dict): Configuration dictionary for processing.
+        progress (FileProgress, optional): Progress tracker of the file.
+        extracted (tuple, optional): The output of `extract_file` for the
+                                     file, when it was extracted beforehand.
     """
-    chunks, labels, indexes = extract_chunks(file_path, config)
+    if progress:
+        progress.check_cancelled()
 
     filename = os.path.basename(file_path)
-    doc = collection.get()
-    start_id = max([int(id[2:]) + 1 for id in doc["ids"]], default=0)
-
-    if indexes:
-        start_index = (
-            max([m["chunk"] for m in doc["metadatas"] if "chunk" in m], default=-1) + 1
-        )
-        metadatas = [
-            {"from": filename, "type": labels[j], "chunk": start_index + indexes[j]}
-            for j in range(len(labels))
+    manifest = get_manifest(config)
+    content_store = get_content_store(config)
+    content_hash = file_hash(file_path)
+    settings = settings_digest(config)
+    previous = manifest.get(collection.name, [filename]).get(filename)
+
+    sources = []
+    if previous is None:
+        sources = [
+            (source_name, source_file)
+            for source_name, source_file in content_store.find(
+                content_hash, settings, exclude=(collection.name, filename)
+            )
+            if manifest.get(source_name, [source_file])
         ]
+    if sources:
+        source_name, source_file = sources[0]
+        source = get_collection(source_name, config)
+        ids, records = copy_chunks(
+            source, source_file, collection, filename, config, progress=progress
+        )
     else:
-        metadatas = [{"from": filename, "type": labels[j]} for j in range(len(labels))]
+        ids, records = ingest_pages(
+            collection,
+            file_path,
+            previous,
+            config,
+            progress=progress,
+            extracted=extracted,
+        )
 
-    collection.add(
-        documents=chunks,
-        ids=[f"id{start_id + i}" for i in range(len(chunks))],
-        metadatas=metadatas,
-    )
\ No newline at end of file
+    text_backend = get_text_backend(config["processing"].get("TEXT_BACKEND", "pdfium"))
+    with span("write"):
+        manifest.replace(
+            collection.name,
+            filename,
+            ids,
+            first_page=1,
+            last_page=text_backend.page_count(file_path),
+            content_hash=content_hash,
+            pages=records,
+        )
+        content_store.add(collection.name, filename, file_path, content_hash, settings)
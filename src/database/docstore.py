@@ -0,0 +1,710 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+
+from storage import SQLiteStore, batched
+
+
+DOCSTORE_FILE = "docstore.sqlite3"
+CONTENT_FOLDER = "contents"
+STAGING_FOLDER = "staging"
+
+
+class ParentChunkStore(SQLiteStore):
+    """Stores the full parent chunk of every sub-chunked document.
+
+    Parent chunks are written once at ingestion time, keyed by collection and
+    chunk index, so that retrieval does not have to re-join sub-chunks from
+    ChromaDB on every query. Reads go through an in-process LRU cache.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        cache_size (int): Maximum number of parent chunks kept in memory.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS parent_chunks (
+        collection TEXT NOT NULL,
+        chunk INTEGER NOT NULL,
+        source TEXT,
+        document TEXT NOT NULL,
+        metadata TEXT NOT NULL,
+        PRIMARY KEY (collection, chunk)
+    );
+    CREATE INDEX IF NOT EXISTS parent_chunks_source
+        ON parent_chunks (collection, source);
+    """
+
+    def __init__(self, path, cache_size=1024):
+        super().__init__(path)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def _cache_put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def add(self, collection_name, indexes, documents, metadatas):
+        """Adds (or replaces) parent chunks of a collection.
+
+        Args:
+            collection_name (str): Name of the collection.
+            indexes (list of int): Chunk indexes of the parent chunks.
+            documents (list of str): Parent chunk texts.
+            metadatas (list of dict): Parent chunk metadata.
+        """
+        rows = [
+            (collection_name, index, meta.get("from"), document, json.dumps(meta))
+            for index, document, meta in zip(indexes, documents, metadatas)
+        ]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO parent_chunks VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.connection.commit()
+            for index in indexes:
+                self.cache.pop((collection_name, index), None)
+
+    def get(self, collection_name, indexes):
+        """Resolves parent chunks in one batched lookup.
+
+        Args:
+            collection_name (str): Name of the collection.
+            indexes (list of int): Chunk indexes to resolve.
+
+        Returns:
+            dict: Mapping chunk index -> (document, metadata) for every index
+                  found in the store. Missing indexes are left out.
+        """
+        found, missing = {}, []
+        with self.lock:
+            for index in dict.fromkeys(indexes):
+                key = (collection_name, index)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    found[index] = self.cache[key]
+                else:
+                    missing.append(index)
+
+            for batch in batched(missing):
+                rows = self.connection.execute(
+                    "SELECT chunk, document, metadata FROM parent_chunks "
+                    f"WHERE collection = ? AND chunk IN ({','.join('?' * len(batch))})",
+                    [collection_name, *batch],
+                ).fetchall()
+                for index, document, metadata in rows:
+                    found[index] = (document, json.loads(metadata))
+                    self._cache_put((collection_name, index), found[index])
+
+        return found
+
+    def delete(self, collection_name, sources=None, indexes=None):
+        """Deletes the parent chunks of a collection.
+
+        Args:
+            collection_name (str): Name of the collection.
+            sources (list of str, optional): Only delete chunks coming from
+                                             these files.
+            indexes (list of int, optional): Only delete these chunk indexes.
+                                             Deletes the whole collection if
+                                             neither filter is given.
+        """
+        with self.lock:
+            if sources is None and indexes is None:
+                self.connection.execute(
+                    "DELETE FROM parent_chunks WHERE collection = ?", (collection_name,)
+                )
+            elif sources is not None:
+                for batch in batched(list(sources)):
+                    self.connection.execute(
+                        "DELETE FROM parent_chunks WHERE collection = ? "
+                        f"AND source IN ({','.join('?' * len(batch))})",
+                        [collection_name, *batch],
+                    )
+            else:
+                for batch in batched(list(indexes)):
+                    self.connection.execute(
+                        "DELETE FROM parent_chunks WHERE collection = ? "
+                        f"AND chunk IN ({','.join('?' * len(batch))})",
+                        [collection_name, *batch],
+                    )
+            self.connection.commit()
+            self.cache = OrderedDict(
+                (key, value)
+                for key, value in self.cache.items()
+                if key[0] != collection_name
+            )
+
+
+class SequenceAllocator(SQLiteStore):
+    """Allocates document IDs and chunk indexes of each collection.
+
+    Allocation is a single transaction on a persistent counter, so ingestion
+    never scans the collection and concurrent uploads (threads or processes)
+    always receive disjoint ranges.
+
+    Args:
+        path (str): Path of the SQLite database file.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS sequences (
+        collection TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (collection, name)
+    );
+    """
+
+    def allocate(self, collection_name, counts, seed=None):
+        """Reserves consecutive values on one or several sequences.
+
+        Args:
+            collection_name (str): Name of the collection.
+            counts (dict): Mapping sequence name -> number of values to reserve.
+            seed (callable, optional): Returns the initial value of every
+                                       sequence of a collection that has no
+                                       counter yet (e.g. collections created
+                                       before the allocator existed).
+
+        Returns:
+            dict: Mapping sequence name -> first reserved value.
+        """
+        starts = {}
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT name, value FROM sequences WHERE collection = ?",
+                    (collection_name,),
+                ).fetchall()
+                values = dict(rows)
+                if any(name not in values for name in counts):
+                    initial = seed() if seed is not None else {}
+                    for name in counts:
+                        values.setdefault(name, initial.get(name, 0))
+
+                for name, count in counts.items():
+                    starts[name] = values[name]
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO sequences VALUES (?, ?, ?)",
+                        (collection_name, name, values[name] + count),
+                    )
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+        return starts
+
+    def reset(self, collection_name):
+        """Forgets the counters of a deleted collection."""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM sequences WHERE collection = ?", (collection_name,)
+            )
+            self.connection.commit()
+
+
+class FileManifest(SQLiteStore):
+    """Records which chunks each ingested file produced.
+
+    The manifest lets deletions target chunk IDs directly and lets the file
+    list be served without reading the ChromaDB collection. For files
+    ingested incrementally, it also records the fingerprint, chunk IDs and
+    parent chunk indexes of each page.
+
+    Args:
+        path (str): Path of the SQLite database file.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS files (
+        collection TEXT NOT NULL,
+        file TEXT NOT NULL,
+        ids TEXT NOT NULL,
+        first_page INTEGER,
+        last_page INTEGER,
+        content_hash TEXT,
+        chunk_count INTEGER NOT NULL,
+        added_at REAL NOT NULL,
+        PRIMARY KEY (collection, file)
+    );
+    CREATE TABLE IF NOT EXISTS file_pages (
+        collection TEXT NOT NULL,
+        file TEXT NOT NULL,
+        page INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL,
+        ids TEXT NOT NULL,
+        chunks TEXT NOT NULL,
+        PRIMARY KEY (collection, file, page)
+    );
+    """
+
+    columns = [
+        "file",
+        "ids",
+        "first_page",
+        "last_page",
+        "content_hash",
+        "chunk_count",
+        "added_at",
+    ]
+
+    def _record(self, row):
+        record = dict(zip(self.columns, row))
+        record["ids"] = json.loads(record["ids"])
+        return record
+
+    def add(self, collection_name, file, ids, first_page, last_page, content_hash):
+        """Records the chunks of an ingested file.
+
+        Chunks of a file that is already in the manifest are appended to its
+        existing entry.
+
+        Args:
+            collection_name (str): Name of the collection.
+            file (str): Name of the file.
+            ids (list of str): IDs of the chunks added to the collection.
+            first_page (int): First page of the file.
+            last_page (int): Last page of the file.
+            content_hash (str): SHA-256 of the file content.
+        """
+        with self.lock:
+            previous = self.get(collection_name, [file]).get(file)
+            if previous is not None:
+                ids = previous["ids"] + list(ids)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    collection_name,
+                    file,
+                    json.dumps(list(ids)),
+                    first_page,
+                    last_page,
+                    content_hash,
+                    len(ids),
+                    time.time(),
+                ),
+            )
+            self.connection.commit()
+
+    def replace(
+        self, collection_name, file, ids, first_page, last_page, content_hash, pages
+    ):
+        """Replaces the entry and the page records of a file in one transaction.
+
+        Args:
+            collection_name (str): Name of the collection.
+            file (str): Name of the file.
+            ids (list of str): IDs of all the chunks of the file.
+            first_page (int): First page of the file.
+            last_page (int): Last page of the file.
+            content_hash (str): SHA-256 of the file content.
+            pages (list of dict): Page records, with the "page" number, the
+                                  "fingerprint" of the page and the "ids" and
+                                  parent "chunks" indexes it produced. Empty
+                                  for files not ingested page by page.
+        """
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM file_pages WHERE collection = ? AND file = ?",
+                (collection_name, file),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    collection_name,
+                    file,
+                    json.dumps(list(ids)),
+                    first_page,
+                    last_page,
+                    content_hash,
+                    len(ids),
+                    time.time(),
+                ),
+            )
+            self.connection.executemany(
+                "INSERT INTO file_pages VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        collection_name,
+                        file,
+                        page["page"],
+                        page["fingerprint"],
+                        json.dumps(page["ids"]),
+                        json.dumps(page["chunks"]),
+                    )
+                    for page in pages
+                ],
+            )
+            self.connection.commit()
+
+    def get_pages(self, collection_name, file):
+        """Returns the page records of a file, ordered by page number.
+
+        Returns:
+            list of dict: The records given to `replace`. Empty for files not
+                          ingested page by page.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT page, fingerprint, ids, chunks FROM file_pages "
+                "WHERE collection = ? AND file = ? ORDER BY page",
+                (collection_name, file),
+            ).fetchall()
+        return [
+            {
+                "page": page,
+                "fingerprint": fingerprint,
+                "ids": json.loads(ids),
+                "chunks": json.loads(chunks),
+            }
+            for page, fingerprint, ids, chunks in rows
+        ]
+
+    def get(self, collection_name, files):
+        """Returns the manifest entries of some files of a collection.
+
+        Args:
+            collection_name (str): Name of the collection.
+            files (list of str): Names of the files.
+
+        Returns:
+            dict: Mapping file name -> manifest entry, for known files only.
+        """
+        records = {}
+        with self.lock:
+            for batch in batched(list(files)):
+                rows = self.connection.execute(
+                    f"SELECT {', '.join(self.columns)} FROM files "
+                    f"WHERE collection = ? AND file IN ({','.join('?' * len(batch))})",
+                    [collection_name, *batch],
+                ).fetchall()
+                for row in rows:
+                    records[row[0]] = self._record(row)
+        return records
+
+    def list(self, collection_name):
+        """Returns all manifest entries of a collection, ordered by file name."""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(self.columns)} FROM files "
+                "WHERE collection = ? ORDER BY file",
+                (collection_name,),
+            ).fetchall()
+        return [self._record(row) for row in rows]
+
+    def delete(self, collection_name, files=None):
+        """Deletes manifest entries of a collection.
+
+        Args:
+            collection_name (str): Name of the collection.
+            files (list of str, optional): Files to forget. Forgets the whole
+                                           collection if None.
+        """
+        with self.lock:
+            for table in ["files", "file_pages"]:
+                if files is None:
+                    self.connection.execute(
+                        f"DELETE FROM {table} WHERE collection = ?", (collection_name,)
+                    )
+                else:
+                    for batch in batched(list(files)):
+                        self.connection.execute(
+                            f"DELETE FROM {table} WHERE collection = ? "
+                            f"AND file IN ({','.join('?' * len(batch))})",
+                            [collection_name, *batch],
+                        )
+            self.connection.commit()
+
+
+def link_or_copy(source, destination):
+    """Places a hard link to `source` at `destination`, or a copy when the
+    file system does not support hard links. Replaces `destination`
+    atomically."""
+    temporary = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, temporary)
+    except OSError:
+        shutil.copyfile(source, temporary)
+    os.replace(temporary, destination)
+
+
+def staging_path(config, filename):
+    """Returns a new path where a file waits for its ingestion, outside of the
+    upload folders. The file keeps its name, which is the name it is ingested
+    under.
+
+    Args:
+        config (dict): Configuration dictionary.
+        filename (str): Name of the file.
+
+    Returns:
+        str: The path, in a folder of its own.
+    """
+    folder = os.path.join(
+        config["dataset"]["CHROMA_DATA_PATH"], STAGING_FOLDER, uuid.uuid4().hex
+    )
+    os.makedirs(folder)
+    return os.path.join(folder, filename)
+
+
+def discard_staged(staged_path):
+    """Removes a staged file and its folder."""
+    shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
+
+
+def ingest_staged(staged_path, destination, ingest):
+    """Ingests a staged file, then moves it to its place in an upload folder.
+
+    A file already at `destination`, e.g. the previous version of a
+    re-uploaded file, is only replaced once the ingestion succeeded: when it
+    fails or is cancelled, the file stays in place along with its chunks. The
+    staged file is removed either way.
+
+    Args:
+        staged_path (str): Path returned by `staging_path`.
+        destination (str): Path of the file in the upload folder.
+        ingest (callable): Ingests the file, called with `staged_path`.
+    """
+    try:
+        ingest(staged_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(staged_path, destination)
+    finally:
+        discard_staged(staged_path)
+
+
+class ContentStore(SQLiteStore):
+    """Content-addressed store of the ingested files, keyed by SHA-256.
+
+    Each file content is kept once in `folder`, whatever the number of
+    collections and names it was ingested under; the uploaded files are hard
+    links to it. References (collection, file name) are counted, and a
+    content is removed with its last reference.
+
+    References also record the ingestion settings, so they tell where the
+    chunks and embeddings of a content already are: a known file added to
+    another collection is copied from there instead of being extracted and
+    embedded again.
+
+    Args:
+        path (str): Path of the SQLite database file.
+        folder (str): Folder of the stored contents.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS contents (
+        hash TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refs INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS content_refs (
+        collection TEXT NOT NULL,
+        file TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        settings TEXT NOT NULL,
+        PRIMARY KEY (collection, file)
+    );
+    CREATE INDEX IF NOT EXISTS content_refs_hash ON content_refs (hash, settings);
+    """
+
+    def __init__(self, path, folder):
+        super().__init__(path)
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def content_path(self, content_hash):
+        return os.path.join(self.folder, content_hash)
+
+    def link(self, content_hash, destination):
+        """Places a stored content at `destination`.
+
+        Returns:
+            bool: False if the content is not stored.
+        """
+        with self.lock:
+            if not os.path.exists(self.content_path(content_hash)):
+                return False
+            link_or_copy(self.content_path(content_hash), destination)
+            return True
+
+    def add(self, collection_name, file, file_path, content_hash, settings):
+        """References a content from a file of a collection, storing the
+        content if it is new. Replaces the previous reference of the file.
+
+        Args:
+            collection_name (str): Name of the collection.
+            file (str): Name of the file.
+            file_path (str): Path of the file, with the content.
+            content_hash (str): SHA-256 of the content.
+            settings (str): Digest of the settings the file was ingested with.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT hash FROM content_refs WHERE collection = ? AND file = ?",
+                (collection_name, file),
+            ).fetchone()
+            if row is None or row[0] != content_hash:
+                if row is not None:
+                    self._release(row[0])
+                updated = self.connection.execute(
+                    "UPDATE contents SET refs = refs + 1 WHERE hash = ?",
+                    (content_hash,),
+                )
+                if updated.rowcount == 0:
+                    self.connection.execute(
+                        "INSERT INTO contents VALUES (?, ?, 1)",
+                        (content_hash, os.path.getsize(file_path)),
+                    )
+            if not os.path.exists(self.content_path(content_hash)):
+                link_or_copy(file_path, self.content_path(content_hash))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO content_refs VALUES (?, ?, ?, ?)",
+                (collection_name, file, content_hash, settings),
+            )
+            self.connection.commit()
+
+    def _release(self, content_hash):
+        self.connection.execute(
+            "UPDATE contents SET refs = refs - 1 WHERE hash = ?", (content_hash,)
+        )
+        row = self.connection.execute(
+            "SELECT refs FROM contents WHERE hash = ?", (content_hash,)
+        ).fetchone()
+        if row is not None and row[0] <= 0:
+            self.connection.execute(
+                "DELETE FROM contents WHERE hash = ?", (content_hash,)
+            )
+            if os.path.exists(self.content_path(content_hash)):
+                os.remove(self.content_path(content_hash))
+
+    def remove(self, collection_name, files=None):
+        """Drops the references of files of a collection. Contents left
+        without references are deleted.
+
+        Args:
+            collection_name (str): Name of the collection.
+            files (list of str, optional): Files to drop. Drops the whole
+                                           collection if None.
+        """
+        with self.lock:
+            if files is None:
+                rows = self.connection.execute(
+                    "SELECT file, hash FROM content_refs WHERE collection = ?",
+                    (collection_name,),
+                ).fetchall()
+            else:
+                rows = []
+                for batch in batched(list(files)):
+                    rows += self.connection.execute(
+                        "SELECT file, hash FROM content_refs WHERE collection = ? "
+                        f"AND file IN ({','.join('?' * len(batch))})",
+                        [collection_name, *batch],
+                    ).fetchall()
+            for file, content_hash in rows:
+                self.connection.execute(
+                    "DELETE FROM content_refs WHERE collection = ? AND file = ?",
+                    (collection_name, file),
+                )
+                self._release(content_hash)
+            self.connection.commit()
+
+    def find(self, content_hash, settings, exclude=None):
+        """Finds a file ingested with the same content and settings.
+
+        Args:
+            content_hash (str): SHA-256 of the content.
+            settings (str): Digest of the ingestion settings.
+            exclude (tuple, optional): (collection, file) to ignore.
+
+        Returns:
+            list of tuple: (collection, file) of the matching references.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT collection, file FROM content_refs "
+                "WHERE hash = ? AND settings = ? ORDER BY collection, file",
+                (content_hash, settings),
+            ).fetchall()
+        return [tuple(row) for row in rows if tuple(row) != exclude]
+
+    def refs(self, content_hash):
+        """Returns the reference count of a content (0 if unknown)."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT refs FROM contents WHERE hash = ?", (content_hash,)
+            ).fetchone()
+        return row[0] if row else 0
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _get_store(store_class, config, **kwargs):
+    path = os.path.join(config["dataset"]["CHROMA_DATA_PATH"], DOCSTORE_FILE)
+    with _stores_lock:
+        if (store_class, path) not in _stores:
+            _stores[(store_class, path)] = store_class(path, **kwargs)
+        return _stores[(store_class, path)]
+
+
+def get_parent_store(config):
+    """Returns the process-wide parent chunk store of a data path.
+
+    Args:
+        config (dict): Configuration dictionary.
+
+    Returns:
+        ParentChunkStore: The shared store.
+    """
+    return _get_store(
+        ParentChunkStore,
+        config,
+        cache_size=config["retrieval"].get("PARENT_CACHE_SIZE", 1024),
+    )
+
+
+def get_sequence_allocator(config):
+    """Returns the process-wide ID allocator of a data path.
+
+    Args:
+        config (dict): Configuration dictionary.
+
+    Returns:
+        SequenceAllocator: The shared allocator.
+    """
+    return _get_store(SequenceAllocator, config)
+
+
+def get_manifest(config):
+    """Returns the process-wide file manifest of a data path.
+
+    Args:
+        config (dict): Configuration dictionary.
+
+    Returns:
+        FileManifest: The shared manifest.
+    """
+    return _get_store(FileManifest, config)
+
+
+def get_content_store(config):
+    """Returns the process-wide content store of a data path.
+
+    Args:
+        config (dict): Configuration dictionary.
+
+    Returns:
+        ContentStore: The shared store.
+    """
+    folder = os.path.join(config["dataset"]["CHROMA_DATA_PATH"], CONTENT_FOLDER)
+    return _get_store(ContentStore, config, folder=folder)
@@ -1,13 +1,11 @@
 import sys
 import yaml
 import networkx as nx
-import chromadb
-from chromadb.config import DEFAULT_TENANT, DEFAULT_DATABASE, Settings
 from typing import Dict, Any
 
 sys.path.append("./src/")
 
-from models.embedding import Multilingual
+from database.registry import get_client, get_embedding_model
 
 with open("src/configs/config.yaml", "r", encoding="utf-8") as config_file:
     config = yaml.safe_load(config_file)
@@ -16,17 +14,14 @@ with open("src/configs/config.yaml", "r", encoding="utf-8") as config_file:
 class KnowledgeGraphRAG:
     def __init__(self, collection_name):
         # Initialize embedding model
-        self.embedding_model = Multilingual()
+        self.embedding_model = get_embedding_model(
+            config["processing"]["EMBEDDING_MODEL"]
+        )
 
         # Initialize graph
         self.graph = nx.DiGraph()
 
-        self.chroma_client = chromadb.PersistentClient(
-            path=config["dataset"]["CHROMA_DATA_PATH"],
-            settings=Settings(),
-            tenant=DEFAULT_TENANT,
-            database=DEFAULT_DATABASE,
-        )
+        self.chroma_client = get_client(config["dataset"]["CHROMA_DATA_PATH"])
 
         self.collection = self.chroma_client.get_or_create_collection(
             name=collection_name
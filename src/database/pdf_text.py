@@ -0,0 +1,127 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdfium2 as pdfium
+from PyPDF2 import PdfReader
+
+
+class PdfiumBackend:
+    """Extracts the text layer of PDF pages with pdfium (native code)."""
+
+    # pdfium is not thread-safe, calls of the threads of a process take turns
+    lock = threading.Lock()
+
+    def page_count(self, path):
+        with self.lock:
+            pdf = pdfium.PdfDocument(path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+
+    def extract_range(self, path, start, stop):
+        """Extracts the text of the pages [start, stop) (0-based)."""
+        texts = []
+        with self.lock:
+            pdf = pdfium.PdfDocument(path)
+            try:
+                for index in range(start, stop):
+                    page = pdf[index]
+                    textpage = page.get_textpage()
+                    texts.append(textpage.get_text_bounded().replace("\r\n", "\n"))
+                    textpage.close()
+                    page.close()
+            finally:
+                pdf.close()
+        return texts
+
+
+class PyPDF2Backend:
+    """Extracts the text layer of PDF pages with PyPDF2 (pure Python)."""
+
+    def page_count(self, path):
+        return len(PdfReader(path).pages)
+
+    def extract_range(self, path, start, stop):
+        """Extracts the text of the pages [start, stop) (0-based)."""
+        reader = PdfReader(path)
+        return [reader.pages[index].extract_text() for index in range(start, stop)]
+
+
+TEXT_BACKENDS = {"pdfium": PdfiumBackend, "PyPDF2": PyPDF2Backend}
+
+
+def get_text_backend(name):
+    """Returns the text extraction backend of the given name.
+
+    Args:
+        name (str): One of the keys of TEXT_BACKENDS.
+    """
+    if name not in TEXT_BACKENDS:
+        raise ValueError(
+            f"Unknown text backend {name}, expected one of {list(TEXT_BACKENDS)}"
+        )
+    return TEXT_BACKENDS[name]()
+
+
+def extract_range(backend_name, path, start, stop):
+    """Extracts a page range in a worker process."""
+    return get_text_backend(backend_name).extract_range(path, start, stop)
+
+
+def iter_page_ranges(page_count, pages_per_task):
+    for start in range(0, page_count, pages_per_task):
+        yield start, min(start + pages_per_task, page_count)
+
+
+def iter_page_texts(path, backend_name="pdfium", workers=1, pages_per_task=50):
+    """Extracts the text of the pages of a PDF, in order.
+
+    Large PDFs are split into ranges of `pages_per_task` pages, extracted by a
+    pool of `workers` processes: pdfium is not thread-safe and PyPDF2 holds
+    the GIL, so processes are the only way to use several cores. At most two
+    ranges per worker are in flight, so memory does not grow with the size of
+    the PDF.
+
+    Args:
+        path (str): Path to the PDF file.
+        backend_name (str): Name of the text extraction backend.
+        workers (int): Number of extraction processes, at most one per CPU.
+                       1 extracts in the calling thread.
+        pages_per_task (int): Number of pages of each range.
+
+    Yields:
+        tuple: The 1-based page number and the text of each page.
+    """
+    backend = get_text_backend(backend_name)
+    page_count = backend.page_count(path)
+    ranges = iter_page_ranges(page_count, pages_per_task)
+    workers = min(workers, os.cpu_count() or 1)
+
+    if workers <= 1 or page_count <= pages_per_task:
+        for start, stop in ranges:
+            texts = backend.extract_range(path, start, stop)
+            yield from enumerate(texts, start=start + 1)
+        return
+
+    # Spawned workers, as forking a multi-threaded server is unsafe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending = deque()
+        try:
+            for start, stop in ranges:
+                arguments = (backend_name, path, start, stop)
+                pending.append((start, executor.submit(extract_range, *arguments)))
+                if len(pending) < 2 * workers:
+                    continue
+                start, future = pending.popleft()
+                yield from enumerate(future.result(), start=start + 1)
+            while pending:
+                start, future = pending.popleft()
+                yield from enumerate(future.result(), start=start + 1)
+        finally:
+            for _, future in pending:
+                future.cancel()
@@ -0,0 +1,57 @@
+import threading
+
+
+class IngestionCancelled(Exception):
+    """Raised inside the ingestion of a file when its job is cancelled."""
+
+
+class FileProgress:
+    """Tracks the ingestion progress of one file.
+
+    The counters are updated by the ingestion functions, possibly from
+    several extraction threads at once, and read by the job status endpoint.
+
+    Args:
+        filename (str): Name of the file being ingested.
+        cancel_event (threading.Event, optional): Set when the ingestion must
+                                                  stop.
+    """
+
+    def __init__(self, filename, cancel_event=None):
+        self.filename = filename
+        self.cancel_event = cancel_event or threading.Event()
+        self.lock = threading.Lock()
+        self.status = "queued"
+        self.pages_total = 0
+        self.pages_extracted = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.failures = []
+
+    def update(self, **increments):
+        """Increments counters, e.g. `update(pages_extracted=1)`."""
+        with self.lock:
+            for key, value in increments.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def record_failure(self, message):
+        """Records a (possibly retried) failure."""
+        with self.lock:
+            self.failures.append(message)
+
+    def check_cancelled(self):
+        """Raises IngestionCancelled if the ingestion has been cancelled."""
+        if self.cancel_event.is_set():
+            raise IngestionCancelled(f"Ingestion of {self.filename} cancelled")
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "filename": self.filename,
+                "status": self.status,
+                "pages_total": self.pages_total,
+                "pages_extracted": self.pages_extracted,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "failures": list(self.failures),
+            }
@@ -0,0 +1,127 @@
+import os
+import shutil
+import threading
+
+import chromadb
+
+from models.embedding import get_model
+from database.vector_store import VECTOR_FOLDER, ChromaVectorStore, NumpyVectorStore
+
+
+_embedding_models = {}
+_clients = {}
+_vector_stores = {}
+_lock = threading.Lock()
+
+
+def get_embedding_model(name):
+    """Returns the process-wide embedding model of a given name.
+
+    The model is loaded on first use and then shared by the server, the
+    retriever, the ingestion and the knowledge graph.
+
+    Args:
+        name (str): Name of the embedding model, e.g. "Multilingual".
+
+    Returns:
+        EmbeddingModel: The shared embedding model.
+    """
+    with _lock:
+        if name not in _embedding_models:
+            _embedding_models[name] = get_model(name)
+        return _embedding_models[name]
+
+
+def register_embedding_model(name, model):
+    """Registers the embedding model to share under a given name.
+
+    Used to substitute a model, e.g. a local one in benchmarks, before the
+    first call to `get_embedding_model`.
+
+    Args:
+        name (str): Name of the embedding model.
+        model (EmbeddingModel): The model instance.
+    """
+    with _lock:
+        _embedding_models[name] = model
+
+
+def get_client(data_path):
+    """Returns the process-wide ChromaDB client of a data path.
+
+    Args:
+        data_path (str): Path of the ChromaDB data folder.
+
+    Returns:
+        chromadb.ClientAPI: The shared persistent client.
+    """
+    with _lock:
+        if data_path not in _clients:
+            _clients[data_path] = chromadb.PersistentClient(path=data_path)
+        return _clients[data_path]
+
+
+def get_collection(collection_name, config):
+    """Gets or creates the vector store of a collection, with the configured
+    backend (VECTOR_STORE) and embedding model.
+
+    NumPy stores keep the rows of the collection in memory, so there is one
+    instance per collection and process.
+
+    Args:
+        collection_name (str): Name of the collection.
+        config (dict): Configuration dictionary.
+
+    Returns:
+        VectorStore: The collection.
+    """
+    data_path = config["dataset"]["CHROMA_DATA_PATH"]
+    backend = config["dataset"].get("VECTOR_STORE", "chroma")
+    embedding_model = get_embedding_model(config["processing"]["EMBEDDING_MODEL"])
+
+    if backend == "chroma":
+        client = get_client(data_path)
+        return ChromaVectorStore(
+            client.get_or_create_collection(
+                name=collection_name,
+                embedding_function=embedding_model.embedding_function,
+                metadata={"hnsw:space": config["retrieval"]["SIMILARITY"]},
+            )
+        )
+
+    if backend == "numpy":
+        if collection_name in ["", ".", ".."] or os.sep in collection_name:
+            raise ValueError(f"Invalid collection name: {collection_name}")
+        folder = os.path.join(data_path, VECTOR_FOLDER, collection_name)
+        with _lock:
+            if folder not in _vector_stores:
+                _vector_stores[folder] = NumpyVectorStore(
+                    folder,
+                    collection_name,
+                    embedding_function=embedding_model.embedding_function,
+                    dtype=config["dataset"].get("VECTOR_DTYPE", "float32"),
+                    space=config["retrieval"]["SIMILARITY"],
+                )
+            return _vector_stores[folder]
+
+    raise ValueError(f"Unknown vector store {backend}, expected chroma or numpy")
+
+
+def drop_collection(collection_name, config):
+    """Deletes the vector store of a collection.
+
+    Args:
+        collection_name (str): Name of the collection.
+        config (dict): Configuration dictionary.
+    """
+    data_path = config["dataset"]["CHROMA_DATA_PATH"]
+    if config["dataset"].get("VECTOR_STORE", "chroma") == "chroma":
+        get_client(data_path).delete_collection(collection_name)
+        return
+
+    folder = os.path.join(data_path, VECTOR_FOLDER, collection_name)
+    with _lock:
+        store = _vector_stores.pop(folder, None)
+        if store is not None:
+            store.close()
+        shutil.rmtree(folder, ignore_errors=True)
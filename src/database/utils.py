@@ -6,7 +6,8 @@ from dotenv import load_dotenv
 
 sys.path.append("./src/")
 
-from models.generation import GeminiFlash
+from models.generation import GeminiFlash, get_model
+from models.scheduler import INGESTION, llm_priority
 
 
 load_dotenv()
@@ -14,9 +15,12 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 
 def entity_extraction(input, template):
-    model = GeminiFlash(api_key=GOOGLE_API_KEY, response_format="application/json")
+    model = get_model(
+        GeminiFlash, api_key=GOOGLE_API_KEY, response_format="application/json"
+    )
     prompt_input = template(input)
-    output = json.loads(model.predict(prompt_input))
+    with llm_priority(INGESTION):
+        output = json.loads(model.predict(prompt_input))
 
     for key in output:
         if output[key] is None:
@@ -0,0 +1,585 @@
+import os
+import abc
+import json
+import glob
+import uuid
+
+import numpy as np
+
+from storage import SQLiteStore, batched
+
+VECTOR_FOLDER = "vectors"
+# Scores (queries x rows) and converted embeddings computed at a time, in
+# float32 elements, so a query never allocates more than about 64 MB
+BLOCK_ELEMENTS = 1 << 24
+# Metadata fields of the chunks that can be filtered on, and their column
+WHERE_COLUMNS = {"from": "source", "chunk": "chunk"}
+WHERE_OPERATORS = {
+    "$eq": "=",
+    "$ne": "!=",
+    "$gt": ">",
+    "$gte": ">=",
+    "$lt": "<",
+    "$lte": "<=",
+}
+
+
+class VectorStore(abc.ABC):
+    """Main class for the vector stores of the collections.
+
+    The interface is the subset of the ChromaDB collection API used by the
+    ingestion and the retrieval: arguments and results have the same names
+    and shapes, and `where` filters the same syntax.
+    Args:
+    - name (str): name of the collection
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    @abc.abstractmethod
+    def count(self):
+        """Returns the number of elements of the collection."""
+
+    @abc.abstractmethod
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        """Adds elements, embedded with the collection embedding function when
+        `embeddings` is None."""
+
+    @abc.abstractmethod
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+        """Returns elements by ID and/or filter, in insertion order."""
+
+    @abc.abstractmethod
+    def query(
+        self,
+        query_embeddings=None,
+        query_texts=None,
+        n_results=10,
+        where=None,
+        include=None,
+    ):
+        """Returns the nearest elements of each query, closest first."""
+
+    @abc.abstractmethod
+    def update(self, ids, embeddings=None, metadatas=None, documents=None):
+        """Replaces the given fields of existing elements."""
+
+    @abc.abstractmethod
+    def delete(self, ids=None, where=None):
+        """Deletes elements by ID and/or filter."""
+
+
+class ChromaVectorStore(VectorStore):
+    """Vector store backed by a ChromaDB collection (HNSW index).
+
+    Args:
+        collection (chromadb.Collection): The ChromaDB collection.
+    """
+
+    def __init__(self, collection):
+        super().__init__(collection.name)
+        self.collection = collection
+
+    def count(self):
+        return self.collection.count()
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        self.collection.add(
+            ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+        )
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+        return self.collection.get(
+            ids=ids,
+            where=where,
+            limit=limit,
+            offset=offset,
+            include=include or ["metadatas", "documents"],
+        )
+
+    def query(
+        self,
+        query_embeddings=None,
+        query_texts=None,
+        n_results=10,
+        where=None,
+        include=None,
+    ):
+        return self.collection.query(
+            query_embeddings=query_embeddings,
+            query_texts=query_texts,
+            n_results=n_results,
+            where=where,
+            include=include or ["metadatas", "documents", "distances"],
+        )
+
+    def update(self, ids, embeddings=None, metadatas=None, documents=None):
+        self.collection.update(
+            ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+        )
+
+    def delete(self, ids=None, where=None):
+        self.collection.delete(ids=ids, where=where)
+
+
+def where_clause(where):
+    """Translates a ChromaDB `where` filter on "from" and "chunk" to SQL.
+
+    Supports equality and comparison operators, "$in", "$nin" and "$and".
+
+    Args:
+        where (dict): The filter, e.g. {"chunk": {"$in": [1, 2]}}.
+
+    Returns:
+        tuple: The SQL condition and its parameters.
+    """
+    if list(where) == ["$and"]:
+        conditions = [where_clause(condition) for condition in where["$and"]]
+    elif len(where) > 1:
+        conditions = [where_clause({key: value}) for key, value in where.items()]
+    else:
+        conditions = None
+    if conditions is not None:
+        sql = " AND ".join(f"({condition})" for condition, _ in conditions)
+        return sql or "1", [value for _, values in conditions for value in values]
+
+    [(key, condition)] = where.items()
+    if key not in WHERE_COLUMNS:
+        raise ValueError(
+            f"Unsupported filter on {key}, expected one of {list(WHERE_COLUMNS)}"
+        )
+    column = WHERE_COLUMNS[key]
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    [(operator, value)] = condition.items()
+    if operator in ["$in", "$nin"]:
+        if not value:
+            return ("0" if operator == "$in" else "1"), []
+        negation = "NOT " if operator == "$nin" else ""
+        placeholders = ", ".join("?" * len(value))
+        return f"{column} {negation}IN ({placeholders})", list(value)
+    if operator not in WHERE_OPERATORS:
+        raise ValueError(f"Unsupported filter operator {operator}")
+    return f"{column} {WHERE_OPERATORS[operator]} ?", [value]
+
+
+def normalize(vectors):
+    """Scales vectors to unit norm, leaving null vectors as they are."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def top_k(queries, embeddings, k, rows=None, live=None):
+    """Exact nearest neighbours by inner product.
+
+    Embeddings are scored by blocks of rows, each with one matrix product
+    whose k best scores are selected with `argpartition` and merged with
+    those of the previous blocks; collections of up to BLOCK_ELEMENTS /
+    queries rows are a single block.
+
+    Args:
+        queries (np.ndarray): Normalized queries, (queries, dimension).
+        embeddings (np.ndarray): Normalized embeddings, e.g. a memory map.
+        k (int): Number of neighbours of each query.
+        rows (np.ndarray, optional): Rows of the candidate embeddings. All
+                                     rows of `embeddings` by default.
+        live (np.ndarray, optional): Mask of the rows to consider, when
+                                     `rows` is None.
+
+    Returns:
+        tuple: The scores and rows of the neighbours of each query, best
+               first; rows are -1 where there are fewer than k candidates.
+    """
+    count = len(embeddings) if rows is None else len(rows)
+    block = BLOCK_ELEMENTS // max(len(queries), 1)
+    if rows is not None or embeddings.dtype != np.float32:
+        # Gathered or converted copies of the block are bounded as well
+        block = min(block, BLOCK_ELEMENTS // embeddings.shape[1])
+    block = max(block, 1)
+    if live is not None and (rows is not None or live.all()):
+        live = None
+
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, count, block):
+        stop = min(start + block, count)
+        if rows is None:
+            vectors = embeddings[start:stop]
+        else:
+            vectors = embeddings[rows[start:stop]]
+        scores = queries @ vectors.astype(np.float32, copy=False).T
+        if live is not None:
+            scores[:, ~live[start:stop]] = -np.inf
+        if scores.shape[1] > k:
+            kept = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, kept, axis=1)
+        else:
+            kept = np.broadcast_to(np.arange(stop - start), scores.shape)
+        kept = kept + start if rows is None else rows[kept + start]
+
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best_rows = np.concatenate([best_rows, kept], axis=1)
+        if best_scores.shape[1] > k:
+            kept = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(best_scores, kept, axis=1)
+            best_rows = np.take_along_axis(best_rows, kept, axis=1)
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_rows = np.take_along_axis(best_rows, order, axis=1)
+    best_rows[np.isneginf(best_scores)] = -1
+    return best_scores, best_rows
+
+
+class NumpyVectorStore(SQLiteStore, VectorStore):
+    """Exact-search vector store of a collection, kept in a NumPy memory map.
+
+    Embeddings are normalized and stored as rows of a `.npy` file, opened as
+    a memory map, so a collection opens instantly and its vectors are paged
+    in by the OS as they are read. Queries score all the rows with a matrix
+    product and select the nearest with `argpartition`, which is exact and,
+    for collections of up to a few 100k chunks, as fast as an HNSW index.
+    IDs, documents and metadata live in a SQLite table next to the file,
+    with "from" and "chunk" as indexed columns for `where` filters.
+
+    Deleted rows are skipped by queries and reclaimed when the file grows:
+    the live rows are then rewritten, in order, into a new file. The current
+    file is recorded in the SQLite database, in the same transaction as the
+    rows, so an interrupted write never mixes two layouts.
+
+    Args:
+        folder (str): Folder of the collection files.
+        name (str): Name of the collection.
+        embedding_function (callable, optional): Embeds the documents added
+                                                 or queried without
+                                                 embeddings.
+        dtype (str): "float32", or "float16" to halve the size of the file.
+        space (str): Distance reported by queries, as in ChromaDB: "cosine",
+                     "ip" or "l2". Distances are computed on the normalized
+                     embeddings.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS vectors (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL UNIQUE,
+        row INTEGER NOT NULL,
+        source TEXT,
+        chunk INTEGER,
+        document TEXT,
+        metadata TEXT
+    );
+    CREATE INDEX IF NOT EXISTS vectors_source ON vectors (source);
+    CREATE INDEX IF NOT EXISTS vectors_chunk ON vectors (chunk);
+    CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    def __init__(
+        self, folder, name, embedding_function=None, dtype="float32", space="cosine"
+    ):
+        super().__init__(os.path.join(folder, "metadata.sqlite3"))
+        self.folder = folder
+        self.name = name
+        self.embedding_function = embedding_function
+        self.dtype = np.dtype(dtype)
+        self.space = space
+
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = 'file'"
+        ).fetchone()
+        self.file = row[0] if row else None
+        # Files of interrupted rewrites
+        for path in glob.glob(os.path.join(folder, "*.npy")):
+            if os.path.basename(path) != self.file:
+                os.remove(path)
+        self.embeddings = None
+        if self.file is not None:
+            self.embeddings = np.load(os.path.join(folder, self.file), mmap_mode="r+")
+
+        # ID of each row, None once deleted, and the row of each ID
+        self.rows = dict(self.connection.execute("SELECT id, row FROM vectors"))
+        self.size = max(self.rows.values(), default=-1) + 1
+        self.ids = [None] * self.size
+        for id, row in self.rows.items():
+            self.ids[row] = id
+        self.live = np.zeros(self.capacity, dtype=bool)
+        self.live[list(self.rows.values())] = True
+
+    @property
+    def capacity(self):
+        return 0 if self.embeddings is None else len(self.embeddings)
+
+    def count(self):
+        return len(self.rows)
+
+    def embed(self, documents):
+        if self.embedding_function is None:
+            raise ValueError(f"Collection {self.name} has no embedding function")
+        return self.embedding_function(documents)
+
+    def _rewrite(self, capacity, dimension):
+        """Copies the live rows, in order, into a new file of `capacity` rows,
+        and makes it the current file."""
+        file = f"embeddings-{uuid.uuid4().hex}.npy"
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(self.folder, file),
+            mode="w+",
+            dtype=self.dtype,
+            shape=(capacity, dimension),
+        )
+        ids = [id for id in self.ids if id is not None]
+        block = max(BLOCK_ELEMENTS // dimension, 1)
+        for start in range(0, len(ids), block):
+            rows = [self.rows[id] for id in ids[start : start + block]]
+            embeddings[start : start + len(rows)] = self.embeddings[rows]
+        embeddings.flush()
+
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE vectors SET row = ? WHERE id = ?",
+                [(row, id) for row, id in enumerate(ids)],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES ('file', ?)",
+                (file,),
+            )
+        if self.file is not None:
+            # Queries in flight keep reading the previous map
+            os.remove(os.path.join(self.folder, self.file))
+
+        self.file, self.embeddings = file, embeddings
+        self.rows = {id: row for row, id in enumerate(ids)}
+        self.ids, self.size = ids, len(ids)
+        self.live = np.zeros(capacity, dtype=bool)
+        self.live[: self.size] = True
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        with self.lock:
+            new = [i for i, id in enumerate(ids) if id not in self.rows]
+            if len(set(ids)) != len(ids):
+                raise ValueError("Duplicate IDs in the added elements")
+            if not new:
+                return
+            ids = [ids[i] for i in new]
+            metadatas = [metadatas[i] for i in new] if metadatas else [{}] * len(ids)
+            documents = [documents[i] for i in new] if documents else [None] * len(ids)
+            if embeddings is None:
+                embeddings = self.embed(documents)
+            else:
+                embeddings = [embeddings[i] for i in new]
+            vectors = normalize(embeddings)
+
+            if self.size + len(ids) > self.capacity:
+                live = len(self.rows)
+                self._rewrite(max(1024, 2 * (live + len(ids))), vectors.shape[1])
+            start = self.size
+            self.embeddings[start : start + len(ids)] = vectors
+            self.embeddings.flush()
+
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO vectors (id, row, source, chunk, document, metadata)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            id,
+                            start + i,
+                            metadata.get("from"),
+                            metadata.get("chunk"),
+                            document,
+                            json.dumps(metadata),
+                        )
+                        for i, (id, metadata, document) in enumerate(
+                            zip(ids, metadatas, documents)
+                        )
+                    ],
+                )
+            for i, id in enumerate(ids):
+                self.rows[id] = start + i
+            self.ids.extend(ids)
+            self.size += len(ids)
+            self.live[start : self.size] = True
+
+    def _select(self, columns, ids=None, where=None, limit=None, offset=None):
+        """Selects the rows matching IDs and a filter, in insertion order."""
+        condition, parameters = where_clause(where) if where else ("1", [])
+        sql = f"SELECT {columns} FROM vectors WHERE ({condition})"
+        if ids is None:
+            sql += " ORDER BY seq"
+            if limit is not None or offset:
+                sql += " LIMIT ? OFFSET ?"
+                parameters = parameters + [-1 if limit is None else limit, offset or 0]
+            return self.connection.execute(sql, parameters).fetchall()
+
+        results = []
+        for batch in batched(list(ids)):
+            placeholders = ", ".join("?" * len(batch))
+            results += self.connection.execute(
+                f"{sql} AND id IN ({placeholders}) ORDER BY seq",
+                parameters + batch,
+            ).fetchall()
+        return results[offset or 0 :][:limit]
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+        include = include or ["metadatas", "documents"]
+        with self.lock:
+            elements = self._select(
+                "id, row, document, metadata", ids, where, limit, offset
+            )
+            embeddings = None
+            if "embeddings" in include:
+                rows = [row for _, row, _, _ in elements]
+                embeddings = []
+                if rows:
+                    embeddings = list(self.embeddings[rows].astype(np.float32))
+        return {
+            "ids": [id for id, _, _, _ in elements],
+            "embeddings": embeddings,
+            "documents": (
+                [document for _, _, document, _ in elements]
+                if "documents" in include
+                else None
+            ),
+            "metadatas": (
+                [json.loads(metadata) for _, _, _, metadata in elements]
+                if "metadatas" in include
+                else None
+            ),
+            "included": include,
+        }
+
+    def distances(self, scores):
+        """Converts inner products of normalized vectors to distances."""
+        if self.space == "l2":
+            return np.maximum(2 - 2 * scores, 0)
+        return 1 - scores
+
+    def query(
+        self,
+        query_embeddings=None,
+        query_texts=None,
+        n_results=10,
+        where=None,
+        include=None,
+    ):
+        include = include or ["metadatas", "documents", "distances"]
+        if query_embeddings is None:
+            query_embeddings = self.embed(query_texts)
+        queries = normalize(np.atleast_2d(np.asarray(query_embeddings)))
+
+        # The rows are read without the lock: writes only append to the map,
+        # and rewrites replace it
+        with self.lock:
+            embeddings, ids = self.embeddings, self.ids
+            rows, live = None, self.live[: self.size].copy()
+            if where:
+                rows = np.array(
+                    [row for (row,) in self._select("row", where=where)],
+                    dtype=np.int64,
+                )
+                rows.sort()
+        k = min(n_results, int(live.sum()) if rows is None else len(rows))
+        if embeddings is None or k <= 0:
+            scores = np.empty((len(queries), 0), dtype=np.float32)
+            selected = np.empty((len(queries), 0), dtype=np.int64)
+        else:
+            if rows is None:
+                embeddings = embeddings[: len(live)]
+            scores, selected = top_k(queries, embeddings, k, rows=rows, live=live)
+
+        results = [
+            [
+                (ids[row], score)
+                for row, score in zip(query_rows, query_scores)
+                if row >= 0 and ids[row] is not None
+            ]
+            for query_rows, query_scores in zip(selected, scores)
+        ]
+        found = self.get(
+            ids=list({id for result in results for id, _ in result}),
+            include=[field for field in include if field != "distances"],
+        )
+        elements = {id: index for index, id in enumerate(found["ids"])}
+        # Elements deleted since the search are dropped
+        results = [
+            [(id, score) for id, score in result if id in elements]
+            for result in results
+        ]
+
+        def field(name):
+            if name not in include:
+                return None
+            return [
+                [found[name][elements[id]] for id, _ in result] for result in results
+            ]
+
+        return {
+            "ids": [[id for id, _ in result] for result in results],
+            "distances": (
+                [
+                    self.distances(np.array([s for _, s in result])).tolist()
+                    for result in results
+                ]
+                if "distances" in include
+                else None
+            ),
+            "embeddings": field("embeddings"),
+            "documents": field("documents"),
+            "metadatas": field("metadatas"),
+            "included": include,
+        }
+
+    def update(self, ids, embeddings=None, metadatas=None, documents=None):
+        with self.lock:
+            missing = [id for id in ids if id not in self.rows]
+            if missing:
+                raise ValueError(f"Unknown IDs in {self.name}: {missing[:10]}")
+            if embeddings is not None:
+                rows = [self.rows[id] for id in ids]
+                self.embeddings[rows] = normalize(embeddings)
+                self.embeddings.flush()
+            with self.connection:
+                if metadatas is not None:
+                    self.connection.executemany(
+                        "UPDATE vectors SET source = ?, chunk = ?, metadata = ?"
+                        " WHERE id = ?",
+                        [
+                            (m.get("from"), m.get("chunk"), json.dumps(m), id)
+                            for id, m in zip(ids, metadatas)
+                        ],
+                    )
+                if documents is not None:
+                    self.connection.executemany(
+                        "UPDATE vectors SET document = ? WHERE id = ?",
+                        list(zip(documents, ids)),
+                    )
+
+    def delete(self, ids=None, where=None):
+        with self.lock:
+            if ids is None and where is None:
+                return
+            deleted = [id for (id,) in self._select("id", ids, where)]
+            with self.connection:
+                for batch in batched(deleted):
+                    placeholders = ", ".join("?" * len(batch))
+                    self.connection.execute(
+                        f"DELETE FROM vectors WHERE id IN ({placeholders})", batch
+                    )
+            for id in deleted:
+                row = self.rows.pop(id)
+                self.ids[row] = None
+                self.live[row] = False
+
+    def close(self):
+        """Closes the files of the collection, e.g. before deleting them."""
+        with self.lock:
+            self.embeddings = None
+            self.connection.close()
+
+
+VECTOR_STORES = {"chroma": ChromaVectorStore, "numpy": NumpyVectorStore}
@@ -1,13 +1,21 @@
 import os
+import threading
 import yaml
 from chromadb.utils import embedding_functions
 
+from models.embedding_cache import CachedEmbeddingFunction
+
 root_dir = os.path.abspath(os.path.join(__file__, "..", ".."))
 
 with open("src/configs/config.yaml", "r") as config_file:
     config = yaml.safe_load(config_file)
 
 DEVICE = config["hardware"]["DEVICE"]
+EMBEDDING_CACHE = config["processing"].get("EMBEDDING_CACHE", False)
+EMBEDDING_CACHE_SIZE = config["processing"].get("EMBEDDING_CACHE_SIZE", 10000)
+EMBEDDING_CACHE_PATH = os.path.join(
+    config["dataset"]["CHROMA_DATA_PATH"], "embedding_cache.sqlite3"
+)
 
 
 class EmbeddingModel(object):
@@ -20,6 +28,10 @@ class EmbeddingModel(object):
         self.model_type = None
         self.device = DEVICE
 
+    def count_tokens(self, text):
+        """Returns the number of tokens of a text, approximated by words."""
+        return len(text.split())
+
 
 class Multilingual(EmbeddingModel):
     def __init__(
@@ -33,7 +45,27 @@ class Multilingual(EmbeddingModel):
                 model_name=self.model_name, device=self.device
             )
         )
-        # self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        if EMBEDDING_CACHE:
+            self.embedding_function = CachedEmbeddingFunction(
+                self.embedding_function,
+                self.model_name,
+                path=EMBEDDING_CACHE_PATH,
+                memory_size=EMBEDDING_CACHE_SIZE,
+            )
+        self.tokenizer = None
+        self.tokenizer_lock = threading.Lock()
+
+    def count_tokens(self, text):
+        """Returns the number of tokens of a text for the model's tokenizer.
+
+        The tokenizer is loaded on first use.
+        """
+        with self.tokenizer_lock:
+            if self.tokenizer is None:
+                from transformers import AutoTokenizer
+
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        return len(self.tokenizer.encode(text, add_special_tokens=False, verbose=False))
 
     def embed(self, query):
         return self.embedding_function([query])[0]
@@ -0,0 +1,126 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from storage import SQLiteStore, batched
+
+
+class EmbeddingDiskCache(SQLiteStore):
+    """Persistent tier of the embedding cache, keyed by content hash."""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS embeddings (
+        key TEXT PRIMARY KEY,
+        vector BLOB NOT NULL
+    );
+    """
+
+    def get(self, keys):
+        vectors = {}
+        with self.lock:
+            for batch in batched(keys):
+                rows = self.connection.execute(
+                    "SELECT key, vector FROM embeddings "
+                    f"WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    vectors[key] = np.frombuffer(vector, dtype=np.float32)
+        return vectors
+
+    def add(self, vectors):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                [
+                    (key, np.asarray(vector, dtype=np.float32).tobytes())
+                    for key, vector in vectors.items()
+                ],
+            )
+            self.connection.commit()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Content-addressed cache in front of an embedding function.
+
+    Embeddings are keyed by (model name, text hash) and looked up in an
+    in-memory LRU first, then in an optional SQLite file. Only the texts
+    missing from both tiers are sent to the wrapped embedding function, in
+    a single call.
+
+    Args:
+        embedding_function: The embedding function to cache.
+        model_name (str): Name of the embedding model, part of the cache key.
+        path (str, optional): Path of the SQLite file of the persistent tier.
+                              The cache is memory-only if None.
+        memory_size (int): Maximum number of embeddings kept in memory.
+    """
+
+    def __init__(self, embedding_function, model_name, path=None, memory_size=10000):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.disk = EmbeddingDiskCache(path) if path else None
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        keys = [self.key(text) for text in input]
+        vectors = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    vectors[key] = self.memory[key]
+            self.memory_hits += sum(key in vectors for key in keys)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self.disk is not None:
+            found = self.disk.get(missing)
+            with self.lock:
+                for key, vector in found.items():
+                    self._remember(key, vector)
+                self.disk_hits += sum(key in found for key in keys)
+            vectors.update(found)
+
+        texts = {key: text for key, text in zip(keys, input) if key not in vectors}
+        if texts:
+            computed = dict(zip(texts, self.embedding_function(list(texts.values()))))
+            computed = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in computed.items()
+            }
+            if self.disk is not None:
+                self.disk.add(computed)
+            with self.lock:
+                for key, vector in computed.items():
+                    self._remember(key, vector)
+                self.misses += sum(key in computed for key in keys)
+            vectors.update(computed)
+
+        return [vectors[key] for key in keys]
+
+    def stats(self):
+        """Returns the hit and miss counters of the cache."""
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self.memory),
+        }
@@ -0,0 +1,99 @@
+import time
+import asyncio
+import threading
+
+from models.generation import GenerationModel
+
+
+class FakeModel(GenerationModel):
+    """Local stand-in for an API generation model.
+
+    Replies are computed locally after an injected latency, so that the
+    pipelines can be tested and measured without a network or an API key.
+
+    Args:
+        latency (float): Seconds spent in every call.
+        reply (callable, optional): Builds the reply from the input. Echoes
+                                    the input by default.
+        failures (int): Number of calls that fail before the model starts
+                        answering.
+        token_latency (float): Seconds between two streamed tokens.
+        error (callable, optional): Builds the exception raised by failing
+                                    calls, e.g. `ResourceExhausted` to emulate
+                                    rate limits. RuntimeError by default.
+    """
+
+    def __init__(
+        self, latency=0.0, reply=None, failures=0, token_latency=0.0, error=None
+    ):
+        super().__init__()
+        self.model_type = "Fake"
+        self.latency = latency
+        self.reply = reply or (lambda input: str(input))
+        self.failures = failures
+        self.token_latency = token_latency
+        self.error = error or RuntimeError
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failing = self.failures > 0
+            self.failures -= 1 if failing else 0
+        return failing
+
+    def _finish(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _reply(self, input, failing):
+        if failing:
+            raise self.error("Fake model failure")
+        return self.reply(input)
+
+    def _call(self, input):
+        failing = self._start()
+        try:
+            time.sleep(self.latency)
+        finally:
+            self._finish()
+        return self._reply(input, failing)
+
+    async def _acall(self, input):
+        # Waits without holding a thread, like a network call
+        failing = self._start()
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self._finish()
+        return self._reply(input, failing)
+
+    def predict(self, input, history=[]):
+        return self._call(input)
+
+    def predict_stream(self, input, history=[]):
+        tokens = self._call(input).split(" ")
+        for i, token in enumerate(tokens):
+            if i > 0:
+                time.sleep(self.token_latency)
+            yield token if i == len(tokens) - 1 else token + " "
+
+    def predict_json(self, input, history=[]):
+        return self._call(input)
+
+    def predict_image(self, input, image, history):
+        return self._call(image)
+
+    async def apredict(self, input, history=[]):
+        return await self._acall(input)
+
+    async def apredict_json(self, input, history=[]):
+        return await self._acall(input)
+
+    async def apredict_image(self, input, image, history):
+        return await self._acall(image)
@@ -1,9 +1,14 @@
 import yaml
 import os
 import base64
+import asyncio
+import threading
 
 import google.generativeai as genai
 
+from models.scheduler import LLMScheduler, estimate_tokens
+from monitoring import record_tokens
+
 root_dir = os.path.abspath(os.path.join(__file__, "..", ".."))
 
 with open("src/configs/config.yaml", "r") as config_file:
@@ -13,6 +18,30 @@ MODEL_FOLDER = config["generation"]["MODEL_FOLDER"]
 TEMPERATURE = config["generation"]["TEMPERATURE"]
 MAX_TOKENS = config["generation"]["MAX_TOKENS"]
 N_CTX = config["generation"]["N_CTX"]
+SCHEDULER_CONFIG = config.get("scheduler", {})
+
+# Every Gemini call goes through this process-wide scheduler
+scheduler = LLMScheduler(
+    rpm=SCHEDULER_CONFIG.get("RPM"),
+    tpm=SCHEDULER_CONFIG.get("TPM"),
+    max_retries=SCHEDULER_CONFIG.get("MAX_RETRIES", 5),
+    base_delay=SCHEDULER_CONFIG.get("BASE_DELAY", 1.0),
+    max_delay=SCHEDULER_CONFIG.get("MAX_DELAY", 30.0),
+)
+
+
+_model_pool = {}
+_model_pool_lock = threading.Lock()
+_configured_api_key = None
+
+
+def configure(api_key):
+    """Configures the Gemini client, once per API key."""
+    global _configured_api_key
+    with _model_pool_lock:
+        if api_key != _configured_api_key:
+            genai.configure(api_key=api_key)
+            _configured_api_key = api_key
 
 
 def image_to_base64_data_uri(file_path):
@@ -33,24 +62,41 @@ class GenerationModel(object):
     def change_config(self, config):
         pass
 
+    def predict_stream(self, input, history=[]):
+        """Yields the answer in pieces as it is generated. Models without
+        native streaming yield the whole answer at once."""
+        yield self.predict(input, history)
+
+    # Async variants, for the request path. Models without a native async
+    # client run their blocking calls in a worker thread.
+    async def apredict(self, input, history=[]):
+        return await asyncio.to_thread(self.predict, input, history)
+
+    async def apredict_json(self, input, history=[]):
+        return await asyncio.to_thread(self.predict_json, input, history)
+
+    async def apredict_image(self, input, image, history):
+        return await asyncio.to_thread(self.predict_image, input, image, history)
+
 
 class GoogleAI(GenerationModel):
-    def __init__(self, api_key, response_format):
+    def __init__(self, api_key, response_format, generation_config=None):
         super().__init__()
         self.path = None
+        self.api_key = api_key
         self.response_format = response_format
-        genai.configure(api_key=api_key)
+        self.generation_config = dict(generation_config or {})
+        configure(api_key)
 
     def init_model(self):
+        generation_config = dict(self.generation_config)
         if self.response_format:
-            self.model = genai.GenerativeModel(
-                self.path,
-                generation_config={"response_mime_type": self.response_format},
-            )
-        else:
-            self.model = genai.GenerativeModel(self.path)
+            generation_config["response_mime_type"] = self.response_format
+        self.model = genai.GenerativeModel(
+            self.path, generation_config=generation_config or None
+        )
 
-    def predict(self, input, history=[]):
+    def chat_history(self, history):
         messages = [
             {
                 "role": "user",
@@ -64,83 +110,133 @@ class GoogleAI(GenerationModel):
                     "parts": [history_message["content"]],
                 }
             )
-        chat = self.model.start_chat(history=messages)
-        response = chat.send_message(input)
+        return messages
+
+    def predict(self, input, history=[]):
+        chat = self.model.start_chat(history=self.chat_history(history))
+        response = scheduler.call(
+            chat.send_message, input, tokens=estimate_tokens(input, history)
+        )
+        record_tokens(self.path, response)
         return response.text
 
+    def predict_stream(self, input, history=[]):
+        def send():
+            # A new chat per attempt, independent of a failed stream
+            chat = self.model.start_chat(history=self.chat_history(history))
+            return chat.send_message(input, stream=True)
+
+        response, chunks = scheduler.call_stream(
+            send, tokens=estimate_tokens(input, history)
+        )
+        for chunk in chunks:
+            if chunk.parts:
+                yield chunk.text
+        record_tokens(self.path, response)
+
+    def json_model(self):
+        # JSON mode uses its own pooled instance instead of switching the
+        # response format of this shared one.
+        if self.response_format == "application/json":
+            return self
+        return get_model(
+            type(self),
+            api_key=self.api_key,
+            response_format="application/json",
+            generation_config=self.generation_config,
+        )
+
     def predict_json(self, input, history=[]):
-        original_response_format = self.response_format
-        self.response_format = "application/json"
-        self.init_model()
+        return self.json_model().predict(input, history)
 
-        output = self.predict(input, history)
-        self.response_format = original_response_format
-        self.init_model()
+    def predict_image(self, input, image, history):
+        chat = self.model.start_chat(history=self.chat_history(history))
+        response = scheduler.call(
+            chat.send_message,
+            [input, image],
+            tokens=estimate_tokens(input, image, history),
+        )
+        record_tokens(self.path, response)
+        return response.text
 
-        return output
+    async def apredict(self, input, history=[]):
+        chat = self.model.start_chat(history=self.chat_history(history))
+        response = await scheduler.acall(
+            chat.send_message_async, input, tokens=estimate_tokens(input, history)
+        )
+        record_tokens(self.path, response)
+        return response.text
 
-    def predict_image(self, input, image, history):
-        messages = [{"role": "user", "parts": ["You are a helpful assistant."]}]
-        for history_message in history:
-            messages.append(
-                {
-                    "role": history_message["role"],
-                    "parts": [history_message["content"]],
-                }
-            )
-        chat = self.model.start_chat(history=messages)
-        response = chat.send_message([input, image])
+    async def apredict_json(self, input, history=[]):
+        return await self.json_model().apredict(input, history)
+
+    async def apredict_image(self, input, image, history):
+        chat = self.model.start_chat(history=self.chat_history(history))
+        response = await scheduler.acall(
+            chat.send_message_async,
+            [input, image],
+            tokens=estimate_tokens(input, image, history),
+        )
+        record_tokens(self.path, response)
         return response.text
 
 
 class GeminiFlash(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiFlash, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiFlash, self).__init__(api_key, response_format, generation_config)
         self.path = "gemini-1.5-flash"
         self.input_token_limit = 500000  # Example, actual might vary
         self.init_model()
 
 
 class GeminiFlash8b(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiFlash8b, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiFlash8b, self).__init__(api_key, response_format, generation_config)
         self.path = "gemini-1.5-flash-8b"
         self.input_token_limit = 1000000  # Example, actual might vary
         self.init_model()
 
 
 class GeminiPro(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiPro, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiPro, self).__init__(api_key, response_format, generation_config)
         self.path = "gemini-1.5-pro"
         self.input_token_limit = 1000000  # Example, actual might vary
         self.init_model()
 
 
 class GeminiProVision(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiProVision, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiProVision, self).__init__(
+            api_key, response_format, generation_config
+        )
         self.path = "gemini-pro-vision"
         self.init_model()
 
 
 class GeminiProLatest(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiProLatest, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiProLatest, self).__init__(
+            api_key, response_format, generation_config
+        )
         self.path = "gemini-pro-latest"
         self.init_model()
 
 
 class GeminiFlashLatest(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiFlashLatest, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiFlashLatest, self).__init__(
+            api_key, response_format, generation_config
+        )
         self.path = "gemini-1.5-flash-latest"
         self.init_model()
 
 
 class GeminiFlash2Exp(GoogleAI):
-    def __init__(self, api_key, response_format=None):
-        super(GeminiFlash2Exp, self).__init__(api_key, response_format)
+    def __init__(self, api_key, response_format=None, generation_config=None):
+        super(GeminiFlash2Exp, self).__init__(
+            api_key, response_format, generation_config
+        )
         self.path = "gemini-2.0-flash-exp"
         self.init_model()
 
@@ -156,9 +252,54 @@ model_classes = {
 }
 
 
-def get_model_by_name(name, api_key=None):
+def get_model(
+    model_class, api_key=None, response_format=None, generation_config=None
+):
+    """Returns the process-wide instance of a generation model.
+
+    Instances are pooled by (model class, API key, response format,
+    generation config), so their clients are built once and reused across
+    requests.
+
+    Args:
+        model_class (type): The model class, e.g. GeminiFlash.
+        api_key (str, optional): The API key of the model.
+        response_format (str, optional): The response MIME type, e.g.
+                                         "application/json".
+        generation_config (dict, optional): The generation parameters.
+
+    Returns:
+        GenerationModel: The shared model instance.
+    """
+    key = (
+        model_class,
+        api_key,
+        response_format,
+        tuple(sorted((generation_config or {}).items())),
+    )
+    with _model_pool_lock:
+        model = _model_pool.get(key)
+    if model is None:
+        model = model_class(
+            api_key=api_key,
+            response_format=response_format,
+            generation_config=generation_config,
+        )
+        with _model_pool_lock:
+            model = _model_pool.setdefault(key, model)
+    return model
+
+
+def get_model_by_name(
+    name, api_key=None, response_format=None, generation_config=None
+):
     if name in model_classes:
-        return model_classes[name](api_key=api_key)
+        return get_model(
+            model_classes[name],
+            api_key=api_key,
+            response_format=response_format,
+            generation_config=generation_config,
+        )
     else:
         raise ValueError(f"No model found: {name}")
 
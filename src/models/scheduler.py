@@ -0,0 +1,376 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from google.api_core import exceptions
+
+from monitoring.metrics import LLM_SCHEDULER_EVENTS
+
+
+# Priority classes, lower values are served first
+INTERACTIVE = 0
+INGESTION = 1
+
+_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+RETRYABLE_ERRORS = (
+    exceptions.ResourceExhausted,
+    exceptions.TooManyRequests,
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.DeadlineExceeded,
+)
+
+# End of a stream without any chunk
+_END = object()
+
+
+@contextmanager
+def llm_priority(priority):
+    """Sets the priority class of the model calls made in this context.
+
+    Worker threads do not inherit it: tasks submitted to an executor must
+    run in a copy of the context (`contextvars.copy_context().run`).
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def is_retryable(error):
+    """Returns whether a model error is worth retrying (rate limits, overload)."""
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def estimate_tokens(*inputs):
+    """Estimates the number of tokens of text inputs, about 4 characters each.
+
+    Images count as the 258 tokens Gemini bills per image.
+    """
+    tokens = 0
+    for input in inputs:
+        if isinstance(input, str):
+            tokens += len(input) // 4 + 1
+        elif isinstance(input, (list, tuple)):
+            tokens += estimate_tokens(*input)
+        elif isinstance(input, dict):
+            tokens += estimate_tokens(*input.values())
+        else:
+            tokens += 258
+    return tokens
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per minute.
+
+    Args:
+        rate (float): Tokens per minute. The bucket holds at most one
+                      minute worth of tokens.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        refill = (now - self.updated_at) * self.rate / 60
+        self.tokens = min(self.rate, self.tokens + refill)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        """Returns the seconds until `amount` tokens are available."""
+        self.refill()
+        # Requests larger than the bucket only wait for a full bucket
+        missing = min(amount, self.rate) - self.tokens
+        return max(0.0, missing * 60 / self.rate)
+
+    def take(self, amount):
+        # The balance may go negative, delaying the next requests
+        self.refill()
+        self.tokens -= amount
+
+
+class LLMScheduler:
+    """Admits model calls under shared rate limits, by priority.
+
+    Calls wait in a priority queue until both the request bucket (RPM) and
+    the token bucket (TPM) allow them; interactive calls are admitted before
+    queued ingestion calls. Calls failing with a retryable error are retried
+    with exponential backoff and full jitter, going through admission again.
+    Streamed calls are only retried until their first chunk: an error raised
+    after it is counted as a stream error and reaches the caller, as part of
+    the answer was already delivered.
+
+    Args:
+        rpm (int, optional): Requests per minute. Unlimited if None.
+        tpm (int, optional): Tokens per minute. Unlimited if None.
+        max_retries (int): Retries of a call failing with a retryable error.
+        base_delay (float): Backoff delay of the first retry, in seconds.
+        max_delay (float): Maximum backoff delay, in seconds.
+    """
+
+    def __init__(
+        self, rpm=None, tpm=None, max_retries=5, base_delay=1.0, max_delay=30.0
+    ):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        # Wake-up events of the async callers waiting for admission
+        self.async_waiters = set()
+        self.metrics = {
+            "admitted": 0,
+            "throttled": 0,
+            "retries": 0,
+            "retryable_errors": 0,
+            "stream_errors": 0,
+            "max_queue_depth": 0,
+        }
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _count(self, event, amount=1):
+        # Called with the condition held
+        self.metrics[event] += amount
+        LLM_SCHEDULER_EVENTS.inc(amount, event=event)
+
+    def _admit(self, tokens):
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+        self._count("admitted")
+
+    def _notify(self):
+        self.condition.notify_all()
+        for loop, wakeup in self.async_waiters:
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def _enqueue(self, priority):
+        entry = (priority, next(self.counter))
+        heapq.heappush(self.queue, entry)
+        self.metrics["max_queue_depth"] = max(
+            self.metrics["max_queue_depth"], len(self.queue)
+        )
+        return entry
+
+    def _dequeue(self, entry, throttled):
+        self.queue.remove(entry)
+        heapq.heapify(self.queue)
+        self._count("throttled", int(throttled))
+        self._notify()
+
+    def _poll(self, entry, tokens):
+        """Admits a queued call if it is first and limits allow it.
+
+        Returns:
+            float: 0 if the call was admitted, else the seconds to wait, or
+                   None to wait for the calls ahead.
+        """
+        if self.queue[0] != entry:
+            return None
+        wait = self._wait_time(tokens)
+        if wait == 0:
+            self._admit(tokens)
+        return wait
+
+    def try_acquire(self, tokens):
+        """Admits a call right away if nothing is queued and limits allow it.
+
+        Returns:
+            bool: Whether the call was admitted.
+        """
+        with self.condition:
+            if self.queue or self._wait_time(tokens) > 0:
+                return False
+            self._admit(tokens)
+            return True
+
+    def acquire(self, tokens, priority=None):
+        """Blocks until a call of `tokens` estimated tokens is admitted."""
+        priority = _priority.get() if priority is None else priority
+        with self.condition:
+            entry = self._enqueue(priority)
+            throttled = False
+            try:
+                while True:
+                    wait = self._poll(entry, tokens)
+                    if wait == 0:
+                        return
+                    throttled = True
+                    self.condition.wait(wait)
+            finally:
+                self._dequeue(entry, throttled)
+
+    async def aacquire(self, tokens, priority=None):
+        """Async variant of `acquire`. Throttled calls wait on the event loop,
+        for the delay of the buckets or until the calls ahead leave the
+        queue, without holding a thread."""
+        if self.try_acquire(tokens):
+            return
+        priority = _priority.get() if priority is None else priority
+        wakeup = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), wakeup)
+        with self.condition:
+            entry = self._enqueue(priority)
+            self.async_waiters.add(waiter)
+        try:
+            while True:
+                with self.condition:
+                    wait = self._poll(entry, tokens)
+                    if wait == 0:
+                        return
+                    # Cleared under the lock: a call leaving the queue from
+                    # now on sets it again
+                    wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+                self._dequeue(entry, True)
+
+    def record_usage(self, estimated, response):
+        """Charges the token bucket with the actual usage of a response."""
+        try:
+            used = response.usage_metadata.total_token_count
+        except Exception:
+            # No usage reported, e.g. by a stream not consumed yet
+            return
+        if used and self.tokens is not None:
+            with self.condition:
+                self.tokens.take(used - estimated)
+
+    def backoff(self, attempt):
+        """Returns the delay before a retry, with full jitter."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _failed(self, error, attempt):
+        if not is_retryable(error):
+            return False
+        with self.condition:
+            self._count("retryable_errors")
+            if attempt == self.max_retries:
+                return False
+            self._count("retries")
+        print(
+            f"Retryable model error ({error}), "
+            f"retrying ({attempt + 1}/{self.max_retries})"
+        )
+        return True
+
+    def call(self, function, *args, tokens=0, **kwargs):
+        """Calls `function` once admitted, retrying retryable errors.
+
+        Args:
+            function (callable): The model call.
+            tokens (int): Estimated number of tokens of the call.
+
+        Returns:
+            The result of the call.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                response = function(*args, **kwargs)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            self.record_usage(tokens, response)
+            return response
+
+    def call_stream(self, function, *args, tokens=0, **kwargs):
+        """Variant of `call` for streamed responses. The stream is started
+        again when it fails with a retryable error before its first chunk.
+
+        Args:
+            function (callable): Starts the streamed model call. It is called
+                                 again on retries, so it must not depend on
+                                 the state left by a failed stream.
+            tokens (int): Estimated number of tokens of the call.
+
+        Returns:
+            tuple: The response and an iterator over its chunks.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                response = function(*args, **kwargs)
+                chunks = iter(response)
+                first = next(chunks, _END)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            return response, self._stream(response, first, chunks, tokens)
+
+    def _stream(self, response, first, chunks, tokens):
+        if first is not _END:
+            try:
+                yield first
+                yield from chunks
+            except Exception as e:
+                if is_retryable(e):
+                    with self.condition:
+                        self._count("stream_errors")
+                raise
+        self.record_usage(tokens, response)
+
+    async def acall(self, function, *args, tokens=0, **kwargs):
+        """Async variant of `call`, for coroutine functions."""
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(tokens)
+            try:
+                response = await function(*args, **kwargs)
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            self.record_usage(tokens, response)
+            return response
+
+    def share(self, processes):
+        """Divides the rate limits between processes with a scheduler each.
+
+        Args:
+            processes (int): Number of processes sharing the limits.
+        """
+        with self.condition:
+            for bucket in (self.requests, self.tokens):
+                if bucket is not None:
+                    bucket.refill()
+                    bucket.rate /= processes
+                    bucket.tokens = min(bucket.tokens, bucket.rate)
+
+    def stats(self):
+        """Returns the queue depth per priority class and the counters."""
+        with self.condition:
+            depth = {"interactive": 0, "ingestion": 0}
+            for priority, _ in self.queue:
+                depth["ingestion" if priority == INGESTION else "interactive"] += 1
+            return {"queue_depth": depth, **self.metrics}
@@ -0,0 +1,7 @@
+from monitoring.metrics import (
+    get_request_id,
+    record_tokens,
+    registry,
+    request_context,
+    span,
+)
@@ -0,0 +1,237 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"'.replace("\n", "\\n"))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Monotonic counter, one value per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [
+                (self.name, format_labels(self.labels, key), value)
+                for key, value in self.values.items()
+            ]
+
+
+class Histogram:
+    """Cumulative histogram, one per combination of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            # Per-bucket counts (the last one is +Inf), sum and count
+            counts, total, count = self.values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0, 0)
+            )
+            counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels + ("le",), key + (bound,))
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                labels = format_labels(self.labels + ("le",), key + ("+Inf",))
+                samples.append((f"{self.name}_bucket", labels, count))
+                labels = format_labels(self.labels, key)
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Gauge:
+    """Gauge read from a callback when the metrics are exported.
+
+    Args:
+        callback (callable): Returns a dict mapping tuples of label values
+                             to the current values.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def samples(self):
+        return [
+            (self.name, format_labels(self.labels, key), value)
+            for key, value in self.callback().items()
+        ]
+
+
+class MetricsRegistry:
+    """Holds the metrics of the process and exports them in the Prometheus
+    text format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, callback, labels=()):
+        return self.register(Gauge(name, help, callback, labels))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "rag_stage_duration_seconds",
+    "Duration of the stages of the chat and ingestion pipelines.",
+    labels=("stage",),
+)
+REQUEST_SECONDS = registry.histogram(
+    "rag_request_duration_seconds",
+    "Duration of the HTTP requests, until the response headers.",
+    labels=("endpoint", "status"),
+)
+ANSWER_CACHE_LOOKUPS = registry.counter(
+    "rag_answer_cache_lookups_total",
+    "Lookups of the semantic answer cache, by result.",
+    labels=("result",),
+)
+SPECULATIVE_RETRIEVALS = registry.counter(
+    "rag_speculative_retrievals_total",
+    "Speculative retrievals on the raw message, by whether their context was "
+    "reused or discarded.",
+    labels=("result",),
+)
+LLM_SCHEDULER_EVENTS = registry.counter(
+    "rag_llm_scheduler_events_total",
+    "Model calls admitted and throttled by the rate limiter, retryable errors, "
+    "retries, and errors raised after the first chunk of a streamed answer.",
+    labels=("event",),
+)
+HISTORY_DROPPED_MESSAGES = registry.counter(
+    "rag_history_dropped_messages_total",
+    "Older conversation messages left out of prompts while their summary was "
+    "being computed.",
+)
+LLM_TOKENS = registry.counter(
+    "rag_llm_tokens_total",
+    "Tokens reported by the generation model responses.",
+    labels=("model", "type"),
+)
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id):
+    """Tags the work of a request with its ID and collects its spans.
+
+    Yields:
+        dict: The duration of each stage of the request, in seconds.
+    """
+    trace = {}
+    request_token = _request_id.set(request_id)
+    trace_token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(trace_token)
+        _request_id.reset(request_token)
+
+
+@contextmanager
+def span(stage):
+    """Times a pipeline stage into the stage histogram and the request trace."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        trace = _trace.get()
+        if trace is not None:
+            trace[stage] = trace.get(stage, 0.0) + duration
+
+
+def record_tokens(model_name, response):
+    """Counts the tokens of a model response from its usage metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, field in [
+        ("prompt", "prompt_token_count"),
+        ("completion", "candidates_token_count"),
+        ("total", "total_token_count"),
+    ]:
+        count = getattr(usage, field, 0)
+        if count:
+            LLM_TOKENS.inc(count, model=model_name, type=kind)
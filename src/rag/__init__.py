@@ -1,3 +1,6 @@
 from rag.retriever import Retriever
 from rag.generator import Generator
 from rag.router import Router
+from rag.cache import SemanticCache
+from rag.packer import ContextPacker
+from rag.history import HistoryManager
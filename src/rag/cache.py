@@ -0,0 +1,167 @@
+import json
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from monitoring.metrics import ANSWER_CACHE_LOOKUPS
+
+
+class SemanticCache:
+    """Caches answers by query embedding, per collection, agent and model.
+
+    A cached answer is served for a new query whose embedding has a cosine
+    similarity of at least `threshold` with the cached query, as long as the
+    entry is younger than `ttl` and its collection has not changed since.
+    Collections are versioned by a generation counter, bumped whenever their
+    documents change.
+
+    Args:
+        threshold (float): Minimum cosine similarity between queries.
+        ttl (float): Lifetime of an entry, in seconds.
+        max_entries (int): Maximum number of entries, least recently used
+                           entries are evicted first.
+        history_policy (str): How the conversation history is taken into
+                              account:
+                              - "standalone": only messages without a
+                                previous user message are cached.
+                              - "exact": entries only match the same history.
+                              - "ignore": the history is not considered.
+    """
+
+    def __init__(
+        self, threshold=0.95, ttl=3600, max_entries=1000, history_policy="standalone"
+    ):
+        if history_policy not in ["standalone", "exact", "ignore"]:
+            raise ValueError(f"Unknown history policy: {history_policy}")
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.history_policy = history_policy
+        self.entries = OrderedDict()
+        self.generations = defaultdict(int)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bump(self, collection_name):
+        """Invalidates all cached answers of a collection."""
+        with self.lock:
+            self.generations[collection_name] += 1
+
+    def generation(self, collection_name):
+        """Returns the current generation counter of a collection."""
+        with self.lock:
+            return self.generations[collection_name]
+
+    def cacheable(self, history):
+        """Returns whether answers given after a conversation history can be
+        cached and served, under the history policy."""
+        return self._history_key(history) is not None
+
+    def _history_key(self, history):
+        if self.history_policy == "standalone":
+            if any(message["role"] == "user" for message in history):
+                return None
+            return ""
+        if self.history_policy == "exact":
+            return json.dumps(history, sort_keys=True)
+        return ""
+
+    def _normalize(self, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def lookup(self, collection_name, agent_name, model_name, embedding, history):
+        """Returns the cached answer of the closest similar query, if any.
+
+        Args:
+            collection_name (str): Name of the collection.
+            agent_name (str): Name of the agent.
+            model_name (str): Name of the generation model.
+            embedding (array): Embedding of the query.
+            history (list of dict): Conversation history.
+
+        Returns:
+            dict or None: The cached answer.
+        """
+        history_key = self._history_key(history)
+        if history_key is None:
+            return None
+        embedding = self._normalize(embedding)
+        now = time.time()
+
+        with self.lock:
+            generation = self.generations[collection_name]
+            best_id, best_similarity = None, self.threshold
+            for entry_id, entry in list(self.entries.items()):
+                if now - entry["created_at"] > self.ttl:
+                    del self.entries[entry_id]
+                    continue
+                if entry["key"] != (collection_name, agent_name, model_name):
+                    continue
+                if entry["generation"] != generation:
+                    continue
+                if entry["history"] != history_key:
+                    continue
+                similarity = float(np.dot(entry["embedding"], embedding))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None:
+                self.misses += 1
+                ANSWER_CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self.hits += 1
+            ANSWER_CACHE_LOOKUPS.inc(result="hit")
+            self.entries.move_to_end(best_id)
+            return self.entries[best_id]["answer"]
+
+    def store(
+        self,
+        collection_name,
+        agent_name,
+        model_name,
+        embedding,
+        history,
+        answer,
+        generation,
+    ):
+        """Caches the answer to a query.
+
+        Args:
+            collection_name (str): Name of the collection.
+            agent_name (str): Name of the agent.
+            model_name (str): Name of the generation model.
+            embedding (array): Embedding of the query.
+            history (list of dict): Conversation history.
+            answer (dict): The answer to cache.
+            generation (int): Generation of the collection read before the
+                              answer was computed. Answers computed while the
+                              collection changed are never served.
+        """
+        history_key = self._history_key(history)
+        if history_key is None:
+            return
+        with self.lock:
+            entry_id = object()
+            self.entries[entry_id] = {
+                "key": (collection_name, agent_name, model_name),
+                "generation": generation,
+                "history": history_key,
+                "embedding": self._normalize(embedding),
+                "answer": answer,
+                "created_at": time.time(),
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns the hit and miss counters of the cache."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+            }
@@ -1,5 +1,9 @@
+import asyncio
 from collections import defaultdict
 
+from rag.history import format_history
+from monitoring import span
+
 
 def fill_template(template: str, **kwargs):
     """Safely fill a template with named parameters, defaulting missing ones to empty string."""
@@ -7,17 +11,16 @@ def fill_template(template: str, **kwargs):
 
 
 class Generator:
-    def __init__(self, config, template):
+    def __init__(self, config, template, history_manager=None):
         self.config = config
         self.prompt_template = template
+        self.history_manager = history_manager
 
     def get_input(self, query, context):
         return fill_template(self.prompt_template, message=query, context=context)
 
-    def predict(self, model, message, history, context=None, user_context=None):
-        model.change_config(self.config)
-
-        input_text = fill_template(
+    def build_input(self, message, history, context=None, user_context=None):
+        return fill_template(
             self.prompt_template,
             message=message,
             context=context or "",
@@ -25,4 +28,38 @@ class Generator:
             user_context=user_context or "",
         )
 
-        return model.predict(input_text, history)
+    def render_history(self, model, history):
+        if self.history_manager is None:
+            return format_history(history)
+        return self.history_manager.render(model, history)
+
+    # The history is only sent through the prompt, not replayed as chat turns
+    def prompt(self, model, message, history, context=None, user_context=None):
+        with span("prompt"):
+            history = self.render_history(model, history)
+            return self.build_input(message, history, context, user_context)
+
+    def predict(self, model, message, history, context=None, user_context=None):
+        model.change_config(self.config)
+        input_text = self.prompt(model, message, history, context, user_context)
+        with span("generation"):
+            return model.predict(input_text, [])
+
+    def predict_stream(
+        self, model, message, history, context=None, user_context=None
+    ):
+        model.change_config(self.config)
+        input_text = self.prompt(model, message, history, context, user_context)
+        # Timed by the consumer, which knows when it waits for the model
+        return model.predict_stream(input_text, [])
+
+    async def apredict(
+        self, model, message, history, context=None, user_context=None
+    ):
+        model.change_config(self.config)
+        # Counting tokens is CPU work, kept off the event loop
+        input_text = await asyncio.to_thread(
+            self.prompt, model, message, history, context, user_context
+        )
+        with span("generation"):
+            return await model.apredict(input_text, [])
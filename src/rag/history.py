@@ -0,0 +1,165 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from monitoring.metrics import HISTORY_DROPPED_MESSAGES
+
+
+SUMMARY_TEMPLATE = """Summarize the following conversation between a user and an
+assistant in at most {words} words. Keep the facts, names and questions that
+later messages may refer to.
+
+<previous_summary>
+{summary}
+</previous_summary>
+
+<messages>
+{messages}
+</messages>"""
+
+
+def format_history(history):
+    """Renders conversation messages as text, one message per line."""
+    return "\n".join(
+        f"{message['role']}: {message['content']}" for message in history
+    )
+
+
+class HistoryManager:
+    """Keeps the conversation history sent to the model bounded.
+
+    The most recent messages are kept verbatim as long as they fit in
+    `window_tokens`. Older messages are replaced by a rolling summary, cached
+    by the content of the summarized messages. A missing summary is computed
+    in the background from the longest summary already cached for the same
+    conversation. Requests never wait for it: the previous summary is used
+    in the meantime, and the older messages it does not cover yet are left
+    out, so that the history stays within budget. They are counted in
+    `dropped` and in the metrics.
+
+    Args:
+        count_tokens (callable): Returns the number of tokens of a text.
+        window_tokens (int): Token budget of the verbatim recent messages.
+        summarize (bool): Whether older messages are summarized or dropped.
+        summary_words (int): Length of the summary asked to the model.
+        max_summaries (int): Number of summaries kept in the cache.
+    """
+
+    def __init__(
+        self,
+        count_tokens,
+        window_tokens=1000,
+        summarize=True,
+        summary_words=150,
+        max_summaries=1000,
+    ):
+        self.count_tokens = count_tokens
+        self.window_tokens = window_tokens
+        self.summarize = summarize
+        self.summary_words = summary_words
+        self.max_summaries = max_summaries
+        self.summaries = OrderedDict()
+        self.pending = set()
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="history-summary"
+        )
+
+    def window_start(self, history):
+        """Returns the index of the first message of the recent window."""
+        used = 0
+        for i in range(len(history) - 1, -1, -1):
+            used += self.count_tokens(format_history(history[i : i + 1]))
+            if used > self.window_tokens:
+                return i + 1
+        return 0
+
+    def prefix_keys(self, messages):
+        """Returns the cache keys of every prefix of a list of messages."""
+        digest = hashlib.sha256()
+        keys = []
+        for message in messages:
+            digest.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+            keys.append(digest.hexdigest())
+        return keys
+
+    def cached_summary(self, messages):
+        """Returns the longest cached summary of a prefix of the messages.
+
+        Returns:
+            tuple: The number of summarized messages and the summary, or
+                   (0, None) if none is cached.
+        """
+        keys = self.prefix_keys(messages)
+        with self.lock:
+            for length in range(len(keys), 0, -1):
+                if keys[length - 1] in self.summaries:
+                    self.summaries.move_to_end(keys[length - 1])
+                    return length, self.summaries[keys[length - 1]]
+        return 0, None
+
+    def refresh(self, model, messages):
+        """Summarizes the messages, rolling over the longest cached summary."""
+        key = self.prefix_keys(messages)[-1]
+        try:
+            length, summary = self.cached_summary(messages)
+            prompt = SUMMARY_TEMPLATE.format(
+                words=self.summary_words,
+                summary=summary or "",
+                messages=format_history(messages[length:]),
+            )
+            summary = model.predict(prompt, [])
+            with self.lock:
+                self.summaries[key] = summary
+                while len(self.summaries) > self.max_summaries:
+                    self.summaries.popitem(last=False)
+        except Exception as e:
+            print(f"An error occurred during history summarization: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def summary(self, model, messages):
+        """Returns the summary of the messages, refreshing it if needed.
+
+        Returns:
+            tuple: The number of summarized messages and the summary, or
+                   (0, None) if no summary is cached yet.
+        """
+        length, summary = self.cached_summary(messages)
+        if length < len(messages):
+            key = self.prefix_keys(messages)[-1]
+            with self.lock:
+                if key in self.pending:
+                    return length, summary
+                self.pending.add(key)
+            self.executor.submit(self.refresh, model, list(messages))
+        return length, summary
+
+    def render(self, model, history):
+        """Renders the bounded history to put in the prompt.
+
+        Args:
+            model (GenerationModel): Model used to summarize older messages.
+            history (list of dict): Conversation history.
+
+        Returns:
+            str: The summary of older messages and the recent messages.
+        """
+        start = self.window_start(history)
+        parts = []
+        if start > 0 and self.summarize:
+            length, summary = self.summary(model, history[:start])
+            if summary:
+                parts.append(f"Summary of the earlier conversation: {summary}")
+            # Messages between the summary and the window wait for the next
+            # summary, rather than exceeding the window
+            if length < start:
+                with self.lock:
+                    self.dropped += start - length
+                HISTORY_DROPPED_MESSAGES.inc(start - length)
+        parts.append(format_history(history[start:]))
+        return "\n".join(part for part in parts if part)
@@ -0,0 +1,72 @@
+def shingles(text, size=8):
+    """Returns the set of word n-grams of a text."""
+    words = text.split()
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+class ContextPacker:
+    """Selects the retrieved chunks that go into the prompt.
+
+    Hits are taken by increasing distance. Hits farther than `max_distance`,
+    or farther than the best hit by more than `max_gap`, are dropped. Chunks
+    whose text mostly overlaps already packed chunks are skipped, and chunks
+    are packed while they fit in the token budget.
+
+    Args:
+        count_tokens (callable): Returns the number of tokens of a text.
+        max_distance (float, optional): Maximum distance of a hit.
+        max_gap (float, optional): Maximum distance of a hit above the
+                                   distance of the best hit.
+        max_overlap (float): Fraction of its word 8-grams a chunk may share
+                             with the packed chunks before it is skipped.
+    """
+
+    def __init__(self, count_tokens, max_distance=None, max_gap=None, max_overlap=0.8):
+        self.count_tokens = count_tokens
+        self.max_distance = max_distance
+        self.max_gap = max_gap
+        self.max_overlap = max_overlap
+
+    def filter(self, hits):
+        """Drops the hits beyond the distance cutoffs.
+
+        Args:
+            hits (list of tuple): (item, distance) pairs, sorted by distance.
+
+        Returns:
+            list of tuple: The kept pairs.
+        """
+        if not hits:
+            return []
+        cutoff = float("inf")
+        if self.max_distance is not None:
+            cutoff = self.max_distance
+        if self.max_gap is not None:
+            cutoff = min(cutoff, hits[0][1] + self.max_gap)
+        return [(item, distance) for item, distance in hits if distance <= cutoff]
+
+    def pack(self, texts, budget):
+        """Packs texts, best first, into a token budget.
+
+        Args:
+            texts (list of str): Candidate chunks, best first.
+            budget (int): Maximum number of tokens of the packed chunks.
+
+        Returns:
+            list of str: The packed chunks, in their original order.
+        """
+        packed, seen, used = [], set(), 0
+        for text in texts:
+            text_shingles = shingles(text)
+            overlap = len(text_shingles & seen) / len(text_shingles)
+            if overlap >= self.max_overlap:
+                continue
+            tokens = self.count_tokens(text)
+            if used + tokens > budget:
+                continue
+            packed.append(text)
+            seen |= text_shingles
+            used += tokens
+        return packed
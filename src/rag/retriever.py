@@ -1,6 +1,9 @@
-import chromadb
+import numpy as np
 
-from models.embedding import get_model
+from database.collection import get_parent_chunks
+from database.registry import get_collection, get_embedding_model
+from rag.packer import ContextPacker
+from monitoring import span
 
 
 class Retriever:
@@ -9,51 +12,96 @@ class Retriever:
         self.data_path = self.config["dataset"]["CHROMA_DATA_PATH"]
         self.top_k = config["retrieval"]["TOP_K"]
         self.similarity = config["retrieval"]["SIMILARITY"]
-        client = chromadb.PersistentClient(path=self.data_path)
-        embedding_model = get_model(self.config["processing"]["EMBEDDING_MODEL"])
-
-        self.collection = client.get_or_create_collection(
-            name=collection_name,
-            embedding_function=embedding_model.embedding_function,
-            metadata={"hnsw:space": self.similarity},
+        self.fetch_multiplier = config["retrieval"].get("FETCH_MULTIPLIER", 3)
+        self.max_context_tokens = config["retrieval"].get("MAX_CONTEXT_TOKENS", 4000)
+        self.context_token_share = config["retrieval"].get("CONTEXT_TOKEN_SHARE", 0.5)
+        self.packer = ContextPacker(
+            self.count_tokens,
+            max_distance=config["retrieval"].get("MAX_DISTANCE"),
+            max_gap=config["retrieval"].get("MAX_DISTANCE_GAP"),
+            max_overlap=config["retrieval"].get("MAX_OVERLAP", 0.8),
         )
+
+        # Client and embedding model are shared, so switching collections is cheap
+        self.collection = get_collection(collection_name, config)
         if self.collection is None:
             raise ValueError("Collection not found")
 
-    def retrieve(self, query_text):
-        sub_result = self.collection.query(
-            query_texts=[query_text],
-            n_results=self.top_k * 3,
-            # include=["documents", "distances", "metadatas"],
-        )
+    @property
+    def embedding_model(self):
+        return get_embedding_model(self.config["processing"]["EMBEDDING_MODEL"])
+
+    def embed(self, query_text):
+        with span("embed_query"):
+            embedding = self.embedding_model.embedding_function([query_text])[0]
+        return np.asarray(embedding)
+
+    def count_tokens(self, text):
+        return self.embedding_model.count_tokens(text)
+
+    def context_budget(self, token_limit=None):
+        """Returns the number of tokens the retrieved context may use.
 
-        context, indexes = [], []
-        i = 0
+        Args:
+            token_limit (int, optional): Input token limit of the generation
+                                         model.
+        """
+        if token_limit is None:
+            return self.max_context_tokens
+        return min(self.max_context_tokens, int(token_limit * self.context_token_share))
 
-        while len(context) < self.top_k and i < len(sub_result["documents"][0]):
-            metadatas = sub_result["metadatas"][0][i]
+    def retrieve(self, query_text=None, query_embedding=None, token_limit=None):
+        # The query is embedded here rather than by the vector store, to time both
+        if query_embedding is None:
+            query_embedding = self.embed(query_text)
+        with span("vector_query"):
+            sub_result = self.collection.query(
+                query_embeddings=[query_embedding],
+                n_results=self.top_k * self.fetch_multiplier,
+                include=["documents", "distances", "metadatas"],
+            )
 
+        # Keep the top_k best relevant hits, one per parent chunk
+        hits = self.packer.filter(
+            list(
+                zip(
+                    zip(sub_result["documents"][0], sub_result["metadatas"][0]),
+                    sub_result["distances"][0],
+                )
+            )
+        )
+        selected, indexes = [], set()
+        for (document, metadatas), _ in hits:
+            if len(selected) >= self.top_k:
+                break
+            if "chunk" in metadatas:
+                if metadatas["chunk"] in indexes:
+                    continue
+                indexes.add(metadatas["chunk"])
+            selected.append((document, metadatas))
+        hits = selected
+
+        # Resolve all parent chunks in one batched lookup
+        with span("reassembly"):
+            parents = get_parent_chunks(self.collection, list(indexes), self.config)
+
+        context = []
+        for document, metadatas in hits:
             # Add metadatas information
             metadata_information = ""
             for key in metadatas:
-                if key not in ["from", "type", "chunk"]:
+                if key not in ["from", "type", "chunk", "page"]:
                     metadata_information += f"{key}: {metadatas[key]}\n"
             metadata_information += "\n" if metadata_information else ""
 
             # If sub chunk:
             if "chunk" in metadatas:
-                chunk_index = metadatas["chunk"]
-                if chunk_index not in indexes:
-                    subchunks = self.collection.get(where={"chunk": chunk_index})[
-                        "documents"
-                    ]
-                    context.append(metadata_information + "".join(subchunks))
-                    indexes.append(chunk_index)
+                parent, _ = parents.get(metadatas["chunk"], (document, None))
+                context.append(metadata_information + parent)
 
             # If not a not sub chunk:
             else:
-                context.append(metadata_information + sub_result["documents"][0][i])
-
-            i += 1
+                context.append(metadata_information + document)
 
-        return context
+        with span("packing"):
+            return self.packer.pack(context, self.context_budget(token_limit))
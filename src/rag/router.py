@@ -13,10 +13,17 @@ class Router:
         output = model.predict_json(input).strip()
         return self.clean_output(output)
 
-    def route_and_reformulate(self, model, query):
-        input = self.template.format(query=query)
-        output = model.predict_json(input).strip()
+    def parse_output(self, output):
+        output = output.strip()
         try:
             return json.loads(output)
         except:
             return output
+
+    def route_and_reformulate(self, model, query):
+        input = self.template.format(query=query)
+        return self.parse_output(model.predict_json(input))
+
+    async def aroute_and_reformulate(self, model, query):
+        input = self.template.format(query=query)
+        return self.parse_output(await model.apredict_json(input))
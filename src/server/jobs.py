@@ -0,0 +1,125 @@
+import os
+import time
+import uuid
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from database.progress import FileProgress, IngestionCancelled
+
+
+class Job:
+    """An ingestion job: a set of files to add to a collection.
+
+    Args:
+        collection_name (str): Name of the target collection.
+        file_paths (list of str): Paths of the files to ingest.
+    """
+
+    def __init__(self, collection_name, file_paths):
+        self.id = uuid.uuid4().hex
+        self.collection_name = collection_name
+        self.file_paths = file_paths
+        self.cancel_event = threading.Event()
+        self.files = [
+            FileProgress(os.path.basename(path), self.cancel_event)
+            for path in file_paths
+        ]
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ["done", "failed", "cancelled"]
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "collection_name": self.collection_name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "files": [progress.to_dict() for progress in self.files],
+        }
+
+
+class JobQueue:
+    """Runs ingestion jobs on a pool of background workers.
+
+    Args:
+        process_file (callable): Ingests one file, called as
+                                 `process_file(collection_name, file_path,
+                                 progress)`. It must raise IngestionCancelled
+                                 once the job is cancelled.
+        workers (int): Number of jobs processed at the same time.
+        max_finished_jobs (int): Number of finished jobs kept for status
+                                 queries.
+    """
+
+    def __init__(self, process_file, workers=2, max_finished_jobs=100):
+        self.process_file = process_file
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ingestion"
+        )
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, collection_name, file_paths):
+        """Queues the ingestion of files and returns the job immediately."""
+        job = Job(collection_name, file_paths)
+        with self.lock:
+            self._prune()
+            self.jobs[job.id] = job
+        # The job runs in the context of the request that submitted it, e.g.
+        # to keep its request ID
+        self.executor.submit(contextvars.copy_context().run, self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Requests the cancellation of a job.
+
+        Returns:
+            bool: Whether the job exists and was still running or queued.
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_event.set()
+        return True
+
+    def _prune(self):
+        finished = sorted(
+            (job for job in self.jobs.values() if job.finished),
+            key=lambda job: job.finished_at,
+        )
+        for job in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job.id]
+
+    def _run(self, job):
+        job.status = "running"
+        for file_path, progress in zip(job.file_paths, job.files):
+            progress.status = "running"
+            try:
+                self.process_file(job.collection_name, file_path, progress)
+                progress.status = "done"
+            except IngestionCancelled:
+                progress.status = "cancelled"
+            except Exception as e:
+                print(f"An error occurred during processing of {file_path}: {e}")
+                progress.record_failure(str(e))
+                progress.status = "failed"
+
+        statuses = [progress.status for progress in job.files]
+        job.finished_at = time.time()
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+        elif "failed" in statuses:
+            job.status = "failed"
+        else:
+            job.status = "done"
@@ -1,20 +1,47 @@
 import os
 import sys
+import json
+import time
+import uuid
+import shutil
 import subprocess
 from typing import List, Dict
 from pydantic import BaseModel
 
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 import yaml
-import chromadb
 
 sys.path.append("./src/")
 
 # local module imports
-from models.generation import get_model_by_name, get_model_names
-from models.embedding import get_model
+from models.generation import get_model_by_name, get_model_names, scheduler
+from database.registry import drop_collection, get_collection, get_embedding_model
+from database.docstore import (
+    STAGING_FOLDER,
+    discard_staged,
+    get_content_store,
+    get_manifest,
+    get_parent_store,
+    get_sequence_allocator,
+    ingest_staged,
+    staging_path,
+)
 from agents.agent import Agent, list_agents
+from rag import Retriever, SemanticCache
+from database.doc_processing import file_hash
+from server.jobs import JobQueue
+from server.uploads import (
+    UploadError,
+    UploadOffsetMismatch,
+    UploadSessions,
+    UploadTooLarge,
+    copy_stream,
+)
+from monitoring import get_request_id, registry, request_context
+from monitoring.metrics import REQUEST_SECONDS, STAGE_SECONDS
 
 
 load_dotenv()
@@ -27,15 +54,111 @@ with open("src/configs/config.yaml", "r", encoding="utf-8") as config_file:
 
 CHROMA_DATA_PATH = config["dataset"]["CHROMA_DATA_PATH"]
 UPLOAD_FOLDER = os.path.join(CHROMA_DATA_PATH, "upload/")
+MAX_UPLOAD_SIZE = config["upload"]["MAX_FILE_SIZE_MB"] * 1024**2
+UPLOAD_BLOCK_SIZE = config["upload"]["BLOCK_SIZE_KB"] * 1024
+UPLOAD_PART_SIZE = config["upload"]["PART_SIZE_MB"] * 1024**2
 MODEL_FOLDER = config["generation"]["MODEL_FOLDER"]
 DEFAULT_MODEL = config["generation"]["LLM"]
 DEFAULT_AGENT = config["agent"]["AGENT"]
 COLL_NAME = config["dataset"]["COLLECTION_NAME"]
 EMB_MODEL_NAME = config["processing"]["EMBEDDING_MODEL"]
-SIMILARITY = config["retrieval"]["SIMILARITY"]
-client = chromadb.PersistentClient(path=CHROMA_DATA_PATH)
-embedding_function = get_model(EMB_MODEL_NAME).embedding_function
+embedding_function = get_embedding_model(EMB_MODEL_NAME).embedding_function
 agent = Agent(config)
+answer_cache = SemanticCache(
+    threshold=config["cache"]["SIMILARITY_THRESHOLD"],
+    ttl=config["cache"]["TTL"],
+    max_entries=config["cache"]["MAX_ENTRIES"],
+    history_policy=config["cache"]["HISTORY_POLICY"],
+)
+
+
+def ingest_file(collection_name, file_path, progress):
+    """
+    Ingests one uploaded file into a collection. Runs on the ingestion
+    workers of the job queue.
+
+    The file waits in the staging folder, and only moves to the upload folder
+    of the collection once ingested: a failed or cancelled re-upload leaves
+    the previous version of the file in place.
+
+    Args:
+        collection_name (str): The name of the target collection.
+        file_path (str): The staged path of the uploaded file.
+        progress (FileProgress): The progress tracker of the file.
+    """
+    collection = get_collection(collection_name, config)
+    destination = os.path.join(
+        UPLOAD_FOLDER, collection_name, os.path.basename(file_path)
+    )
+    with request_context(get_request_id()):
+        try:
+            ingest_staged(
+                file_path,
+                destination,
+                lambda path: agent.processing_function(
+                    collection, path, config, progress
+                ),
+            )
+        finally:
+            answer_cache.bump(collection_name)
+
+
+jobs = JobQueue(ingest_file, workers=config["processing"].get("INGESTION_WORKERS", 2))
+uploads = UploadSessions(
+    os.path.join(CHROMA_DATA_PATH, "pending_uploads"),
+    max_size=MAX_UPLOAD_SIZE,
+    block_size=UPLOAD_BLOCK_SIZE,
+    ttl=config["upload"]["PENDING_TTL"],
+)
+# Files staged for the jobs of a previous run, lost with it
+shutil.rmtree(os.path.join(CHROMA_DATA_PATH, STAGING_FOLDER), ignore_errors=True)
+
+registry.gauge(
+    "rag_llm_queue_depth",
+    "Model calls waiting for admission by the rate limiter.",
+    lambda: {
+        (priority,): depth
+        for priority, depth in scheduler.stats()["queue_depth"].items()
+    },
+    labels=("priority",),
+)
+registry.gauge(
+    "rag_answer_cache_entries",
+    "Answers held by the semantic answer cache.",
+    lambda: {(): answer_cache.stats()["size"]},
+)
+
+
+@app.middleware("http")
+async def track_request(request: Request, call_next):
+    """
+    Tags the request with the `X-Request-ID` sent by the client (or a new
+    one), so that its spans and logs can be correlated, and records its
+    duration.
+    """
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    start = time.perf_counter()
+    with request_context(request_id):
+        response = await call_next(request)
+    duration = time.perf_counter() - start
+    # Labelled by route template, so that paths sent by clients do not each
+    # add a series
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint, status=response.status_code)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Exports the latency histograms, counters and gauges of the backend in
+    the Prometheus text format.
+    """
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4"
+    )
 
 
 def give_permissions(folder):
@@ -121,11 +244,64 @@ class GenerationInput(BaseModel):
     user_context: List[str]
 
 
+def lookup_answer(body):
+    """
+    Looks up the semantic answer cache for a generation request.
+
+    Args:
+        body (GenerationInput): The generation request.
+
+    Returns:
+        tuple: The cached answer (or None), and the key to store the answer
+               with: the query embedding and the collection generation. Both
+               are None if the cache is disabled or the history policy
+               excludes the request, without embedding the query.
+    """
+    if not config["cache"]["ENABLED"] or not answer_cache.cacheable(body.history):
+        return None, None
+    generation = answer_cache.generation(body.collection_name)
+    embedding = embedding_function([body.prompt_user])[0]
+    cached = answer_cache.lookup(
+        body.collection_name,
+        config["agent"]["AGENT"],
+        body.model_name,
+        embedding,
+        body.history,
+    )
+    return cached, (embedding, generation)
+
+
+def store_answer(body, key, answer):
+    """
+    Stores the answer to a generation request in the semantic answer cache.
+
+    Args:
+        body (GenerationInput): The generation request.
+        key (tuple): The key returned by `lookup_answer`.
+        answer (dict): The answer, with its output, context and user context.
+    """
+    if key is None:
+        return
+    embedding, generation = key
+    answer_cache.store(
+        body.collection_name,
+        config["agent"]["AGENT"],
+        body.model_name,
+        embedding,
+        body.history,
+        answer,
+        generation,
+    )
+
+
 @app.post("/generate-response/")
-def generate_response(body: GenerationInput):
+async def generate_response(body: GenerationInput):
     """
     Generates a response using a specified language model and context.
 
+    The model calls are awaited, and the blocking embedding and ChromaDB work
+    runs in worker threads, so a worker process serves many chats at once.
+
     Args:
         body (GenerationInput): The request body containing generation
                                 parameters including model name, collection name,
@@ -136,13 +312,91 @@ def generate_response(body: GenerationInput):
         dict: A dictionary containing the generated output, the retrieved
               context, and the updated user context.
     """
+    cached, key = await run_in_threadpool(lookup_answer, body)
+    if cached:
+        return {**cached, "user_context": body.user_context}
+
     model = get_model_by_name(name=body.model_name, api_key=GOOGLE_API_KEY)
-    agent.update_collection(body.collection_name, config)
-    output, context, user_context = agent.predict(
-        model, body.prompt_user, body.history, body.user_context
+    # The agent is shared by concurrent requests: each one retrieves from
+    # its own collection
+    retriever = await run_in_threadpool(Retriever, body.collection_name, config)
+    output, context, user_context = await agent.apredict(
+        model, body.prompt_user, body.history, body.user_context, retriever=retriever
     )
 
-    return {"output": output, "context": context, "user_context": user_context}
+    answer = {"output": output, "context": context, "user_context": user_context}
+    store_answer(body, key, answer)
+    return answer
+
+
+@app.post("/generate-response-stream/")
+def generate_response_stream(body: GenerationInput):
+    """
+    Generates a response like `/generate-response/`, but streams it.
+
+    The response is newline-delimited JSON: one `{"token": ...}` line per
+    piece of the answer as soon as the model produces it, then a final
+    `{"context": ..., "user_context": ...}` line.
+
+    Args:
+        body (GenerationInput): The request body containing generation
+                                parameters.
+
+    Returns:
+        StreamingResponse: The streamed answer.
+    """
+    cached, key = lookup_answer(body)
+    if cached:
+        tokens = [cached["output"]]
+        context, user_context = cached["context"], body.user_context
+    else:
+        model = get_model_by_name(name=body.model_name, api_key=GOOGLE_API_KEY)
+        tokens, context, user_context = agent.predict_stream(
+            model,
+            body.prompt_user,
+            body.history,
+            body.user_context,
+            retriever=Retriever(body.collection_name, config),
+        )
+
+    def events():
+        output = ""
+        pieces = iter(tokens)
+        # Only the time spent waiting for the model counts as generation,
+        # not the time the client takes to read the pieces
+        generation_time, first = 0.0, True
+        while True:
+            start = time.perf_counter()
+            token = next(pieces, None)
+            generation_time += time.perf_counter() - start
+            if token is None:
+                break
+            if first and not cached:
+                STAGE_SECONDS.observe(generation_time, stage="first_token")
+            first = False
+            output += token
+            yield json.dumps({"token": token}) + "\n"
+        if not cached:
+            STAGE_SECONDS.observe(generation_time, stage="generation")
+        yield json.dumps({"context": context, "user_context": user_context}) + "\n"
+
+        if not cached:
+            answer = {
+                "output": output,
+                "context": context,
+                "user_context": user_context,
+            }
+            store_answer(body, key, answer)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+def link_known_content(staged_path):
+    """
+    Replaces a staged upload by a link to the content store when the same
+    content was already ingested, so that it is kept on disk once.
+    """
+    get_content_store(config).link(file_hash(staged_path), staged_path)
 
 
 @app.post("/upload/")
@@ -151,35 +405,224 @@ async def upload_files(
 ):
     """
     Uploads document files (e.g., PDF files) to a specified collection
-    and processes them for indexing.
+    and queues them for indexing.
+
+    The files are written to disk block by block, and files larger than the
+    configured maximum size are rejected. For large files, prefer the
+    resumable `/upload/init/` protocol.
+
+    The files are processed in the background by the ingestion job queue;
+    use `/job-status/` to follow their progress.
 
     Args:
         files (List[UploadFile]): A list of uploaded files.
         collection_name (str): The name of the collection where files will be
                                stored and indexed.
 
-    Raises:
-        Exception: If an error occurs during file processing.
+    Returns:
+        dict: A dictionary containing the ID of the ingestion job.
     """
-    collection = client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=embedding_function,
-        metadata={"hnsw:space": SIMILARITY},
-    )
+    os.makedirs(os.path.join(UPLOAD_FOLDER, collection_name), exist_ok=True)
+    staged_paths = []
+    try:
+        for file in files:
+            if file.filename != "":
+                path = staging_path(config, os.path.basename(file.filename))
+                staged_paths.append(path)
+                await run_in_threadpool(
+                    copy_stream,
+                    file.file,
+                    path,
+                    MAX_UPLOAD_SIZE,
+                    block_size=UPLOAD_BLOCK_SIZE,
+                )
+    except UploadTooLarge as e:
+        for path in staged_paths:
+            discard_staged(path)
+        raise HTTPException(status_code=413, detail=f"{file.filename}: {e}")
+
+    for path in staged_paths:
+        await run_in_threadpool(link_known_content, path)
+    job = jobs.submit(collection_name, staged_paths)
+    return {"job_id": job.id}
+
+
+class UploadInitInput(BaseModel):
+    """
+    Represents the input structure for opening a resumable upload.
+
+    Attributes:
+        collection_name (str): The name of the target collection.
+        filename (str): The name of the uploaded file.
+        size (int): The size of the file, in bytes.
+    """
+    collection_name: str
+    filename: str
+    size: int
+
+
+class UploadInput(BaseModel):
+    """
+    Represents the input structure for operations on a resumable upload.
+
+    Attributes:
+        upload_id (str): The ID of the upload.
+    """
+    upload_id: str
+
+
+def upload_session(upload_id):
+    session = uploads.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+    return session
+
+
+@app.post("/upload/init/")
+def upload_init(body: UploadInitInput):
+    """
+    Opens a resumable upload. The file is then sent in parts with
+    `/upload/part/`, and `/upload/commit/` queues it for indexing.
+
+    Args:
+        body (UploadInitInput): The target collection, file name and size.
+
+    Returns:
+        dict: The upload session, with its ID and the number of bytes
+              received so far.
+    """
+    try:
+        session = uploads.init(
+            body.collection_name, os.path.basename(body.filename), body.size
+        )
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {**session, "part_size": UPLOAD_PART_SIZE}
+
+
+@app.post("/upload/part/")
+async def upload_part(
+    upload_id: str = Form(...), offset: int = Form(...), part: UploadFile = File(...)
+):
+    """
+    Appends a part to a resumable upload. A part may overlap the data already
+    received, e.g. when it is retried after a dropped connection.
+
+    Args:
+        upload_id (str): The ID of the upload.
+        offset (int): The position of the part in the file.
+        part (UploadFile): The part.
+
+    Returns:
+        dict: The number of bytes received so far. On a 409 error, the
+              detail gives the position where the next part must start.
+    """
+    upload_session(upload_id)
+    try:
+        received = await run_in_threadpool(uploads.append, upload_id, offset, part.file)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Upload not found: {upload_id}")
+    except UploadOffsetMismatch as e:
+        raise HTTPException(status_code=409, detail={"received": e.received})
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return {"upload_id": upload_id, "received": received}
+
+
+@app.post("/upload/status/")
+def upload_status(body: UploadInput):
+    """
+    Reports how much of a resumable upload was received, to resume it.
+
+    Args:
+        body (UploadInput): The request body containing the upload ID.
+
+    Returns:
+        dict: The upload session, with the number of bytes received.
+    """
+    return upload_session(body.upload_id)
 
-    for file in files:
-        if file.filename != "":
-            pdf_path = os.path.join(UPLOAD_FOLDER, collection_name, file.filename)
-            content = await file.read()
-            os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-            with open(pdf_path, mode="wb") as w:
-                w.write(content)
 
-            try:
-                agent.processing_function(collection, pdf_path, config)
-            except Exception as e:
-                os.remove(pdf_path)
-                raise Exception(f"An error occurred during processing: {e}") from e
+@app.post("/upload/commit/")
+def upload_commit(body: UploadInput):
+    """
+    Completes a resumable upload and queues the file for indexing.
+
+    Args:
+        body (UploadInput): The request body containing the upload ID.
+
+    Returns:
+        dict: A dictionary containing the ID of the ingestion job.
+    """
+    try:
+        session, path = uploads.commit(body.upload_id)
+    except KeyError:
+        raise HTTPException(
+            status_code=404, detail=f"Upload not found: {body.upload_id}"
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    os.makedirs(os.path.join(UPLOAD_FOLDER, session["collection_name"]), exist_ok=True)
+    staged_path = staging_path(config, session["filename"])
+    os.replace(path, staged_path)
+    link_known_content(staged_path)
+    job = jobs.submit(session["collection_name"], [staged_path])
+    return {"job_id": job.id}
+
+
+@app.post("/upload/abort/")
+def upload_abort(body: UploadInput):
+    """
+    Abandons a resumable upload and removes the data received.
+
+    Args:
+        body (UploadInput): The request body containing the upload ID.
+    """
+    uploads.abort(body.upload_id)
+
+
+class JobInput(BaseModel):
+    """
+    Represents the input structure for operations on an ingestion job.
+
+    Attributes:
+        job_id (str): The ID of the ingestion job.
+    """
+    job_id: str
+
+
+@app.post("/job-status/")
+def job_status(body: JobInput):
+    """
+    Reports the progress of an ingestion job.
+
+    Args:
+        body (JobInput): The request body containing the job ID.
+
+    Returns:
+        dict: The job status and, for each file, its status, the number of
+              pages extracted, the number of chunks embedded and the
+              failures encountered.
+    """
+    job = jobs.get(body.job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {body.job_id}")
+    return job.to_dict()
+
+
+@app.post("/cancel-job/")
+def cancel_job(body: JobInput):
+    """
+    Cancels an ingestion job. Files not yet ingested are skipped, and the
+    chunks of the file being ingested are removed.
+
+    Args:
+        body (JobInput): The request body containing the job ID.
+
+    Returns:
+        dict: Whether a running or queued job was cancelled.
+    """
+    return {"cancelled": jobs.cancel(body.job_id)}
 
 
 class DeleteInput(BaseModel):
@@ -199,48 +642,48 @@ class DeleteInput(BaseModel):
 def delete_files(body: DeleteInput):
     """
     Deletes specified files from a collection and removes their
-    corresponding entries from the ChromaDB collection.
+    corresponding entries from the vector store, using the chunk IDs
+    recorded in the file manifest.
 
     Args:
         body (DeleteInput): The request body containing the list of files to
                             delete and the collection name.
     """
-    collection = client.get_or_create_collection(
-        name=body.collection_name,
-        embedding_function=embedding_function,
-        metadata={"hnsw:space": SIMILARITY},
-    )
+    collection = get_collection(body.collection_name, config)
 
     for file in body.files:
         file_path = os.path.join(UPLOAD_FOLDER, body.collection_name, file)
         if os.path.exists(file_path):
             os.remove(file_path)
 
-    elements = collection.get()
-    ids_to_remove = [
-        id
-        for id, metadata in zip(elements["ids"], elements["metadatas"])
-        if metadata.get("from") in body.files
-    ]
+    manifest = get_manifest(config)
+    records = manifest.get(body.collection_name, body.files)
+    ids_to_remove = [id for record in records.values() for id in record["ids"]]
     if ids_to_remove:
         collection.delete(ids=ids_to_remove)
 
+    # Files ingested before the manifest existed
+    unknown_files = [file for file in body.files if file not in records]
+    if unknown_files:
+        collection.delete(where={"from": {"$in": unknown_files}})
+
+    manifest.delete(body.collection_name, body.files)
+    get_parent_store(config).delete(body.collection_name, body.files)
+    get_content_store(config).remove(body.collection_name, body.files)
+    answer_cache.bump(body.collection_name)
+
 
 @app.post("/delete-collection/")
 def delete_collection(body: DeleteInput):
     """
     Deletes an entire collection, including all files within its associated
-    folder and the collection itself from the ChromaDB database.
+    folder and the collection itself from the vector store.
 
     Args:
         body (DeleteInput): The request body containing the name of the
                             collection to delete.
     """
-    collection = client.get_or_create_collection(
-        name=body.collection_name,
-        embedding_function=embedding_function,
-        metadata={"hnsw:space": SIMILARITY},
-    )
+    collection = get_collection(body.collection_name, config)
 
     folder_path = os.path.join(UPLOAD_FOLDER, body.collection_name)
     if os.path.exists(folder_path):
@@ -251,7 +694,12 @@ def delete_collection(body: DeleteInput):
     ids = collection.get()["ids"]
     if ids:
         collection.delete(ids=ids)
-    client.delete_collection(body.collection_name)
+    drop_collection(body.collection_name, config)
+    get_parent_store(config).delete(body.collection_name)
+    get_sequence_allocator(config).reset(body.collection_name)
+    get_manifest(config).delete(body.collection_name)
+    get_content_store(config).remove(body.collection_name)
+    answer_cache.bump(body.collection_name)
 
 
 class CollectionInput(BaseModel):
@@ -271,7 +719,7 @@ def create_collection(body: CollectionInput):
 
     If the folder for the new collection does not exist, it will be created
     and appropriate permissions will be set. The collection will also be
-    initialized in ChromaDB.
+    initialized in the vector store.
 
     Args:
         body (CollectionInput): The request body containing the name of the
@@ -282,11 +730,7 @@ def create_collection(body: CollectionInput):
         os.makedirs(folder_path)
         give_permissions(folder_path)
 
-    client.create_collection(
-        name=body.collection_name,
-        embedding_function=embedding_function,
-        metadata={"hnsw:space": SIMILARITY},
-    )
+    get_collection(body.collection_name, config)
 
 
 @app.post("/get-names/")
@@ -327,7 +771,8 @@ def get_names():
 @app.post("/list-files/")
 def list_files(body: CollectionInput):
     """
-    Lists all files within a specified collection's upload folder.
+    Lists all files within a specified collection's upload folder, with
+    their statistics from the file manifest.
 
     Args:
         body (CollectionInput): The request body containing the name of the
@@ -335,15 +780,27 @@ def list_files(body: CollectionInput):
 
     Returns:
         dict: A dictionary containing a list of filenames within the
-              specified folder.
+              specified folder, and a mapping from filename to its chunk
+              count, page range and content hash.
     """
     folder_path = os.path.join(UPLOAD_FOLDER, body.collection_name)
     files_list = []
     if os.path.exists(folder_path) and os.path.isdir(folder_path):
         files_list = os.listdir(folder_path)
 
+    files_stats = {
+        record["file"]: {
+            "chunk_count": record["chunk_count"],
+            "first_page": record["first_page"],
+            "last_page": record["last_page"],
+            "content_hash": record["content_hash"],
+        }
+        for record in get_manifest(config).list(body.collection_name)
+    }
+
     return {
         "files_list": files_list,
+        "files_stats": files_stats,
     }
 
 
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+
+class UploadError(Exception):
+    """Base class of the errors of an upload, reported to the client."""
+
+
+class UploadTooLarge(UploadError):
+    """Raised when an upload exceeds the maximum file size."""
+
+
+class UploadOffsetMismatch(UploadError):
+    """Raised when a part does not start where the upload stopped.
+
+    Args:
+        received (int): Number of bytes received so far, where the next part
+                        must start.
+    """
+
+    def __init__(self, received):
+        super().__init__(f"Upload part must start at byte {received}")
+        self.received = received
+
+
+def copy_stream(source, destination, max_size, block_size=1 << 20, offset=0):
+    """Copies a file object to disk block by block, never holding more than
+    one block in memory.
+
+    Args:
+        source: Readable binary file object.
+        destination (str): Path of the written file. It is appended to when
+                           `offset` is not 0.
+        max_size (int): Maximum size of the destination file, in bytes.
+        block_size (int): Number of bytes read and written at a time.
+        offset (int): Size of the destination file before the copy.
+
+    Returns:
+        int: The size of the destination file.
+
+    Raises:
+        UploadTooLarge: If the file would exceed `max_size`. The destination
+                        is truncated back to `offset`.
+    """
+    size = offset
+    with open(destination, "ab" if offset else "wb") as file:
+        while block := source.read(block_size):
+            size += len(block)
+            if size > max_size:
+                file.truncate(offset)
+                raise UploadTooLarge(
+                    f"File exceeds the maximum upload size of {max_size} bytes"
+                )
+            file.write(block)
+    return size
+
+
+class UploadSessions:
+    """Resumable uploads, sent as a sequence of parts and then committed.
+
+    Sessions live on disk, as the data received so far and a JSON sidecar,
+    so that a dropped connection or a server restart only loses the part in
+    flight: the client asks how many bytes were received and resumes from
+    there. Abandoned sessions are removed after `ttl` seconds.
+
+    Args:
+        folder (str): Folder of the pending uploads.
+        max_size (int): Maximum size of an uploaded file, in bytes.
+        block_size (int): Number of bytes written to disk at a time.
+        ttl (float): Lifetime of an inactive session, in seconds.
+    """
+
+    def __init__(self, folder, max_size, block_size=1 << 20, ttl=86400):
+        self.folder = folder
+        self.max_size = max_size
+        self.block_size = block_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.session_locks = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def data_path(self, upload_id):
+        return os.path.join(self.folder, f"{upload_id}.part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.folder, f"{upload_id}.json")
+
+    def _session_lock(self, upload_id):
+        with self.lock:
+            return self.session_locks.setdefault(upload_id, threading.Lock())
+
+    def init(self, collection_name, filename, size):
+        """Opens an upload session.
+
+        Args:
+            collection_name (str): Name of the target collection.
+            filename (str): Name of the uploaded file.
+            size (int): Total size of the file, in bytes.
+
+        Returns:
+            dict: The session, with its "upload_id" and "received" bytes.
+        """
+        if size > self.max_size:
+            raise UploadTooLarge(
+                f"File exceeds the maximum upload size of {self.max_size} bytes"
+            )
+        self.prune()
+        session = {
+            "upload_id": uuid.uuid4().hex,
+            "collection_name": collection_name,
+            "filename": filename,
+            "size": size,
+            "created_at": time.time(),
+        }
+        open(self.data_path(session["upload_id"]), "wb").close()
+        with open(self._meta_path(session["upload_id"]), "w") as file:
+            json.dump(session, file)
+        return self.get(session["upload_id"])
+
+    def get(self, upload_id):
+        """Returns a session with its number of received bytes, or None."""
+        # IDs are generated hex strings, anything else is not a session
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as file:
+                session = json.load(file)
+            session["received"] = os.path.getsize(self.data_path(upload_id))
+        except (OSError, ValueError):
+            return None
+        return session
+
+    def append(self, upload_id, offset, source):
+        """Appends a part to an upload.
+
+        A part starting before the end of the received data is a retry: the
+        bytes already received are skipped.
+
+        Args:
+            upload_id (str): ID of the session.
+            offset (int): Position of the part in the file.
+            source: Readable binary file object with the part.
+
+        Returns:
+            int: The number of bytes received so far.
+
+        Raises:
+            KeyError: If the session does not exist.
+            UploadOffsetMismatch: If the part starts after the received data.
+            UploadTooLarge: If the part goes beyond the announced size.
+        """
+        with self._session_lock(upload_id):
+            session = self.get(upload_id)
+            if session is None:
+                raise KeyError(upload_id)
+            received = session["received"]
+            if offset > received:
+                raise UploadOffsetMismatch(received)
+            source.seek(received - offset, os.SEEK_CUR)
+            received = copy_stream(
+                source,
+                self.data_path(upload_id),
+                session["size"],
+                block_size=self.block_size,
+                offset=received,
+            )
+            os.utime(self._meta_path(upload_id))
+            return received
+
+    def commit(self, upload_id):
+        """Closes a complete upload.
+
+        Returns:
+            tuple: The session and the path of the received file, which the
+                   caller moves to its destination.
+
+        Raises:
+            KeyError: If the session does not exist.
+            UploadError: If the upload is incomplete.
+        """
+        with self._session_lock(upload_id):
+            session = self.get(upload_id)
+            if session is None:
+                raise KeyError(upload_id)
+            if session["received"] != session["size"]:
+                raise UploadError(
+                    f"Upload incomplete: {session['received']} of "
+                    f"{session['size']} bytes received"
+                )
+            os.remove(self._meta_path(upload_id))
+        with self.lock:
+            self.session_locks.pop(upload_id, None)
+        return session, self.data_path(upload_id)
+
+    def abort(self, upload_id):
+        """Removes a session and its data."""
+        with self._session_lock(upload_id):
+            for path in [self._meta_path(upload_id), self.data_path(upload_id)]:
+                if upload_id.isalnum() and os.path.exists(path):
+                    os.remove(path)
+        with self.lock:
+            self.session_locks.pop(upload_id, None)
+
+    def prune(self):
+        """Removes the data of the sessions inactive for more than `ttl`
+        seconds, and the data of committed sessions left behind."""
+        now = time.time()
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                continue
@@ -0,0 +1 @@
+from storage.sqlite import MAX_SQL_PARAMETERS, SQLiteStore, batched
@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import threading
+
+
+# SQLite refuses statements with more than 999 host parameters on old builds.
+MAX_SQL_PARAMETERS = 900
+
+
+class SQLiteStore(object):
+    """Main class for the SQLite side stores kept next to the ChromaDB data.
+    Args:
+    - path (str): path of the SQLite database file
+    """
+
+    schema = ""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.schema)
+        self.connection.commit()
+
+
+def batched(items, size=MAX_SQL_PARAMETERS):
+    """Yields successive slices of at most `size` elements from a list."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
@@ -21,18 +21,52 @@ python unit.py RAGTest.testApp
 """
 
 import unittest
+import asyncio
+import io
 import os
 import sys
+import tempfile
+import threading
+import time
 import yaml
+import numpy as np
 from dotenv import load_dotenv
 
 import chromadb
+from google.api_core.exceptions import ResourceExhausted
 
 sys.path.append("./src/")
 
 from models.embedding import Multilingual
 from models.generation import GeminiFlash
-from database.doc_processing import process
+from models.fake import FakeModel
+from models.scheduler import INGESTION, INTERACTIVE, LLMScheduler, llm_priority
+from models.embedding_cache import CachedEmbeddingFunction
+from database.doc_processing import process, extract_images
+from database.chunking import iter_chunks, iter_sub_chunks
+from database.collection import iter_grouped_chunks
+from database.pdf_text import iter_page_texts
+from database.bulk_ingest import Checkpoint
+from database.vector_store import NumpyVectorStore, VectorStore
+from rag import ContextPacker, Generator, HistoryManager, SemanticCache
+from rag.history import format_history
+from server.jobs import JobQueue
+from server.uploads import UploadOffsetMismatch, UploadSessions, UploadTooLarge
+from monitoring import request_context, span
+from monitoring.metrics import (
+    ANSWER_CACHE_LOOKUPS,
+    HISTORY_DROPPED_MESSAGES,
+    MetricsRegistry,
+)
+from database.docstore import (
+    ContentStore,
+    FileManifest,
+    ParentChunkStore,
+    SequenceAllocator,
+    get_parent_store,
+    ingest_staged,
+    staging_path,
+)
 
 
 TEST_FILE = "data/test/unit/unit_paper.pdf"
@@ -127,6 +161,636 @@ class RAGTest(unittest.TestCase):
         self.assertFalse(0 in list(set([m["chunk"] for m in metadatas_doc_2])))
 
 
+class DocstoreTest(unittest.TestCase):
+    def testParentChunkStore(self):
+        path = os.path.join(tempfile.mkdtemp(), "docstore.sqlite3")
+        store = ParentChunkStore(path, cache_size=1)
+        store.add(
+            "unit",
+            [0, 1],
+            ["First chunk", "Second chunk"],
+            [{"from": "a.pdf", "type": "text"}, {"from": "b.pdf", "type": "text"}],
+        )
+
+        parents = store.get("unit", [1, 0, 1, 2])
+        self.assertEqual(parents[0][0], "First chunk")
+        self.assertEqual(parents[1][1]["from"], "b.pdf")
+        self.assertNotIn(2, parents)
+        self.assertEqual(len(store.cache), 1)
+
+        store.delete("unit", ["a.pdf"])
+        self.assertEqual(list(store.get("unit", [0, 1])), [1])
+        store.delete("unit")
+        self.assertEqual(store.get("unit", [0, 1]), {})
+
+    def testGroupedChunks(self):
+        folder = tempfile.mkdtemp()
+        config = {"dataset": {"CHROMA_DATA_PATH": folder}, "retrieval": {}}
+        collection = NumpyVectorStore(folder, "unit")
+        # Sub-chunks of two files ingested concurrently, interleaved
+        elements = [
+            ("a0", 0, "a.pdf"),
+            ("b0", 1, "b.pdf"),
+            ("a1", 0, "a.pdf"),
+            ("c", None, "c.pdf"),
+            ("b1", 1, "b.pdf"),
+            ("a2", 0, "a.pdf"),
+        ]
+        metadatas = [
+            {"from": file} if index is None else {"from": file, "chunk": index}
+            for _, index, file in elements
+        ]
+        collection.add(
+            ids=[f"id{i}" for i in range(len(elements))],
+            embeddings=np.eye(len(elements)),
+            documents=[document for document, _, _ in elements],
+            metadatas=metadatas,
+        )
+        get_parent_store(config).add("unit", [1], ["b0b1"], [{"from": "b.pdf"}])
+
+        chunks = list(iter_grouped_chunks(collection, config, batch_size=2))
+        self.assertEqual(
+            chunks,
+            [
+                ("a0a1a2", {"from": "a.pdf"}),
+                ("b0b1", {"from": "b.pdf"}),
+                ("c", {"from": "c.pdf"}),
+            ],
+        )
+
+    def testSequenceAllocator(self):
+        path = os.path.join(tempfile.mkdtemp(), "docstore.sqlite3")
+        allocator = SequenceAllocator(path)
+        seed = lambda: {"id": 5, "chunk": 2}
+
+        first = allocator.allocate("unit", {"id": 10, "chunk": 3}, seed=seed)
+        second = allocator.allocate("unit", {"id": 4, "chunk": 1}, seed=seed)
+
+        self.assertEqual(first, {"id": 5, "chunk": 2})
+        self.assertEqual(second, {"id": 15, "chunk": 5})
+        allocator.reset("unit")
+        self.assertEqual(allocator.allocate("unit", {"id": 1}), {"id": 0})
+
+    def testFileManifest(self):
+        path = os.path.join(tempfile.mkdtemp(), "docstore.sqlite3")
+        manifest = FileManifest(path)
+        manifest.add("unit", "a.pdf", ["id0", "id1"], 1, 3, "hash")
+        manifest.add("unit", "a.pdf", ["id5"], 1, 3, "hash")
+        manifest.add("unit", "b.pdf", ["id2"], 1, 1, "other")
+
+        records = manifest.get("unit", ["a.pdf", "c.pdf"])
+        self.assertEqual(list(records), ["a.pdf"])
+        self.assertEqual(records["a.pdf"]["ids"], ["id0", "id1", "id5"])
+        self.assertEqual(records["a.pdf"]["chunk_count"], 3)
+
+        manifest.delete("unit", ["a.pdf"])
+        self.assertEqual([r["file"] for r in manifest.list("unit")], ["b.pdf"])
+
+    def testPageRecords(self):
+        path = os.path.join(tempfile.mkdtemp(), "docstore.sqlite3")
+        manifest = FileManifest(path)
+        pages = [
+            {"page": 2, "fingerprint": "b", "ids": ["id1"], "chunks": [1]},
+            {"page": 1, "fingerprint": "a", "ids": ["id0"], "chunks": [0]},
+        ]
+        manifest.replace("unit", "a.pdf", ["id0", "id1"], 1, 2, "hash", pages)
+        manifest.replace("unit", "a.pdf", ["id0"], 1, 1, "hash", pages[1:])
+
+        self.assertEqual(manifest.get("unit", ["a.pdf"])["a.pdf"]["ids"], ["id0"])
+        self.assertEqual(manifest.get_pages("unit", "a.pdf"), pages[1:])
+        manifest.replace("unit", "a.pdf", ["id0", "id1"], 1, 2, "hash", pages)
+        records = manifest.get_pages("unit", "a.pdf")
+        self.assertEqual([record["page"] for record in records], [1, 2])
+
+        manifest.delete("unit", ["a.pdf"])
+        self.assertEqual(manifest.get_pages("unit", "a.pdf"), [])
+
+    def testContentStore(self):
+        folder = tempfile.mkdtemp()
+        store = ContentStore(os.path.join(folder, "docstore.sqlite3"), folder)
+        path = os.path.join(folder, "a.pdf")
+        with open(path, "wb") as file:
+            file.write(b"content")
+
+        store.add("first", "a.pdf", path, "hash", "settings")
+        store.add("second", "b.pdf", path, "hash", "settings")
+        store.add("second", "b.pdf", path, "hash", "settings")
+        self.assertEqual(store.refs("hash"), 2)
+        self.assertEqual(
+            store.find("hash", "settings", exclude=("first", "a.pdf")),
+            [("second", "b.pdf")],
+        )
+        self.assertEqual(store.find("hash", "other"), [])
+
+        copy = os.path.join(folder, "c.pdf")
+        self.assertTrue(store.link("hash", copy))
+        store.remove("first")
+        self.assertTrue(os.path.exists(store.content_path("hash")))
+        store.remove("second", ["b.pdf"])
+        self.assertEqual(store.refs("hash"), 0)
+        self.assertFalse(os.path.exists(store.content_path("hash")))
+        self.assertFalse(store.link("hash", copy))
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def testCachedEmbeddingFunction(self):
+        calls = []
+
+        def embedding_function(texts):
+            calls.append(list(texts))
+            return [[float(len(text)), 1.0] for text in texts]
+
+        path = os.path.join(tempfile.mkdtemp(), "embedding_cache.sqlite3")
+        cache = CachedEmbeddingFunction(embedding_function, "unit", path, memory_size=2)
+
+        first = cache(["a", "bb", "a"])
+        self.assertEqual(calls, [["a", "bb"]])
+        self.assertEqual([list(v) for v in first], [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]])
+
+        cache(["bb", "ccc"])
+        self.assertEqual(calls[-1], ["ccc"])
+
+        # A new process only has the disk tier
+        cache = CachedEmbeddingFunction(embedding_function, "unit", path)
+        cache(["a", "ccc"])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats()["disk_hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 0)
+
+
+class ExtractionTest(unittest.TestCase):
+    def testConcurrentExtraction(self):
+        pages = [f"page {i}" for i in range(8)]
+
+        model = FakeModel(latency=0.2)
+        start = time.perf_counter()
+        serial = extract_images(model, "query", pages, workers=1)
+        serial_time = time.perf_counter() - start
+
+        model = FakeModel(latency=0.2)
+        start = time.perf_counter()
+        concurrent = extract_images(model, "query", pages, workers=4)
+        concurrent_time = time.perf_counter() - start
+
+        self.assertEqual(concurrent, pages)
+        self.assertEqual(concurrent, serial)
+        self.assertEqual(model.max_in_flight, 4)
+        self.assertLess(concurrent_time, serial_time / 2)
+
+    def testExtractionRetries(self):
+        model = FakeModel(failures=2)
+        pages = ["page 0", "page 1"]
+
+        output = extract_images(model, "query", pages, retries=2, retry_delay=0)
+        self.assertEqual(output, pages)
+        self.assertEqual(model.calls, 4)
+
+        with self.assertRaises(RuntimeError):
+            extract_images(
+                FakeModel(failures=3), "query", pages[:1], retries=2, retry_delay=0
+            )
+
+
+class JobQueueTest(unittest.TestCase):
+    def testJobProgressAndCancellation(self):
+        started = threading.Event()
+        cancelled = threading.Event()
+
+        def process_file(collection_name, file_path, progress):
+            progress.update(pages_total=5)
+            if file_path == "first.pdf":
+                # Blocks until the job is cancelled
+                started.set()
+                cancelled.wait(10)
+            for _ in range(5):
+                progress.check_cancelled()
+                progress.update(pages_extracted=1)
+            if file_path == "broken.pdf":
+                raise ValueError("Unreadable file")
+
+        def wait_finished(job):
+            deadline = time.monotonic() + 10
+            while not job.finished:
+                self.assertLess(time.monotonic(), deadline, "job still running")
+                time.sleep(0.01)
+
+        jobs = JobQueue(process_file, workers=2)
+        job = jobs.submit("unit", ["paper.pdf", "broken.pdf"])
+        cancelled_job = jobs.submit("unit", ["first.pdf", "second.pdf"])
+        self.assertTrue(started.wait(10))
+        self.assertTrue(jobs.cancel(cancelled_job.id))
+        cancelled.set()
+        wait_finished(job)
+        wait_finished(cancelled_job)
+
+        status = jobs.get(job.id).to_dict()
+        self.assertEqual(status["status"], "failed")
+        self.assertEqual([f["status"] for f in status["files"]], ["done", "failed"])
+        self.assertEqual(status["files"][0]["pages_extracted"], 5)
+        self.assertEqual(status["files"][1]["failures"], ["Unreadable file"])
+        self.assertEqual(cancelled_job.status, "cancelled")
+        self.assertEqual(
+            [f["status"] for f in cancelled_job.to_dict()["files"]],
+            ["cancelled", "cancelled"],
+        )
+        self.assertFalse(jobs.cancel(cancelled_job.id))
+
+
+class StreamingTest(unittest.TestCase):
+    def testGeneratorStreaming(self):
+        model = FakeModel(
+            latency=0.1, token_latency=0.05, reply=lambda input: "one two three four"
+        )
+        generator = Generator({}, template="{context}\n{message}")
+
+        start = time.perf_counter()
+        tokens = generator.predict_stream(model, "question", [], context=["doc"])
+        first_token = next(tokens)
+        first_token_time = time.perf_counter() - start
+        output = first_token + "".join(tokens)
+        total_time = time.perf_counter() - start
+
+        self.assertEqual(output, generator.predict(model, "question", [], ["doc"]))
+        self.assertLess(first_token_time, total_time - 0.1)
+
+
+class SemanticCacheTest(unittest.TestCase):
+    """Test the semantic answer cache."""
+
+    def testSemanticCache(self):
+        lookups = dict(ANSWER_CACHE_LOOKUPS.values)
+        cache = SemanticCache(threshold=0.95, history_policy="standalone")
+        generation = cache.generation("docs")
+        answer = {"output": "a"}
+        cache.store("docs", "agent", "model", [1.0, 0.0], [], answer, generation)
+
+        self.assertEqual(
+            cache.lookup("docs", "agent", "model", [0.99, 0.05], []), answer
+        )
+        self.assertIsNone(cache.lookup("docs", "agent", "model", [0.0, 1.0], []))
+        self.assertIsNone(cache.lookup("docs", "agent", "other", [1.0, 0.0], []))
+        self.assertEqual(
+            ANSWER_CACHE_LOOKUPS.values[("miss",)], lookups.get(("miss",), 0) + 2
+        )
+        self.assertEqual(
+            ANSWER_CACHE_LOOKUPS.values[("hit",)], lookups.get(("hit",), 0) + 1
+        )
+        history = [{"role": "user", "content": "hello"}]
+        self.assertIsNone(cache.lookup("docs", "agent", "model", [1.0, 0.0], history))
+        self.assertFalse(cache.cacheable(history))
+        self.assertTrue(cache.cacheable([{"role": "assistant", "content": "hi"}]))
+
+        cache.bump("docs")
+        self.assertIsNone(cache.lookup("docs", "agent", "model", [1.0, 0.0], []))
+        # An answer computed before the collection changed is never served.
+        cache.store("docs", "agent", "model", [1.0, 0.0], [], answer, generation)
+        self.assertIsNone(cache.lookup("docs", "agent", "model", [1.0, 0.0], []))
+
+
+class ContextPackerTest(unittest.TestCase):
+    """Test the selection of the retrieved chunks."""
+
+    def testContextPacker(self):
+        packer = ContextPacker(lambda text: len(text.split()), 0.5, 0.2)
+        hits = [("a", 0.1), ("b", 0.25), ("c", 0.35), ("d", 0.6)]
+        self.assertEqual(packer.filter(hits), [("a", 0.1), ("b", 0.25)])
+
+        first = " ".join(f"w{i}" for i in range(20))
+        overlapping = " ".join(f"w{i}" for i in range(2, 20))
+        other = " ".join(f"v{i}" for i in range(10))
+        self.assertEqual(packer.pack([first, overlapping, other], 100), [first, other])
+        self.assertEqual(packer.pack([first, other], 15), [other])
+
+
+class HistoryManagerTest(unittest.TestCase):
+    """Test the bounded conversation history."""
+
+    def testHistoryManager(self):
+        model = FakeModel(reply=lambda input: "summary")
+        manager = HistoryManager(lambda text: len(text.split()), window_tokens=10)
+        history = [{"role": "user", "content": f"message {i}"} for i in range(8)]
+
+        # Older messages are dropped and counted until their summary is computed
+        dropped = HISTORY_DROPPED_MESSAGES.values.get((), 0)
+        self.assertNotIn("message 4", manager.render(model, history))
+        self.assertEqual(manager.dropped, 5)
+        self.assertEqual(HISTORY_DROPPED_MESSAGES.values[()] - dropped, 5)
+        manager.executor.submit(lambda: None).result()
+        self.assertEqual(model.calls, 1)
+        rendered = manager.render(model, history)
+        self.assertTrue(rendered.startswith("Summary of the earlier conversation"))
+        self.assertIn("message 5", rendered)
+        self.assertEqual(manager.dropped, 5)
+
+        # The window slides: the summary covers only part of the older
+        # messages, the rest is dropped rather than exceeding the window
+        history.append({"role": "user", "content": "message 8"})
+        rendered = manager.render(model, history)
+        self.assertIn("summary", rendered)
+        self.assertNotIn("message 5", rendered)
+        self.assertIn("message 6", rendered)
+        self.assertEqual(manager.dropped, 6)
+        self.assertEqual(
+            rendered,
+            "Summary of the earlier conversation: summary\n"
+            + format_history(history[6:]),
+        )
+
+
+class AsyncTest(unittest.TestCase):
+    """Test that async model calls do not hold a thread while waiting."""
+
+    def testConcurrentGeneration(self):
+        model = FakeModel(latency=0.2)
+        generator = Generator({}, template="{context}\n{message}")
+
+        async def generate(n):
+            return await asyncio.gather(
+                *[generator.apredict(model, f"q{i}", [], ["doc"]) for i in range(n)]
+            )
+
+        start = time.perf_counter()
+        outputs = asyncio.run(generate(200))
+        self.assertLess(time.perf_counter() - start, 2.0)
+        self.assertEqual(model.max_in_flight, 200)
+        self.assertEqual(outputs[0], generator.predict(model, "q0", [], ["doc"]))
+
+
+class SchedulerTest(unittest.TestCase):
+    """Test the shared rate limiter of the model calls."""
+
+    def testRetries(self):
+        scheduler = LLMScheduler(max_retries=3, base_delay=0.01)
+        model = FakeModel(failures=2, error=ResourceExhausted)
+        self.assertEqual(scheduler.call(model.predict, "input"), "input")
+        self.assertEqual(scheduler.stats()["retries"], 2)
+
+        model = FakeModel(failures=1)
+        with self.assertRaises(RuntimeError):
+            scheduler.call(model.predict, "input")
+        self.assertEqual(model.calls, 1)
+
+    def testShare(self):
+        scheduler = LLMScheduler(rpm=60, tpm=6000)
+        scheduler.share(4)
+        self.assertEqual(scheduler.requests.rate, 15)
+        self.assertLessEqual(scheduler.tokens.tokens, 1500)
+
+    def testStreamRetries(self):
+        scheduler = LLMScheduler(max_retries=3, base_delay=0.01)
+        model = FakeModel(failures=2, error=ResourceExhausted)
+        _, chunks = scheduler.call_stream(model.predict_stream, "one two")
+        self.assertEqual(list(chunks), ["one ", "two"])
+        self.assertEqual(scheduler.stats()["retries"], 2)
+
+        def interrupted():
+            yield "one "
+            raise ResourceExhausted("Quota exceeded")
+
+        # Part of the answer was delivered: the error is not retried
+        _, chunks = scheduler.call_stream(interrupted)
+        self.assertEqual(next(chunks), "one ")
+        self.assertRaises(ResourceExhausted, next, chunks)
+        self.assertEqual(scheduler.stats()["stream_errors"], 1)
+        self.assertEqual(scheduler.stats()["retries"], 2)
+
+    def testPriority(self):
+        scheduler = LLMScheduler(rpm=600)
+        scheduler.requests.tokens = 0
+        admitted = []
+
+        def call(name, priority):
+            with llm_priority(priority):
+                scheduler.call(admitted.append, name)
+
+        ingestion = threading.Thread(target=call, args=("ingestion", INGESTION))
+        interactive = threading.Thread(target=call, args=("chat", INTERACTIVE))
+        ingestion.start()
+        time.sleep(0.02)
+        interactive.start()
+        ingestion.join()
+        interactive.join()
+
+        self.assertEqual(admitted, ["chat", "ingestion"])
+        self.assertEqual(scheduler.stats()["max_queue_depth"], 2)
+
+    def testAsyncAcquire(self):
+        scheduler = LLMScheduler(rpm=600)
+        scheduler.requests.tokens = 0
+        admitted = []
+
+        def ingest():
+            with llm_priority(INGESTION):
+                scheduler.acquire(0)
+            admitted.append("ingestion")
+
+        async def chat(name):
+            await scheduler.aacquire(0)
+            admitted.append(name)
+
+        async def run():
+            ingestion = threading.Thread(target=ingest)
+            ingestion.start()
+            while not scheduler.stats()["queue_depth"]["ingestion"]:
+                await asyncio.sleep(0.001)
+            threads = threading.active_count()
+            chats = asyncio.gather(chat("chat1"), chat("chat2"))
+            await asyncio.sleep(0.02)
+            # Throttled async calls wait on the event loop
+            self.assertEqual(scheduler.stats()["queue_depth"]["interactive"], 2)
+            self.assertEqual(threading.active_count(), threads)
+            await chats
+            await asyncio.to_thread(ingestion.join)
+
+        asyncio.run(run())
+        self.assertEqual(admitted, ["chat1", "chat2", "ingestion"])
+        self.assertEqual(scheduler.stats()["throttled"], 3)
+
+
+class MetricsTest(unittest.TestCase):
+    """Test the stage spans and the Prometheus export."""
+
+    def testSpans(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("stage_seconds", "Stages.", ("stage",))
+        histogram.observe(0.003, stage="embed")
+        histogram.observe(2.0, stage="embed")
+        text = registry.render()
+        self.assertIn("# TYPE stage_seconds histogram", text)
+        self.assertIn('stage_seconds_bucket{stage="embed",le="0.005"} 1', text)
+        self.assertIn('stage_seconds_bucket{stage="embed",le="+Inf"} 2', text)
+        self.assertIn('stage_seconds_count{stage="embed"} 2', text)
+
+        with request_context("request") as trace:
+            with span("retrieval"):
+                time.sleep(0.01)
+            with span("retrieval"):
+                pass
+        self.assertEqual(list(trace), ["retrieval"])
+        self.assertGreaterEqual(trace["retrieval"], 0.01)
+
+
+class ChunkingTest(unittest.TestCase):
+    """Test the streaming chunker."""
+
+    def testChunking(self):
+        pages = [
+            "\n".join(f"p{page} line{line} a b c" for line in range(10))
+            for page in range(1, 4)
+        ]
+        chunks = list(iter_chunks(pages, max_chunk_size=20, overlap=3))
+        for (previous, _), (chunk, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(chunk.split()[:3], previous.split()[-3:])
+        self.assertTrue(all(len(chunk.split()) <= 20 for chunk, _ in chunks))
+        self.assertEqual(chunks[0][1], 1)
+        self.assertEqual(chunks[-1][1], 3)
+
+        sub_chunks = list(iter_sub_chunks(pages, 20, 10, overlap=3))
+        parents = {}
+        for sub_chunk, _, parent in sub_chunks:
+            self.assertLessEqual(len(sub_chunk.split()), 10)
+            parents[parent] = parents.get(parent, "") + sub_chunk
+        self.assertEqual(list(parents.values()), [chunk for chunk, _ in chunks])
+
+
+class PdfTextTest(unittest.TestCase):
+    """Test the text extraction backends."""
+
+    def testBackends(self):
+        reference = list(iter_page_texts(TEST_FILE, "PyPDF2"))
+        pages = list(iter_page_texts(TEST_FILE, "pdfium", workers=2, pages_per_task=1))
+        self.assertEqual(
+            [number for number, _ in pages], list(range(1, len(reference) + 1))
+        )
+        self.assertGreater(len(" ".join(text for _, text in pages).split()), 0)
+
+
+class UploadTest(unittest.TestCase):
+    """Test the resumable uploads."""
+
+    def testResumableUpload(self):
+        uploads = UploadSessions(tempfile.mkdtemp(), max_size=10, block_size=3)
+        self.assertRaises(UploadTooLarge, uploads.init, "unit", "a.pdf", 11)
+        upload_id = uploads.init("unit", "a.pdf", 8)["upload_id"]
+
+        self.assertEqual(uploads.append(upload_id, 0, io.BytesIO(b"abcde")), 5)
+        # A retried part overlapping the received data is only appended once
+        self.assertEqual(uploads.append(upload_id, 3, io.BytesIO(b"def")), 6)
+        with self.assertRaises(UploadOffsetMismatch) as context:
+            uploads.append(upload_id, 7, io.BytesIO(b"h"))
+        self.assertEqual(context.exception.received, 6)
+        with self.assertRaises(UploadTooLarge):
+            uploads.append(upload_id, 6, io.BytesIO(b"ghi"))
+        self.assertEqual(uploads.get(upload_id)["received"], 6)
+
+        uploads.append(upload_id, 6, io.BytesIO(b"gh"))
+        session, path = uploads.commit(upload_id)
+        self.assertEqual(session["filename"], "a.pdf")
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"abcdefgh")
+        self.assertIsNone(uploads.get(upload_id))
+
+    def testFailedReupload(self):
+        config = {"dataset": {"CHROMA_DATA_PATH": tempfile.mkdtemp()}}
+        folder = os.path.join(config["dataset"]["CHROMA_DATA_PATH"], "upload", "unit")
+        destination = os.path.join(folder, "a.pdf")
+        ingested = []
+
+        def stage(content):
+            path = staging_path(config, "a.pdf")
+            with open(path, "wb") as file:
+                file.write(content)
+            return path
+
+        def fail(path):
+            raise ValueError("Unreadable file")
+
+        ingest_staged(stage(b"first"), destination, ingested.append)
+        self.assertEqual(os.path.basename(ingested[0]), "a.pdf")
+        staged = stage(b"second")
+        self.assertRaises(ValueError, ingest_staged, staged, destination, fail)
+
+        # The previous version is still listed and can be deleted
+        self.assertFalse(os.path.exists(staged))
+        self.assertEqual(os.listdir(folder), ["a.pdf"])
+        with open(destination, "rb") as file:
+            self.assertEqual(file.read(), b"first")
+        ingest_staged(stage(b"third"), destination, ingested.append)
+        with open(destination, "rb") as file:
+            self.assertEqual(file.read(), b"third")
+        os.remove(destination)
+        self.assertEqual(os.listdir(folder), [])
+
+
+class BulkIngestTest(unittest.TestCase):
+    """Test the checkpoint of bulk ingestion."""
+
+    def testCheckpoint(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "checkpoint.jsonl")
+        document = os.path.join(folder, "a.pdf")
+        with open(document, "wb") as file:
+            file.write(b"first")
+        checkpoint = Checkpoint(path)
+        checkpoint.record("a.pdf", os.stat(document), pages=1, chunks=2)
+        checkpoint.close()
+        # Line cut by an interruption
+        with open(path, "a", encoding="utf-8") as file:
+            file.write('{"file": "b.p')
+
+        checkpoint = Checkpoint(path)
+        self.assertTrue(checkpoint.is_done("a.pdf", os.stat(document)))
+        self.assertNotIn("b.pdf", checkpoint.entries)
+        with open(document, "wb") as file:
+            file.write(b"modified")
+        self.assertFalse(checkpoint.is_done("a.pdf", os.stat(document)))
+        checkpoint.record("a.pdf", os.stat(document), pages=1, chunks=3)
+        checkpoint.close()
+        self.assertEqual(Checkpoint(path).entries["a.pdf"]["chunks"], 3)
+
+
+class VectorStoreTest(unittest.TestCase):
+    """Test the NumPy vector store."""
+
+    def testNumpyVectorStore(self):
+        folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(300, 8))
+        store = NumpyVectorStore(folder, "unit")
+        store.add(
+            ids=[f"id{i}" for i in range(300)],
+            embeddings=embeddings,
+            documents=[f"chunk {i}" for i in range(300)],
+            metadatas=[{"from": f"{i % 3}.pdf", "chunk": i // 2} for i in range(300)],
+        )
+        queries = rng.normal(size=(2, 8))
+        normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        expected = np.argsort(-(queries @ normalized.T), axis=1)[:, :5]
+
+        result = store.query(query_embeddings=queries, n_results=5)
+        self.assertEqual(result["ids"], [[f"id{i}" for i in row] for row in expected])
+        result = store.query(
+            query_embeddings=queries[:1], n_results=5, where={"from": "1.pdf"}
+        )
+        self.assertEqual(
+            {metadata["from"] for metadata in result["metadatas"][0]}, {"1.pdf"}
+        )
+        self.assertEqual(
+            store.get(where={"chunk": {"$in": [3]}})["documents"],
+            ["chunk 6", "chunk 7"],
+        )
+
+        store.delete(where={"from": "0.pdf"})
+        store.close()
+        store = NumpyVectorStore(folder, "unit")
+        self.assertEqual(store.count(), 200)
+        result = store.query(query_embeddings=queries[:1], n_results=200)
+        self.assertEqual(len(result["ids"][0]), 200)
+        self.assertNotIn("0.pdf", {m["from"] for m in result["metadatas"][0]})
+        # Backends implement the whole interface
+        self.assertRaises(TypeError, VectorStore, "unit")
+
+
 if __name__ == "__main__":
     load_dotenv()
 